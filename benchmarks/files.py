@@ -0,0 +1,124 @@
+"""
+Throughput benchmark for file attachments.
+
+Uploads and downloads files of several sizes through the v2 files API and
+reports the time spent per MB in each direction, along with the peak memory
+allocated while doing so. Download memory should follow the chunk size, not
+the file size; upload memory also counts what an in-process storage (such as
+fakeredis) keeps.
+
+The storage is configured through the usual environment variables::
+
+    $ MOCK_REDIS=1 python benchmarks/files.py --sizes 1,8 --chunk-size 65536
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snappass.main as snappass  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class RandomStream:
+    """
+    Binary stream of ``size`` pseudo-random bytes, generated as it is read.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = offset + (self.size if whence == os.SEEK_END else 0)
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        self.position += size
+        return os.urandom(size)
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(client, size, iterations):
+    """
+    Upload and download a ``size`` bytes file ``iterations`` times, returning
+    the total (upload, download) durations and peak allocations.
+    """
+    upload = download = 0.0
+    upload_peak = download_peak = 0
+    for _ in range(iterations):
+        rv, elapsed, peak = measure(lambda: client.post(
+            '/api/v2/files?filename=bench.bin', input_stream=RandomStream(size),
+            content_type='application/octet-stream'))
+        if rv.status_code != 200:
+            raise RuntimeError('Upload failed: %s' % rv.get_data(as_text=True))
+        upload += elapsed
+        upload_peak = max(upload_peak, peak)
+
+        url = '/api/v2/files/' + quote(rv.get_json()['token'])
+
+        def download_file():
+            rv = client.get(url, buffered=False)
+            received = sum(len(chunk) for chunk in rv.response)
+            rv.close()
+            return received
+        received, elapsed, peak = measure(download_file)
+        if received != size:
+            raise RuntimeError('Downloaded %d bytes out of %d' % (received, size))
+        download += elapsed
+        download_peak = max(download_peak, peak)
+    return upload, download, upload_peak, download_peak
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1,4,10',
+                        help='comma separated file sizes, in MB (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=3,
+                        help='how many times each file is uploaded and downloaded (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=snappass.SETTINGS['SNAPPASS_FILE_CHUNK_SIZE'][1],
+                        help='encrypted chunk size, in bytes (default: %(default)s)')
+    args = parser.parse_args(argv)
+    args.sizes = [float(size) for size in args.sizes.split(',') if size]
+    return args
+
+
+def main(argv=None, out=sys.stdout):
+    args = parse_args(argv)
+    app = snappass.create_app({'SNAPPASS_FILE_CHUNK_SIZE': args.chunk_size,
+                               'SNAPPASS_MAX_FILE_SIZE': int(max(args.sizes) * MB)})
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    out.write('%10s %14s %14s %14s %14s\n' % ('size (MB)', 'upload s/MB', 'download s/MB',
+                                              'upload peak', 'download peak'))
+    for size in args.sizes:
+        upload, download, upload_peak, download_peak = run(client, int(size * MB), args.iterations)
+        megabytes = size * args.iterations
+        out.write('%10g %14.4f %14.4f %13.1fK %13.1fK\n'
+                  % (size, upload / megabytes, download / megabytes, upload_peak / 1024, download_peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Key mode benchmark.
+
+Creates and reveals secrets through the v2 API, once with a fresh Fernet key
+per secret (the default) and once with envelope encryption under a server
+master key, and reports the median time of each operation along with the
+length of the tokens handed out.
+
+The storage is configured through the usual environment variables::
+
+    $ MOCK_REDIS=1 python benchmarks/keys.py --iterations 2000 --size 64
+"""
+import argparse
+import base64
+import os
+import statistics
+import sys
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snappass.main as snappass  # noqa: E402
+
+MODES = {
+    'fernet': {},
+    'envelope': {'SNAPPASS_MASTER_KEYS': 'bench:' + base64.urlsafe_b64encode(os.urandom(32)).decode('ascii')},
+}
+
+
+def run(config, size, iterations):
+    """
+    Return the create and reveal durations (seconds), and the token length.
+    """
+    app = snappass.create_app(config)
+    app.config['TESTING'] = True
+    client = app.test_client()
+    password = 'x' * size
+    create, reveal = [], []
+    token = ''
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = client.post('/api/v2/passwords', json={'password': password})
+        create.append(time.perf_counter() - started)
+        token = response.get_json()['token']
+
+        started = time.perf_counter()
+        response = client.get('/api/v2/passwords/' + quote(token))
+        reveal.append(time.perf_counter() - started)
+        assert response.get_json()['password'] == password
+    return create, reveal, len(token)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='secrets created and revealed in each mode (default: %(default)s)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='secret size, in bytes (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, out=sys.stdout):
+    args = parse_args(argv)
+    out.write('%-10s %12s %12s %14s\n' % ('mode', 'create us', 'reveal us', 'token length'))
+    for mode, config in MODES.items():
+        create, reveal, token_length = run(config, args.size, args.iterations)
+        out.write('%-10s %12.1f %12.1f %14d\n' % (mode, statistics.median(create) * 1e6,
+                                                  statistics.median(reveal) * 1e6, token_length))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Load test and latency benchmark for snappass.
+
+Drives the Flask application through the browser flow (create, preview,
+reveal) and the v2 API flow (create, check, retrieve) from several threads,
+then reports throughput and latency percentiles per route, and per phase of
+the request: Fernet encryption/decryption, storage calls and template
+rendering.
+
+The storage is configured through the usual environment variables, so run it
+against fakeredis or a local Redis::
+
+    $ MOCK_REDIS=1 python benchmarks/load.py --concurrency 8 --sizes 16,65536
+    $ REDIS_URL=redis://localhost:6379/0 python benchmarks/load.py --mode server
+"""
+import argparse
+import collections
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+from urllib.parse import quote, unquote, urlencode, urlparse
+
+from flask import before_render_template, template_rendered
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snappass.main as snappass  # noqa: E402
+from snappass.metrics import NullMetrics  # noqa: E402
+
+FLOWS = ('web', 'v2')
+
+
+class Recorder:
+    """
+    Thread-safe collection of durations (in seconds) by name.
+    """
+
+    def __init__(self):
+        self.durations = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.durations[name].append(duration)
+
+    def timed(self, name, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return wrapper
+
+
+class TimedStorage:
+    """
+    Proxy timing every call made to a storage backend.
+    """
+
+    def __init__(self, storage, recorder):
+        self.storage = storage
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return self.recorder.timed('storage.' + name, getattr(self.storage, name))
+
+
+class TimedMetrics(NullMetrics):
+    """
+    Metrics recording the duration of every crypto operation.
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    @contextmanager
+    def crypto_timer(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.recorder.add('crypto.' + operation, time.perf_counter() - start)
+
+
+def percentile(durations, fraction):
+    ordered = sorted(durations)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def instrument(stack, recorder):
+    """
+    Time the crypto, storage and template phases of every request.
+    """
+    services = snappass.current_services()
+    stack.enter_context(mock.patch.object(services, 'metrics', TimedMetrics(recorder)))
+    stack.enter_context(mock.patch.object(services, 'storage', TimedStorage(services.storage, recorder)))
+
+    started = threading.local()
+
+    def before_render(sender, template, context, **extra):
+        started.at = time.perf_counter()
+
+    def rendered(sender, template, context, **extra):
+        recorder.add('template.' + template.name, time.perf_counter() - started.at)
+
+    before_render_template.connect(before_render, snappass.app)
+    template_rendered.connect(rendered, snappass.app)
+    stack.callback(before_render_template.disconnect, before_render, snappass.app)
+    stack.callback(template_rendered.disconnect, rendered, snappass.app)
+
+
+class TestClientDriver:
+    """
+    Issue requests in-process through Flask's test client.
+    """
+
+    def __init__(self):
+        self.client = snappass.app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, data=body, headers=headers or {})
+        return response.status_code, response.get_data()
+
+
+class ServerDriver:
+    """
+    Issue requests over HTTP to a threaded WSGI server.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection(self.host, self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def web_flow(driver, recorder, secret):
+    body = urlencode({'password': secret, 'ttl': 'hour'})
+    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'}
+    status, content = timed_request(recorder, 'handle_password', driver, 'POST', '/', body, headers)
+    key = urlparse(json.loads(content)['link']).path.rsplit('/', 1)[1]
+    timed_request(recorder, 'preview_password', driver, 'GET', '/' + key)
+    timed_request(recorder, 'show_password', driver, 'POST', '/' + key)
+
+
+def v2_flow(driver, recorder, secret):
+    body = json.dumps({'password': secret, 'ttl': 3600})
+    headers = {'Content-Type': 'application/json'}
+    status, content = timed_request(recorder, 'api_v2_set_password', driver, 'POST', '/api/v2/passwords',
+                                    body, headers)
+    path = '/api/v2/passwords/' + quote(unquote(json.loads(content)['token']), safe='')
+    timed_request(recorder, 'api_v2_check_password', driver, 'HEAD', path)
+    timed_request(recorder, 'api_v2_retrieve_password', driver, 'GET', path)
+
+
+def timed_request(recorder, name, driver, method, path, body=None, headers=None):
+    start = time.perf_counter()
+    status, content = driver.request(method, path, body, headers)
+    recorder.add('route.' + name, time.perf_counter() - start)
+    if status >= 400:
+        raise RuntimeError('%s %s answered %d' % (method, path, status))
+    return status, content
+
+
+def run(make_driver, flows, secret, iterations, concurrency):
+    """
+    Run ``iterations`` of each flow spread over ``concurrency`` threads, and
+    return the recorder and the elapsed wall time.
+    """
+    recorder = Recorder()
+    flow_functions = {'web': web_flow, 'v2': v2_flow}
+    per_thread = [iterations // concurrency + (1 if i < iterations % concurrency else 0)
+                  for i in range(concurrency)]
+    errors = []
+
+    def worker(count):
+        driver = make_driver()
+        try:
+            for _ in range(count):
+                for flow in flows:
+                    flow_functions[flow](driver, recorder, secret)
+        except Exception as e:
+            errors.append(e)
+
+    with ExitStack() as stack:
+        instrument(stack, recorder)
+        threads = [threading.Thread(target=worker, args=(count,)) for count in per_thread]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return recorder, elapsed
+
+
+def report(recorder, elapsed, out=sys.stdout):
+    out.write('%-40s %8s %10s %9s %9s %9s\n' % ('name', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name in sorted(recorder.durations):
+        durations = recorder.durations[name]
+        out.write('%-40s %8d %10.1f %9.3f %9.3f %9.3f\n' % (
+            name, len(durations), len(durations) / elapsed,
+            percentile(durations, 0.50) * 1000,
+            percentile(durations, 0.95) * 1000,
+            percentile(durations, 0.99) * 1000))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('client', 'server'), default='client',
+                        help='drive the app through the Flask test client, or through a real WSGI server')
+    parser.add_argument('--flows', default=','.join(FLOWS),
+                        help='comma separated flows to run (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='how many times each flow runs, per secret size (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of client threads (default: %(default)s)')
+    parser.add_argument('--sizes', default='16,1024,65536',
+                        help='comma separated secret sizes, in bytes (default: %(default)s)')
+    args = parser.parse_args(argv)
+    args.flows = [flow for flow in args.flows.split(',') if flow]
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    for flow in args.flows:
+        if flow not in FLOWS:
+            parser.error('unknown flow %r' % flow)
+    return args
+
+
+def main(argv=None, out=sys.stdout):
+    args = parse_args(argv)
+    snappass.app.config['TESTING'] = True
+
+    with ExitStack() as stack:
+        if args.mode == 'server':
+            server = make_server('127.0.0.1', 0, snappass.app, threaded=True,
+                                 request_handler=QuietRequestHandler)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            stack.callback(server.shutdown)
+
+            def make_driver():
+                return ServerDriver('127.0.0.1', server.server_port)
+        else:
+            make_driver = TestClientDriver
+
+        for size in args.sizes:
+            recorder, elapsed = run(make_driver, args.flows, 'x' * size, args.iterations, args.concurrency)
+            out.write('\n== %s mode, %d byte secrets, %d threads, %.2fs ==\n'
+                      % (args.mode, size, args.concurrency, elapsed))
+            report(recorder, elapsed, out)
+
+
+if __name__ == '__main__':
+    main()
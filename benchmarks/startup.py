@@ -0,0 +1,80 @@
+"""
+Startup benchmark.
+
+Measures, in fresh interpreters, how long importing ``snappass.main``,
+creating an application and serving its first request each take, and lists
+the optional backends (redis-py, prometheus_client, cryptography, distutils)
+already imported after each phase. Cold start latency matters for
+autoscaled, serverless and CLI uses of SnapPass.
+
+The storage is configured through the usual environment variables::
+
+    $ MOCK_REDIS=1 python benchmarks/startup.py --runs 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = ('redis', 'prometheus_client', 'cryptography', 'distutils')
+
+PHASES = ('import', 'create_app', 'first_request')
+
+# Run in a fresh interpreter, so nothing is imported or cached beforehand.
+CHILD = '''
+import json, sys, time
+
+backends = %r
+timings, loaded = {}, {}
+
+def done(phase, started):
+    timings[phase] = time.perf_counter() - started
+    loaded[phase] = [name for name in backends if name in sys.modules]
+
+started = time.perf_counter()
+import snappass.main
+done('import', started)
+
+started = time.perf_counter()
+app = snappass.main.create_app()
+done('create_app', started)
+
+started = time.perf_counter()
+response = app.test_client().post('/api/v2/passwords', json={'password': 'startup'})
+assert response.status_code == 200, response.status_code
+done('first_request', started)
+
+print(json.dumps({'timings': timings, 'loaded': loaded}))
+''' % (BACKENDS,)
+
+
+def measure():
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, check=True,
+                            stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='how many fresh interpreters to start (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, out=sys.stdout):
+    args = parse_args(argv)
+    runs = [measure() for _ in range(args.runs)]
+
+    out.write('%-14s %12s %12s  %s\n' % ('phase', 'median ms', 'max ms', 'backends imported'))
+    for phase in PHASES:
+        durations = [run['timings'][phase] * 1000 for run in runs]
+        out.write('%-14s %12.1f %12.1f  %s\n' % (phase, statistics.median(durations), max(durations),
+                                                 ', '.join(runs[-1]['loaded'][phase]) or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,10 @@ setup(
                       open('AUTHORS.rst').read()),
     url='http://github.com/Pinterest/snappass/',
     install_requires=['Flask', 'redis', 'cryptography'],
+    extras_require={
+        'metrics': ['prometheus_client'],
+        'server': ['gunicorn'],
+    },
     license='MIT',
     author='Dave Dash',
     author_email='dd+github@davedash.com',
@@ -15,6 +19,7 @@ setup(
     entry_points={
         'console_scripts': [
             'snappass = snappass.main:main',
+            'snappass-events = snappass.events:main',
         ],
     },
     include_package_data=True,
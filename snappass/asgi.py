@@ -0,0 +1,355 @@
+"""
+ASGI entry point serving snappass with an asyncio Redis client.
+
+The routes that touch storage are served natively on the event loop, so a
+single process can hold many in-flight requests; everything else (the index
+page, static assets, file attachments, 404s) is handed to the regular Flask
+application.
+
+Run it with any ASGI server, for example::
+
+    $ uvicorn snappass.asgi:application
+"""
+import asyncio
+import io
+import re
+import sys
+import time
+from urllib.parse import unquote_plus
+
+from flask import abort, request
+from werkzeug.exceptions import HTTPException
+
+from snappass import main
+from snappass.capacity import REJECTED, InsufficientCapacity, is_out_of_memory
+from snappass.main import (
+    RATE_LIMITED_ENDPOINTS,
+    StorageCall,
+    as_capacity_problem,
+    as_rate_limited_problem,
+    default_app,
+    is_connection_error,
+    is_file_key,
+    parse_token,
+    request_cost,
+    trust_proxies,
+)
+from snappass.redis_config import create_redis_client
+from snappass.storage import AsyncRedisStorage, RedisStorage, ThreadedStorage, run_in_thread
+
+app = default_app()
+services = app.extensions['snappass']
+
+# Initialize storage: Redis natively through redis.asyncio, the other
+# backends on worker threads.
+if isinstance(services.storage, RedisStorage):
+    storage = AsyncRedisStorage(create_redis_client(use_asyncio=True, environ=services.environ),
+                                services.storage.transactions)
+else:
+    storage = ThreadedStorage(services.storage)
+
+
+async def run_steps(steps):
+    """
+    Run the steps of an operation or view of :mod:`snappass.main`, awaiting
+    each of their calls, and return their result.
+    """
+    send, value = steps.send, None
+    while True:
+        try:
+            call = send(value)
+        except StopIteration as e:
+            return e.value
+        try:
+            if isinstance(call, StorageCall):
+                with services.metrics.storage_timer(call.command):
+                    value = await getattr(storage, call.command)(*call.args)
+            else:
+                with services.metrics.crypto_timer(call.operation):
+                    value = await services.crypto_executor.run_async(call.func, call.size, *call.args)
+        except Exception as e:
+            send, value = steps.throw, e
+        else:
+            send = steps.send
+
+
+async def set_password(password, ttl, views=1):
+    return await run_steps(main.set_password_steps(password, ttl, views))
+
+
+async def get_password(token):
+    return (await run_steps(main.take_password_steps(token)))[0]
+
+
+class ServedByFlask(Exception):
+    """
+    Raised by a view to hand its request over to the Flask application, as
+    for files, which are only told apart from passwords once their token is
+    parsed, and are streamed back by Flask.
+    """
+
+
+def show_password_steps(password_key):
+    if is_file_key(parse_token(unquote_plus(password_key))[0]):
+        raise ServedByFlask()
+    return (yield from main.show_password_steps(password_key))
+
+
+# (method, path pattern, endpoint, steps), matched in order; anything else is
+# served by Flask.
+ROUTES = [
+    ('POST', re.compile(r'^/$'), 'handle_password', main.handle_password_steps),
+    ('POST', re.compile(r'^/api/set_password/$'), 'api_handle_password', main.api_handle_password_steps),
+    ('POST', re.compile(r'^/api/v2/passwords$'), 'api_v2_set_password', main.api_v2_set_password_steps),
+    ('POST', re.compile(r'^/api/v2/passwords/batch$'), 'api_v2_set_passwords', main.api_v2_set_passwords_steps),
+    ('POST', re.compile(r'^/api/v2/passwords/status$'), 'api_v2_check_passwords',
+     main.api_v2_check_passwords_steps),
+    ('HEAD', re.compile(r'^/api/v2/passwords/([^/]+)$'), 'api_v2_check_password', main.api_v2_check_password_steps),
+    ('GET', re.compile(r'^/api/v2/passwords/([^/]+)$'), 'api_v2_retrieve_password',
+     main.api_v2_retrieve_password_steps),
+    ('GET', re.compile(r'^/_/_/health$'), 'health_check', main.health_check_steps),
+    ('GET', re.compile(r'^/([^/]+)$'), 'preview_password', main.preview_password_steps),
+    ('POST', re.compile(r'^/([^/]+)$'), 'show_password', show_password_steps),
+]
+
+
+def match_route(method, path):
+    for route_method, pattern, endpoint, steps in ROUTES:
+        if route_method != method:
+            continue
+        match = pattern.match(path)
+        if match:
+            return endpoint, steps, match.groups()
+    return None, None, ()
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    The request body, as read by the Flask application in a worker thread:
+    each ASGI message is only received from the event loop once needed, so
+    uploads are never held in memory whole.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect' or not message.get('more_body'):
+                self._done = True
+            self._buffer = message.get('body', b'')
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def build_environ(scope, stream, content_length=None):
+    """
+    Translate an ASGI HTTP scope into a WSGI environ, so Flask can parse the
+    request and render responses exactly as it does under WSGI.
+
+    The body is read from ``stream``, ``content_length`` bytes long if
+    already read, as told by the client otherwise.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # Without a Content-Length, the body is read until its last message.
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if content_length is not None:
+        environ['CONTENT_LENGTH'] = str(content_length)
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH' and content_length is not None:
+            # The body has already been read in full.
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def call_wsgi(environ, send, loop):
+    """
+    Serve a request with the Flask application, in a worker thread, sending
+    the response to the ASGI server as it is produced, so that downloads are
+    never held in memory whole.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    def emit(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    iterable = app.wsgi_app(environ, start_response)
+    try:
+        emit(response_start(started['status'], started['headers']))
+        for chunk in iterable:
+            if chunk:
+                emit({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        emit({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+def response_start(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    }
+
+
+def ignore(environ, start_response):
+    pass
+
+
+async def dispatch(endpoint, steps, args, environ):
+    started = time.perf_counter()
+    if app.config['SNAPPASS_PROXY_COUNT']:
+        # Native routes bypass app.wsgi_app, and the proxy fix wrapping it.
+        trust_proxies(ignore, app.config['SNAPPASS_PROXY_COUNT'])(environ, None)
+    with app.request_context(environ):
+        rate_limiter = services.rate_limiter
+        try:
+            retry_after = 0
+            if endpoint in rate_limiter.limits:
+                identity = rate_limiter.identity(request.remote_addr, request.headers.get('X-API-Key'))
+                retry_after = await run_in_thread(rate_limiter.check, endpoint, identity, request_cost(endpoint))
+            if retry_after:
+                response = as_rate_limited_problem(request, retry_after)
+            elif endpoint in RATE_LIMITED_ENDPOINTS and await admit() == REJECTED:
+                response = as_capacity_problem(request, InsufficientCapacity(services.capacity.interval))
+            else:
+                response = app.make_response(await run_steps(steps(*args)))
+        except InsufficientCapacity as e:
+            response = as_capacity_problem(request, e)
+        except HTTPException as e:
+            response = e.get_response(environ)
+        except Exception as e:
+            if is_out_of_memory(e):
+                response = as_capacity_problem(request, InsufficientCapacity(services.capacity.interval, 503))
+            elif is_connection_error(e):
+                print('Failed to connect to redis! %s' % e)
+                response = abort_response(500, environ)
+            else:
+                raise
+        metrics = services.metrics
+        metrics.observe_request(endpoint, environ['REQUEST_METHOD'], response.status_code,
+                                time.perf_counter() - started)
+        if metrics.enabled:
+            metrics.observe_pool(pool_client())
+        body = b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.get_data()
+        return response.status_code, list(response.headers.items()), body
+
+
+def pool_client():
+    # Native routes use the asyncio client, when storage has one.
+    if isinstance(storage, AsyncRedisStorage):
+        return storage.client
+    return services.redis_pool_client()
+
+
+async def admit():
+    capacity = services.capacity
+    if not capacity.enabled:
+        return None
+    decision = await run_in_thread(capacity.admit)
+    services.metrics.observe_admission(decision)
+    return decision
+
+
+def abort_response(status_code, environ):
+    try:
+        abort(status_code)
+    except HTTPException as e:
+        return e.get_response(environ)
+
+
+async def read_body(receive, limit):
+    """
+    Read the body of a request served natively, or return None as soon as it
+    grows beyond ``limit`` bytes.
+    """
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if len(body) > limit:
+            return None
+        if not message.get('more_body'):
+            break
+    return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await storage.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+
+    loop = asyncio.get_running_loop()
+    endpoint, steps, args = match_route(scope['method'], scope['path'])
+    if endpoint is None:
+        environ = build_environ(scope, io.BufferedReader(ReceiveStream(receive, loop)))
+        return await run_in_thread(call_wsgi, environ, send, loop)
+
+    body = await read_body(receive, app.config['MAX_CONTENT_LENGTH'])
+    if body is None:
+        environ = build_environ(scope, io.BytesIO(), 0)
+        response = abort_response(413, environ)
+        status, headers, body = response.status_code, list(response.headers.items()), response.get_data()
+    else:
+        environ = build_environ(scope, io.BytesIO(body), len(body))
+        try:
+            status, headers, body = await dispatch(endpoint, steps, args, environ)
+        except ServedByFlask:
+            return await run_in_thread(call_wsgi, environ, send, loop)
+
+    await send(response_start(status, headers))
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,155 @@
+"""
+Fingerprinting, pre-compression and caching of the bundled static assets.
+
+Asset URLs carry a ``v`` query parameter holding a hash of the file's
+content, so browsers may cache them forever: a changed file gets a new URL.
+Running ``python -m snappass.assets`` ahead of deployment writes the hashes
+to a manifest and stores gzip (and, when the `brotli` package is installed,
+brotli) compressed copies next to each compressible asset, which are then
+served to clients that accept them. Without the build step, hashes are
+computed on first use and assets are served uncompressed.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+MANIFEST = 'manifest.json'
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.eot', '.otf', '.ttf')
+# (Accept-Encoding token, file suffix), by order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+ONE_YEAR = 365 * 24 * 3600
+
+_fingerprints = {}
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def iter_assets(static_folder):
+    """
+    Yield the path, relative to the static folder, of every original asset.
+    """
+    for root, dirs, files in os.walk(static_folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(tuple(suffix for encoding, suffix in ENCODINGS)):
+                continue
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            if path == MANIFEST:
+                continue
+            yield path.replace(os.sep, '/')
+
+
+def fingerprints(static_folder):
+    """
+    Return the content hash of every asset, from the manifest if the build
+    step ran, computing them otherwise.
+    """
+    if static_folder not in _fingerprints:
+        manifest = os.path.join(static_folder, MANIFEST)
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                _fingerprints[static_folder] = json.load(f)
+        else:
+            _fingerprints[static_folder] = {
+                path: file_hash(os.path.join(static_folder, path)) for path in iter_assets(static_folder)
+            }
+    return _fingerprints[static_folder]
+
+
+def static_url(path):
+    """
+    Jinja helper returning the cache-busting URL of a static asset.
+    """
+    url = '%s/%s' % (current_app.config['STATIC_URL'], path)
+    fingerprint = fingerprints(current_app.static_folder).get(path)
+    if fingerprint:
+        url += '?v=' + fingerprint
+    return url
+
+
+def send_static(filename):
+    """
+    Serve a static asset, pre-compressed when possible, with long-lived
+    cache headers when requested through its fingerprinted URL.
+    """
+    static_folder = current_app.static_folder
+    path = safe_join(static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    for encoding, suffix in ENCODINGS:
+        # Encodings refused with q=0 are listed too.
+        if request.accept_encodings[encoding] > 0 and os.path.isfile(path + suffix):
+            response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_from_directory(static_folder, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+
+    version = request.args.get('v')
+    if version and version == fingerprints(static_folder).get(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+        response.expires = None
+    return response
+
+
+def build(static_folder, out=sys.stdout):
+    """
+    Write the fingerprint manifest and the compressed copies of the assets.
+    """
+    manifest = {}
+    for path in iter_assets(static_folder):
+        full_path = os.path.join(static_folder, path)
+        manifest[path] = file_hash(full_path)
+        if not path.endswith(COMPRESSIBLE_EXTENSIONS):
+            continue
+        with open(full_path, 'rb') as f:
+            content = f.read()
+        compressed = {'.gz': gzip.compress(content, 9, mtime=0)}
+        if brotli is not None:
+            compressed['.br'] = brotli.compress(content)
+        for suffix, data in compressed.items():
+            # Only keep copies that are actually worth serving.
+            if len(data) < len(content):
+                with open(full_path + suffix, 'wb') as f:
+                    f.write(data)
+                out.write('%s%s: %d -> %d bytes\n' % (path, suffix, len(content), len(data)))
+
+    with open(os.path.join(static_folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    _fingerprints.pop(static_folder, None)
+    return manifest
+
+
+def main():
+    static_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'static')
+    manifest = build(static_folder)
+    print('Fingerprinted %d assets in %s' % (len(manifest), static_folder))
+
+
+if __name__ == '__main__':
+    main()
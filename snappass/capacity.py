@@ -0,0 +1,155 @@
+"""
+Admission control against Redis memory pressure.
+
+When ``SNAPPASS_CAPACITY`` is set, a background thread samples Redis'
+``INFO memory`` and key count every ``interval`` seconds, reports them as
+metrics, and new secrets are admitted from the cached sample:
+
+- below the high watermark (a fraction of ``maxmemory``), as requested;
+- between the high and full watermarks, with their lifetime capped to
+  ``pressure_ttl``, so that memory is given back sooner;
+- beyond the full watermark, not at all: they are refused with a 507
+  rather than stored only to be evicted unread.
+
+Without a ``maxmemory`` limit, usage is unknown and every secret is
+admitted. Should Redis itself refuse a write for lack of memory, the
+request is answered with a 503.
+"""
+import sys
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+
+from snappass.settings import to_bool
+
+ACCEPTED = 'accepted'
+SHORTENED = 'shortened'
+REJECTED = 'rejected'
+
+
+class InsufficientCapacity(HTTPException):
+    """
+    Raised when a secret can't be stored for lack of memory, and retrying
+    later may succeed.
+    """
+    code = 507
+    description = 'There is no room left to store this secret, please retry later.'
+
+    def __init__(self, retry_after, code=None):
+        super().__init__()
+        self.retry_after = retry_after
+        if code is not None:
+            self.code = code
+
+
+def is_out_of_memory(error):
+    # Past maxmemory, Redis answers writes with an OOM error under the noeviction policy.
+    redis_exceptions = sys.modules.get('redis.exceptions')
+    return redis_exceptions is not None and isinstance(error, redis_exceptions.ResponseError) and \
+        str(error).startswith('OOM ')
+
+
+class NullCapacity:
+    """
+    Stand-in used when admission control is disabled: every secret is
+    admitted as requested.
+    """
+    enabled = False
+    interval = 5.0
+
+    def admit(self):
+        return ACCEPTED
+
+    def ttl(self, ttl):
+        return ttl
+
+
+class CapacityMonitor(NullCapacity):
+    enabled = True
+
+    def __init__(self, client, metrics, interval=5.0, high_watermark=0.8, full_watermark=0.95,
+                 pressure_ttl=3600):
+        self.client = client
+        self.metrics = metrics
+        self.interval = interval
+        self.high_watermark = high_watermark
+        self.full_watermark = full_watermark
+        self.pressure_ttl = pressure_ttl
+        self._status = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """
+        Sample Redis memory usage now, cache and return it.
+        """
+        status = {'sampled_at': time.time(), 'usage': None}
+        try:
+            info = self.client.info('memory')
+            status['keys'] = self.client.dbsize()
+        except Exception as e:
+            print('Failed to sample Redis memory usage: %s' % e)
+        else:
+            status['used_memory'] = int(info.get('used_memory', 0))
+            status['maxmemory'] = int(info.get('maxmemory', 0))
+            if status['maxmemory']:
+                status['usage'] = status['used_memory'] / status['maxmemory']
+            self.metrics.observe_capacity(status)
+        self._status = status
+        return status
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def _ensure_sampling(self):
+        # Started lazily, so that each forked worker gets its own thread.
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refresh, name='snappass-capacity', daemon=True)
+                self._thread.start()
+
+    def usage(self):
+        """
+        Return the last sampled fraction of ``maxmemory`` in use, or None if
+        unknown or stale.
+        """
+        self._ensure_sampling()
+        status = self._status
+        if status is None:
+            status = self.sample()
+        if time.time() - status['sampled_at'] > 3 * self.interval:
+            return None
+        return status['usage']
+
+    def admit(self):
+        """
+        Decide whether a new secret may be stored, and for how long.
+        """
+        usage = self.usage()
+        if usage is None or usage < self.high_watermark:
+            return ACCEPTED
+        if usage < self.full_watermark:
+            return SHORTENED
+        return REJECTED
+
+    def ttl(self, ttl):
+        """
+        Return the lifetime a new secret gets, capped under memory pressure.
+        """
+        if self.admit() == SHORTENED:
+            return min(ttl, self.pressure_ttl)
+        return ttl
+
+
+def create_capacity(client, metrics, environ):
+    if client is None or not to_bool(environ.get('SNAPPASS_CAPACITY', 'False')):
+        return NullCapacity()
+    return CapacityMonitor(
+        client, metrics,
+        interval=float(environ.get('SNAPPASS_CAPACITY_INTERVAL', 5)),
+        high_watermark=float(environ.get('SNAPPASS_CAPACITY_HIGH_WATERMARK', 0.8)),
+        full_watermark=float(environ.get('SNAPPASS_CAPACITY_FULL_WATERMARK', 0.95)),
+        pressure_ttl=int(environ.get('SNAPPASS_CAPACITY_PRESSURE_TTL', 3600)))
@@ -0,0 +1,255 @@
+"""
+Fernet encryption helpers, optionally run on a bounded executor.
+
+Encrypting and decrypting large secrets is CPU bound. A
+:class:`CryptoExecutor` moves that work to a thread or process pool once a
+payload crosses a size threshold, and refuses new work with a 503 once too
+many jobs are already queued, rather than letting requests pile up.
+
+Encrypted secrets are stored as a one byte format marker followed by the raw
+Fernet token, rather than the base64 encoding Fernet hands out, which saves a
+quarter of the space. Secrets above a size threshold are also compressed
+with zlib before being encrypted. Values stored in the former format, plain
+base64 Fernet tokens, are still decrypted.
+
+With :class:`MasterKeys` configured, secrets are envelope encrypted instead:
+each gets a compact random key, handed out in its token, from which its
+Fernet key is derived with the current server master key. The stored value
+records the id of that master key, so master keys can be rotated while
+older secrets remain readable.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from snappass.storage import run_in_thread
+
+# Format markers. Base64 Fernet tokens always start with 'g' instead.
+RAW = b'\x01'
+RAW_ZLIB = b'\x02'
+FORMATS = (RAW, RAW_ZLIB)
+# Envelope encrypted values: the marker, the master key id (length
+# prefixed), then a value in one of the formats above.
+ENVELOPE = b'\x03'
+
+# Size of the per-secret keys of envelope encryption, in bytes
+SECRET_KEY_SIZE = 16
+MASTER_KEY_ID = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+class CryptoBusy(ServiceUnavailable):
+    description = 'Too many secrets are being processed right now, please retry shortly.'
+
+
+def pack(token, marker=RAW):
+    """
+    Turn a base64 Fernet token into its stored form.
+    """
+    return marker + base64.urlsafe_b64decode(token)
+
+
+def unpack(data):
+    """
+    Return the format marker and the base64 Fernet token of a stored value.
+    """
+    marker = data[:1]
+    if marker in FORMATS:
+        return marker, base64.urlsafe_b64encode(data[1:])
+    return None, data
+
+
+def is_encrypted(data):
+    """
+    Tell whether a stored value was encrypted on the server, and so can only
+    be read with its key.
+    """
+    return data[:1] in FORMATS or data[:1] == ENVELOPE
+
+
+def compress(data, compress_threshold=None):
+    """
+    Compress data of at least ``compress_threshold`` bytes when that makes it
+    smaller, returning it with its format marker.
+    """
+    if compress_threshold and len(data) >= compress_threshold:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return compressed, RAW_ZLIB
+    return data, RAW
+
+
+def encrypt_bytes(data, compress_threshold=None):
+    """
+    Encrypt data (bytes) with a freshly generated Fernet key, and return the
+    encrypted data (bytes) with the key (bytes).
+
+    Data of at least ``compress_threshold`` bytes is compressed first, when
+    that makes it smaller.
+    """
+    from cryptography.fernet import Fernet
+
+    data, marker = compress(data, compress_threshold)
+    encryption_key = Fernet.generate_key()
+    return pack(Fernet(encryption_key).encrypt(data), marker), encryption_key
+
+
+class MasterKeys:
+    """
+    Server master keys by id. The first key encrypts new secrets; the others
+    are kept to decrypt secrets encrypted before a rotation.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError('At least one master key is required')
+        for key_id, key in keys:
+            if not MASTER_KEY_ID.match(key_id):
+                raise ValueError('Invalid master key id %r' % key_id)
+            if len(key) < 32:
+                raise ValueError('Master key %r is shorter than 32 bytes' % key_id)
+        self.current_id = keys[0][0]
+        self.keys = dict(keys)
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Parse a comma separated list of ``<id>:<url-safe base64 key>``.
+        """
+        keys = []
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            key_id, sep, key = item.partition(':')
+            if not sep:
+                raise ValueError('Master keys are expected as <id>:<base64 key>, got %r' % key_id)
+            keys.append((key_id.strip(), base64.urlsafe_b64decode(key.strip())))
+        return cls(keys)
+
+    def derive(self, key_id, secret_key):
+        """
+        Return the Fernet key of a secret from its compact key.
+        """
+        try:
+            master_key = self.keys[key_id]
+        except KeyError:
+            raise ValueError('Unknown master key id %r' % key_id)
+        return base64.urlsafe_b64encode(hmac.new(master_key, secret_key, hashlib.sha256).digest())
+
+    def encrypt(self, data, compress_threshold=None):
+        """
+        Encrypt data (bytes) under the current master key, and return the
+        encrypted data (bytes) with its compact key (bytes).
+        """
+        from cryptography.fernet import Fernet
+
+        data, marker = compress(data, compress_threshold)
+        secret_key = os.urandom(SECRET_KEY_SIZE)
+        fernet = Fernet(self.derive(self.current_id, secret_key))
+        key_id = self.current_id.encode('ascii')
+        return ENVELOPE + bytes([len(key_id)]) + key_id + pack(fernet.encrypt(data), marker), secret_key
+
+
+def decrypt_bytes(data, decryption_key, master_keys=None):
+    from cryptography.fernet import Fernet
+
+    if data[:1] == ENVELOPE:
+        if master_keys is None:
+            raise ValueError('Envelope encrypted secret, but no master keys are configured')
+        end = 2 + data[1]
+        decryption_key = master_keys.derive(data[2:end].decode('ascii'), decryption_key)
+        data = data[end:]
+    marker, token = unpack(data)
+    data = Fernet(decryption_key).decrypt(token)
+    if marker == RAW_ZLIB:
+        data = zlib.decompress(data)
+    return data
+
+
+class CryptoExecutor:
+    """
+    Run crypto functions inline, or on a pool when ``kind`` is set.
+
+    Payloads smaller than ``threshold`` bytes always run inline, since handing
+    them to a pool costs more than the work itself. Larger ones never run on
+    an event loop: without a pool, :meth:`run_async` runs them on the loop's
+    default executor. At most ``max_pending``
+    jobs may be queued or running at once; past that :class:`CryptoBusy` is
+    raised. The pool is created on first use, so it is never inherited across
+    a fork.
+    """
+
+    def __init__(self, kind=None, max_workers=None, threshold=0, max_pending=None):
+        if kind is not None and kind not in EXECUTORS:
+            raise ValueError('Unknown crypto executor %r, expected one of %s'
+                             % (kind, ', '.join(sorted(EXECUTORS))))
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.threshold = threshold
+        if max_pending is None:
+            max_pending = self.max_workers * 4
+        if max_pending < 1:
+            raise ValueError('At least one crypto job must be allowed to be pending, got %r' % max_pending)
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = EXECUTORS[self.kind](max_workers=self.max_workers)
+            return self._executor
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise CryptoBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def offloads(self, size):
+        return self.kind is not None and size >= self.threshold
+
+    def run(self, fn, size, *args):
+        if not self.offloads(size):
+            return fn(*args)
+        return self._submit(fn, *args).result()
+
+    async def run_async(self, fn, size, *args):
+        if self.offloads(size):
+            return await asyncio.wrap_future(self._submit(fn, *args))
+        if size >= self.threshold:
+            return await run_in_thread(fn, *args)
+        return fn(*args)
+
+    def reset(self):
+        """
+        Forget the pool inherited from the parent process, after a fork.
+        """
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
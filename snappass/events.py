@@ -0,0 +1,270 @@
+"""
+Audit events for the lifecycle of secrets.
+
+When ``SNAPPASS_EVENTS`` is set, every secret created, previewed or revealed
+produces an event in a Redis Stream capped to about ``SNAPPASS_EVENTS_MAXLEN``
+entries. Events carry a digest of the storage key, never the secret nor its
+key. They are queued in memory and written in batches by a background
+thread, so requests never wait on the stream; when the queue is full,
+events are dropped and counted rather than slowing requests down.
+
+Secrets that lapse unread produce no request. The ``snappass-events listen``
+command turns Redis' keyspace notifications for expired keys into
+``expired`` events; run a single instance of it. ``snappass-events export``
+reads the stream in batches, as JSON lines, optionally through a consumer
+group so that each event is exported once.
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from snappass.settings import to_bool
+from snappass.sharding import parse_key
+
+EVENTS = ('created', 'previewed', 'revealed', 'expired')
+
+
+def secret_id(storage_key):
+    """
+    Identify a secret in events without disclosing its storage key.
+    """
+    return hashlib.sha256(storage_key.encode('utf-8')).hexdigest()[:16]
+
+
+def secret_kind(storage_key, prefix):
+    parsed = parse_key(prefix, storage_key)
+    return 'file' if parsed is not None and parsed.file else 'password'
+
+
+class NullEvents:
+    """
+    Stand-in used when events are disabled: every hook does nothing.
+    """
+    enabled = False
+    dropped = 0
+
+    def emit(self, event, storage_key, **fields):
+        pass
+
+    def flush(self, timeout=None):
+        pass
+
+    def reset(self):
+        pass
+
+
+class EventPublisher(NullEvents):
+    """
+    Queue events and append them to ``stream`` from a background thread,
+    up to ``batch_size`` per round trip.
+    """
+    enabled = True
+
+    def __init__(self, client, stream, prefix, maxlen=100000, queue_size=10000, batch_size=100):
+        self.client = client
+        self.stream = stream
+        self.prefix = prefix
+        self.maxlen = maxlen
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.reset()
+
+    def emit(self, event, storage_key, **fields):
+        record = {
+            'event': event,
+            'secret': secret_id(storage_key),
+            'kind': secret_kind(storage_key, self.prefix),
+            'time': str(int(time.time() * 1000)),
+        }
+        record.update((name, str(value)) for name, value in fields.items() if value is not None)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snappass-events', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.publish(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def publish(self, batch):
+        pipe = self.client.pipeline(transaction=False)
+        for record in batch:
+            pipe.xadd(self.stream, record, maxlen=self.maxlen, approximate=True)
+        try:
+            pipe.execute()
+        except Exception as e:
+            self.dropped += len(batch)
+            print('Failed to publish %d events: %s' % (len(batch), e))
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued events are written, for tests and shutdown.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            time.sleep(0.005)
+
+    def reset(self):
+        """
+        Forget the queue and thread inherited from the parent process, after
+        a fork.
+        """
+        self.dropped = 0
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+
+def create_events(client_factory, stream, prefix, environ=None):
+    environ = os.environ if environ is None else environ
+    if not to_bool(environ.get('SNAPPASS_EVENTS', 'False')):
+        return NullEvents()
+    return EventPublisher(client_factory(), environ.get('SNAPPASS_EVENTS_STREAM') or stream, prefix,
+                          maxlen=int(environ.get('SNAPPASS_EVENTS_MAXLEN', 100000)))
+
+
+def expired_key(key, prefix):
+    """
+    Return the storage key of a secret named by an expiry notification, or
+    None for other keys (file chunks, rate limits, other applications).
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', 'replace')
+    if not key.startswith(prefix) or ':' in key[len(prefix):]:
+        return None
+    return key
+
+
+def listen_expiries(client, events, prefix, db=0, configure=False):
+    """
+    Emit an ``expired`` event for every secret Redis expires, until
+    interrupted.
+
+    Expired key notifications must be enabled (``notify-keyspace-events``
+    including ``Ex``); ``configure`` enables them.
+    """
+    if configure:
+        flags = client.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        flags = flags.decode('ascii') if isinstance(flags, bytes) else flags
+        client.config_set('notify-keyspace-events', ''.join(sorted(set(flags) | {'E', 'x'})))
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('__keyevent@%d__:expired' % db)
+    for message in pubsub.listen():
+        storage_key = expired_key(message['data'], prefix)
+        if storage_key is not None:
+            events.emit('expired', storage_key)
+
+
+def export_events(client, stream, out, since='0-0', batch_size=100, follow=False, group=None,
+                  consumer='export', block=5000):
+    """
+    Write the events of ``stream`` to ``out`` as JSON lines, reading
+    ``batch_size`` at a time, and return how many were written.
+
+    Without ``group``, events after the ``since`` id are read, until the
+    end of the stream unless ``follow``. With ``group``, the consumer group
+    tracks what was exported and each batch is acknowledged once written.
+    """
+    if group is not None:
+        try:
+            client.xgroup_create(stream, group, id=since, mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+    last_id = since
+    count = 0
+    while True:
+        if group is None:
+            response = client.xread({stream: last_id}, count=batch_size, block=block if follow else None)
+        else:
+            response = client.xreadgroup(group, consumer, {stream: '>'}, count=batch_size,
+                                         block=block if follow else None)
+        entries = response[0][1] if response else []
+        if not entries:
+            if follow:
+                continue
+            return count
+        for entry_id, fields in entries:
+            record = {'id': _text(entry_id)}
+            record.update((_text(name), _text(value)) for name, value in fields.items())
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            last_id = entry_id
+        out.flush()
+        if group is not None:
+            client.xack(stream, group, *[entry_id for entry_id, fields in entries])
+        count += len(entries)
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='snappass-events', description='SnapPass audit events.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    listen = commands.add_parser('listen', help='turn expiry notifications into expired events')
+    listen.add_argument('--configure', action='store_true',
+                        help='enable expired key notifications on the Redis server')
+
+    export = commands.add_parser('export', help='write events as JSON lines')
+    export.add_argument('--since', default='0-0', help='export events after this stream id (default: all)')
+    export.add_argument('--batch-size', type=int, default=100, help='events read per round trip')
+    export.add_argument('--follow', action='store_true', help='keep waiting for new events')
+    export.add_argument('--group', help='consumer group remembering what was exported')
+    export.add_argument('--consumer', default='export', help='consumer name within the group')
+    return parser.parse_args(argv)
+
+
+def main(argv=None, out=sys.stdout, environ=None):
+    from snappass.redis_config import create_redis_client
+
+    args = parse_args(argv)
+    environ = os.environ if environ is None else environ
+    prefix = environ.get('REDIS_PREFIX', 'snappass')
+    stream = environ.get('SNAPPASS_EVENTS_STREAM') or prefix + 'events'
+    client = create_redis_client(environ=environ)
+    if args.command == 'listen':
+        events = EventPublisher(client, stream, prefix, maxlen=int(environ.get('SNAPPASS_EVENTS_MAXLEN', 100000)))
+        pool = getattr(client, 'connection_pool', None)
+        db = int(pool.connection_kwargs.get('db', 0)) if pool is not None else 0
+        try:
+            listen_expiries(client, events, prefix, db, args.configure)
+        except KeyboardInterrupt:
+            events.flush(timeout=5)
+    else:
+        try:
+            export_events(client, stream, out, args.since, args.batch_size, args.follow, args.group, args.consumer)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Large secrets and file attachments, stored as encrypted chunks.
+
+A file is read from the upload stream ``chunk_size`` bytes at a time. Each
+chunk is encrypted on its own with Fernet (so it is authenticated) and
+stored under ``<storage key>:<index>``. Each chunk's plaintext starts with
+its index and a last-chunk flag, so chunks can be neither reordered nor
+dropped. A header holding the encrypted file name, type and chunk count is
+written last under the storage key itself, so a file only becomes visible
+once it is complete. Revealing a file consumes the header first and
+streams the chunks back one by one, so memory use stays bounded by the
+chunk size whatever the file size.
+"""
+import json
+import struct
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from snappass.crypto import pack, unpack
+
+CHUNK_HEADER = struct.Struct('>I?')
+# Chunks written to storage per round trip.
+CHUNKS_PER_WRITE = 8
+
+
+class FileTooLarge(RequestEntityTooLarge):
+    pass
+
+
+class CorruptFile(Exception):
+    pass
+
+
+def chunk_key(storage_key, index):
+    return '%s:%d' % (storage_key, index)
+
+
+def read_chunks(stream, chunk_size):
+    """
+    Yield (chunk, is_last) pairs from a binary stream, holding at most two
+    chunks in memory.
+    """
+    chunk = stream.read(chunk_size)
+    while True:
+        following = stream.read(chunk_size)
+        yield chunk, not following
+        if not following:
+            return
+        chunk = following
+
+
+def store_file(storage, storage_key, stream, ttl, filename, content_type, chunk_size, max_size):
+    """
+    Encrypt and store a file read from ``stream``, returning its encryption
+    key (bytes).
+
+    Raises :class:`FileTooLarge` once more than ``max_size`` bytes have been
+    read; the chunks stored so far are deleted.
+    """
+    from cryptography.fernet import Fernet
+
+    encryption_key = Fernet.generate_key()
+    fernet = Fernet(encryption_key)
+    size = 0
+    count = 0
+    pending = []
+    try:
+        for chunk, last in read_chunks(stream, chunk_size):
+            size += len(chunk)
+            if size > max_size:
+                raise FileTooLarge('Files are limited to %d bytes.' % max_size)
+            plaintext = CHUNK_HEADER.pack(count, last) + chunk
+            pending.append((chunk_key(storage_key, count), ttl, pack(fernet.encrypt(plaintext))))
+            count += 1
+            if len(pending) == CHUNKS_PER_WRITE:
+                storage.set_many(pending)
+                pending = []
+        if pending:
+            storage.set_many(pending)
+    except FileTooLarge:
+        for index in range(count - len(pending)):
+            storage.getdel(chunk_key(storage_key, index))
+        raise
+
+    header = {
+        'filename': filename,
+        'content_type': content_type,
+        'size': size,
+        'chunks': count,
+    }
+    storage.set(storage_key, ttl, pack(fernet.encrypt(json.dumps(header).encode('utf-8'))))
+    return encryption_key
+
+
+def open_file(storage, storage_key, decryption_key):
+    """
+    Consume a stored file. Returns its header (dict) and an iterator over
+    its decrypted content, or (None, None) if it doesn't exist.
+    """
+    from cryptography.fernet import Fernet, InvalidToken
+
+    encrypted_header = storage.getdel(storage_key)
+    if encrypted_header is None:
+        return None, None
+    fernet = Fernet(decryption_key)
+    try:
+        header = json.loads(fernet.decrypt(unpack(encrypted_header)[1]))
+    except InvalidToken:
+        raise CorruptFile('The file header could not be decrypted')
+
+    def content():
+        for index in range(header['chunks']):
+            encrypted_chunk = storage.getdel(chunk_key(storage_key, index))
+            if encrypted_chunk is None:
+                raise CorruptFile('Chunk %d of %s is missing' % (index, storage_key))
+            try:
+                plaintext = fernet.decrypt(unpack(encrypted_chunk)[1])
+            except InvalidToken:
+                raise CorruptFile('Chunk %d of %s could not be decrypted' % (index, storage_key))
+            chunk_index, last = CHUNK_HEADER.unpack_from(plaintext)
+            if chunk_index != index or last != (index == header['chunks'] - 1):
+                raise CorruptFile('Chunk %d of %s is out of place' % (index, storage_key))
+            yield plaintext[CHUNK_HEADER.size:]
+
+    return header, content()
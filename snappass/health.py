@@ -0,0 +1,80 @@
+"""
+Liveness and readiness probes.
+
+Liveness only tells that the process answers requests. Readiness tells that
+it can also serve secrets: storage answers a ping within the latency budget
+and the Redis connection pool isn't saturated. Storage is checked by a
+background thread every ``interval`` seconds, so probes are answered from
+the cached result and never add load to Redis themselves.
+"""
+import threading
+import time
+
+from snappass.metrics import pool_usage
+
+
+class ReadinessProbe:
+
+    def __init__(self, ping, redis_client=None, interval=5.0, latency_budget=0.25, max_pool_usage=0.9):
+        self.ping = ping
+        self.redis_client = redis_client
+        self.interval = interval
+        self.latency_budget = latency_budget
+        self.max_pool_usage = max_pool_usage
+        self._status = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        Check storage now, cache and return the result.
+        """
+        status = {'ready': True, 'checked_at': time.time()}
+        start = time.perf_counter()
+        try:
+            self.ping()
+        except Exception as e:
+            status.update(ready=False, reason='Storage is unreachable: %s' % e)
+        latency = time.perf_counter() - start
+        status['latency_ms'] = round(latency * 1000, 3)
+        if status['ready'] and latency > self.latency_budget:
+            status.update(ready=False, reason='Storage answered in %.0fms, over the %.0fms budget'
+                          % (latency * 1000, self.latency_budget * 1000))
+
+        usage = pool_usage(self.redis_client) if self.redis_client is not None else None
+        max_connections = getattr(getattr(self.redis_client, 'connection_pool', None), 'max_connections', None)
+        if usage is not None and max_connections:
+            status['pool_usage'] = round(usage[0] / max_connections, 3)
+            if status['ready'] and status['pool_usage'] >= self.max_pool_usage:
+                status.update(ready=False, reason='%d of %d Redis connections are in use'
+                              % (usage[0], max_connections))
+
+        self._status = status
+        return status
+
+    def _refresh(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def _ensure_refreshing(self):
+        # Started lazily, so that each forked worker gets its own thread.
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refresh, name='snappass-readiness', daemon=True)
+                self._thread.start()
+
+    def status(self):
+        """
+        Return the cached readiness, never waiting on storage except for the
+        very first check of the process.
+        """
+        self._ensure_refreshing()
+        status = self._status
+        if status is None:
+            status = self.check()
+        elif time.time() - status['checked_at'] > 3 * self.interval:
+            # The refresh thread is stuck, most likely waiting on storage.
+            status = dict(status, ready=False, reason='Storage has not answered for %.0fs'
+                          % (time.time() - status['checked_at']))
+        return status
@@ -1,31 +1,101 @@
+import math
 import os
+import re
 import sys
+import threading
+import time
 import uuid
+from collections import namedtuple
 
-import redis
-
-from cryptography.fernet import Fernet
-from flask import abort, Flask, render_template, request, jsonify, make_response
-from redis.exceptions import ConnectionError
+from flask import abort, current_app, Flask, g, has_app_context, has_request_context, render_template, request, \
+    jsonify, make_response, url_for, Response
 from urllib.parse import quote_plus
 from urllib.parse import unquote_plus
 from urllib.parse import urljoin
-from distutils.util import strtobool
 # _ is required to get the Jinja templates translated
 from flask_babel import Babel, _  # noqa: F401
-
-NO_SSL = bool(strtobool(os.environ.get('NO_SSL', 'False')))
-URL_PREFIX = os.environ.get('URL_PREFIX', None)
-HOST_OVERRIDE = os.environ.get('HOST_OVERRIDE', None)
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from snappass.assets import send_static, static_url
+from snappass.capacity import REJECTED, InsufficientCapacity, is_out_of_memory
+from snappass.crypto import decrypt_bytes, encrypt_bytes, is_encrypted
+from snappass.events import secret_id
+from snappass.files import FileTooLarge, open_file, store_file
+from snappass.server import serve
+from snappass.services import Services
+from snappass.settings import environ as settings_environ, to_bool
+from snappass.sharding import ShardedStorage, build_key, parse_key, parse_tenant_shards, parse_tenants
+from snappass.storage import MemoryStorage
+from snappass.tokens import decode_token, encode_token
+
+# Legacy tokens, still accepted: the storage key, then the base64 Fernet
+# key of the secret if not encrypted in the browser
 TOKEN_SEPARATOR = '~'
+FERNET_KEY = re.compile(r'^[A-Za-z0-9_-]{43}=$')
+# Storage keys from before REDIS_PREFIX
+UNPREFIXED_KEY = re.compile(r'^[0-9a-f]{32}$')
+
+# Secrets encrypted in the browser: AES-GCM IV, ciphertext and tag in
+# unpadded url-safe base64.
+CLIENT_CIPHERTEXT = re.compile(r'^[A-Za-z0-9_-]{38,}$')
+
+# Previewing a secret in the browser hands out a signed nonce, in a cookie
+# named after the secret, recording how many views it had left.
+REVEAL_NONCE_COOKIE = 'snappass_reveal_'
+
+TIME_CONVERSION = {'two weeks': 1209600, 'week': 604800, 'day': 86400,
+                   'hour': 3600}
+DEFAULT_API_TTL = 1209600
+MAX_TTL = DEFAULT_API_TTL
+# Room for the multipart framing and fields around an uploaded file
+MULTIPART_HEADROOM = 64 * 1024
+
+# Routes creating secrets, limited by SNAPPASS_RATE_LIMIT and SNAPPASS_CAPACITY
+RATE_LIMITED_ENDPOINTS = ('handle_password', 'api_handle_password', 'api_v2_set_password',
+                          'api_v2_set_passwords', 'api_v2_set_file')
+
+# Settings used by the views, parsed into the application config
+SETTINGS = {
+    'NO_SSL': (to_bool, False),
+    'URL_PREFIX': (str, None),
+    'HOST_OVERRIDE': (str, None),
+    'STATIC_URL': (str, 'static'),
+    'SECRET_KEY': (str, 'Secret Key'),
+    'REDIS_PREFIX': (str, 'snappass'),
+    'SNAPPASS_MAX_BATCH_SIZE': (int, 1000),
+    # API keys whose secrets live under their tenant's own prefix, and tenants pinned to a shard
+    'SNAPPASS_TENANTS': (parse_tenants, {}),
+    'SNAPPASS_TENANT_SHARDS': (parse_tenant_shards, {}),
+    # Let the web form encrypt secrets in the browser, the key never reaching the server
+    'SNAPPASS_CLIENT_ENCRYPTION': (to_bool, False),
+    # How many times a single secret may be viewed at most
+    'SNAPPASS_MAX_VIEWS': (int, 10),
+    # How long after its preview a secret can be revealed with a single GETDEL
+    'SNAPPASS_REVEAL_NONCE_TTL': (int, 300),
+    # Secrets of at least this many bytes are compressed before encryption, 0 disables
+    'SNAPPASS_COMPRESS_THRESHOLD': (int, 1024),
+    # Files are stored in encrypted chunks under keys of their own
+    'SNAPPASS_FILE_CHUNK_SIZE': (int, 65536),
+    'SNAPPASS_MAX_FILE_SIZE': (int, 10 * 1024 * 1024),
+    # How many reverse proxies in front set X-Forwarded-For and X-Forwarded-Proto
+    'SNAPPASS_PROXY_COUNT': (int, 0),
+}
+
+_routes = []
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def route(rule, methods):
+    """
+    Register a view on every application created by :func:`create_app`.
+    """
+    def decorator(view):
+        _routes.append((rule, view, methods))
+        return view
 
-# Initialize Flask Application
-app = Flask(__name__)
-if os.environ.get('DEBUG'):
-    app.debug = True
-app.secret_key = os.environ.get('SECRET_KEY', 'Secret Key')
-app.config.update(
-    dict(STATIC_URL=os.environ.get('STATIC_URL', 'static')))
+    return decorator
 
 
 # Set up Babel
@@ -33,37 +103,117 @@ def get_locale():
     return request.accept_languages.best_match(['en', 'es', 'de', 'nl', 'fr'])
 
 
-babel = Babel(app, locale_selector=get_locale)
+def create_app(config=None):
+    """
+    Create a SnapPass application.
 
-# Initialize Redis
-if os.environ.get('MOCK_REDIS'):
-    from fakeredis import FakeStrictRedis
+    ``config`` maps settings, named after their environment variable, to
+    their value; settings it leaves out are read from the environment.
+    Redis clients and other backends are only built when first used.
+    """
+    environ = settings_environ(config)
+
+    # Initialize Flask Application
+    app = Flask(__name__)
+    if environ.get('DEBUG'):
+        app.debug = True
+    for name, (parse, default) in SETTINGS.items():
+        value = environ.get(name)
+        app.config[name] = default if value is None else parse(value)
+    # Refuse larger bodies before they are read, rather than once spooled
+    app.config['MAX_CONTENT_LENGTH'] = app.config['SNAPPASS_MAX_FILE_SIZE'] + MULTIPART_HEADROOM
+    app.extensions['snappass'] = Services(app.config, environ, RATE_LIMITED_ENDPOINTS)
+    if app.config['SNAPPASS_PROXY_COUNT']:
+        app.wsgi_app = trust_proxies(app.wsgi_app, app.config['SNAPPASS_PROXY_COUNT'])
+
+    Babel(app, locale_selector=get_locale)
+
+    # Serve static assets pre-compressed and cacheable through fingerprinted URLs
+    app.jinja_env.globals['static_url'] = static_url
+    app.view_functions['static'] = send_static
+
+    app.before_request(start_request_timer)
+    app.before_request(enforce_rate_limit)
+    app.before_request(enforce_capacity)
+    app.register_error_handler(InsufficientCapacity, handle_insufficient_capacity)
+    app.after_request(record_request_metrics)
+    for rule, view, methods in _routes:
+        app.add_url_rule(rule, view_func=view, methods=methods)
+    return app
+
+
+def trust_proxies(wsgi_app, count):
+    """
+    Wrap a WSGI application to take the client's address and scheme from the
+    headers set by the ``count`` reverse proxies in front of it.
+    """
+    return ProxyFix(wsgi_app, x_for=count, x_proto=count)
 
-    redis_client = FakeStrictRedis()
-elif os.environ.get('REDIS_URL'):
-    redis_client = redis.StrictRedis.from_url(os.environ.get('REDIS_URL'))
-else:
-    redis_host = os.environ.get('REDIS_HOST', 'localhost')
-    redis_port = os.environ.get('REDIS_PORT', 6379)
-    redis_db = os.environ.get('SNAPPASS_REDIS_DB', 0)
-    redis_client = redis.StrictRedis(
-        host=redis_host, port=redis_port, db=redis_db)
-REDIS_PREFIX = os.environ.get('REDIS_PREFIX', 'snappass')
 
-TIME_CONVERSION = {'two weeks': 1209600, 'week': 604800, 'day': 86400,
-                   'hour': 3600}
-DEFAULT_API_TTL = 1209600
-MAX_TTL = DEFAULT_API_TTL
+def default_app():
+    """
+    Return the application configured by the environment alone, created on
+    first use.
+    """
+    global _default_app
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+    return _default_app
+
+
+def current_services():
+    """
+    Return the backends of the application handling the current request, or
+    of the default application outside of requests.
+    """
+    app = current_app if has_app_context() else default_app()
+    return app.extensions['snappass']
+
+
+def __getattr__(name):
+    # The default application and its backends used to be built on import,
+    # and are still reachable as module attributes (e.g. snappass.main:app).
+    if name == 'app':
+        return default_app()
+    if name in ('redis_client', 'storage', 'metrics', 'readiness', 'crypto_executor', 'rate_limiter'):
+        return getattr(default_app().extensions['snappass'], name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def render_page(template_name, **context):
+    """
+    Render a template whose context takes few distinct values, reusing the
+    rendered page for the requested locale and context.
+    """
+    if current_app.debug:
+        return render_template(template_name, **context)
+    page_cache = current_services().page_cache
+    key = (template_name, get_locale()) + tuple(sorted(context.items()))
+    page = page_cache.get(key)
+    if page is None:
+        page = page_cache[key] = render_template(template_name, **context)
+    return page
+
+
+def is_connection_error(error):
+    # redis-py can only have raised it if storage imported it.
+    redis_exceptions = sys.modules.get('redis.exceptions')
+    return redis_exceptions is not None and isinstance(error, redis_exceptions.ConnectionError)
 
 
 def check_redis_alive(fn):
     def inner(*args, **kwargs):
         try:
             if fn.__name__ == 'main':
-                redis_client.ping()
+                current_services().storage.ping()
             return fn(*args, **kwargs)
-        except ConnectionError as e:
-            print('Failed to connect to redis! %s' % e.message)
+        except Exception as e:
+            if is_out_of_memory(e):
+                raise InsufficientCapacity(current_services().capacity.interval, 503) from e
+            if not is_connection_error(e):
+                raise
+            print('Failed to connect to redis! %s' % e)
             if fn.__name__ == 'main':
                 sys.exit(0)
             else:
@@ -72,15 +222,54 @@ def check_redis_alive(fn):
     return inner
 
 
+# Operations and views are written as steps: generators yielding the storage
+# and crypto calls they wait on, and returning their result. run_steps makes
+# each call in turn; the ASGI entry point awaits them on its event loop.
+StorageCall = namedtuple('StorageCall', 'command args')
+CryptoCall = namedtuple('CryptoCall', 'operation func size args')
+
+
+@check_redis_alive
+def run_steps(steps):
+    """
+    Run the steps of an operation or view, blocking on each of their calls,
+    and return their result.
+    """
+    services = current_services()
+    send, value = steps.send, None
+    while True:
+        try:
+            call = send(value)
+        except StopIteration as e:
+            return e.value
+        try:
+            if isinstance(call, StorageCall):
+                with services.metrics.storage_timer(call.command):
+                    value = getattr(services.storage, call.command)(*call.args)
+            else:
+                with services.metrics.crypto_timer(call.operation):
+                    value = services.crypto_executor.run(call.func, call.size, *call.args)
+        except Exception as e:
+            send, value = steps.throw, e
+        else:
+            send = steps.send
+
+
 def encrypt(password):
     """
     Take a password string, encrypt it with Fernet symmetric encryption,
     and return the result (bytes), with the decryption key (bytes)
     """
-    encryption_key = Fernet.generate_key()
-    fernet = Fernet(encryption_key)
-    encrypted_password = fernet.encrypt(password.encode('utf-8'))
-    return encrypted_password, encryption_key
+    return run_steps(encrypt_steps(password))
+
+
+def encrypt_steps(password):
+    services = current_services()
+    data = password.encode('utf-8')
+    # Envelope encryption under the server master keys, when configured
+    encrypt_fn = encrypt_bytes if services.master_keys is None else services.master_keys.encrypt
+    return (yield CryptoCall('encrypt', encrypt_fn, len(data),
+                             (data, services.config['SNAPPASS_COMPRESS_THRESHOLD'])))
 
 
 def decrypt(password, decryption_key):
@@ -88,20 +277,98 @@ def decrypt(password, decryption_key):
     Decrypt a password (bytes) using the provided key (bytes),
     and return the plain-text password (bytes).
     """
-    fernet = Fernet(decryption_key)
-    return fernet.decrypt(password)
+    return run_steps(decrypt_steps(password, decryption_key))
 
 
-def parse_token(token):
-    token_fragments = token.split(TOKEN_SEPARATOR, 1)  # Split once, not more.
-    storage_key = token_fragments[0]
+def decrypt_steps(password, decryption_key):
+    return (yield CryptoCall('decrypt', decrypt_bytes, len(password),
+                             (password, decryption_key, current_services().master_keys)))
 
-    try:
-        decryption_key = token_fragments[1].encode('utf-8')
-    except IndexError:
-        decryption_key = None
 
-    return storage_key, decryption_key
+def current_tenant():
+    """
+    Return the tenant of the API key the request carries, if any.
+    """
+    if not has_request_context():
+        return None
+    return current_services().config['SNAPPASS_TENANTS'].get(request.headers.get('X-API-Key'))
+
+
+def new_storage_key(file=False):
+    """
+    Return a new storage key, under the requesting tenant's prefix and, with
+    sharding, naming the shard holding it.
+    """
+    services = current_services()
+    uuid_hex = uuid.uuid4().hex
+    tenant = current_tenant()
+    storage = services.storage
+    shard = storage.choose_shard(tenant, uuid_hex) if isinstance(storage, ShardedStorage) else None
+    return build_key(services.config['REDIS_PREFIX'], uuid_hex, tenant, shard, file)
+
+
+def is_file_key(storage_key):
+    if storage_key is None:
+        return False
+    parsed = parse_key(current_services().config['REDIS_PREFIX'], storage_key)
+    return parsed is not None and parsed.file
+
+
+def known_missing(storage_key):
+    """
+    Return whether the storage key is known to be gone, from the negative
+    cache, sparing a storage lookup.
+    """
+    services = current_services()
+    if not services.negative_cache.enabled:
+        return False
+    missing = storage_key in services.negative_cache
+    services.metrics.observe_negative_cache('hit' if missing else 'miss')
+    return missing
+
+
+def make_token(storage_key, encryption_key):
+    """
+    Build the token handed out to users from the storage key (str) and the
+    encryption key (bytes, None for passwords encrypted in the browser).
+    """
+    config = current_services().config
+    return encode_token(config['SECRET_KEY'], parse_key(config['REDIS_PREFIX'], storage_key), encryption_key)
+
+
+def parse_token(token):
+    """
+    Return the storage key and decryption key (or None) of a token, or
+    (None, None) if it is malformed or forged, without querying storage.
+
+    Tokens are checked against their tag; legacy tokens, which have none,
+    must at least hold a well-formed storage key.
+    """
+    config = current_services().config
+    prefix = config['REDIS_PREFIX']
+    decoded = decode_token(config['SECRET_KEY'], token)
+    if decoded is not None:
+        parsed, decryption_key = decoded
+        return build_key(prefix, parsed.uuid, parsed.tenant, parsed.shard, parsed.file), decryption_key
+
+    storage_key, separator, decryption_key = token.partition(TOKEN_SEPARATOR)
+    # Chunks of files are never handed out.
+    if (parse_key(prefix, storage_key) is None or ':' in storage_key[len(prefix):]) and \
+            not UNPREFIXED_KEY.match(storage_key):
+        return None, None
+    if not separator:
+        return storage_key, None
+    if not FERNET_KEY.match(decryption_key):
+        return None, None
+    return storage_key, decryption_key.encode('utf-8')
+
+
+def is_bare_key(token):
+    """
+    Tell whether a token is a legacy one holding a storage key alone, as
+    handed out for secrets encrypted in the browser.
+    """
+    return TOKEN_SEPARATOR not in token and decode_token(current_services().config['SECRET_KEY'], token) is None
 
 
 def as_validation_problem(request, problem_type, problem_title, invalid_params):
@@ -126,6 +393,34 @@ def as_not_found_problem(request, problem_type, problem_title, invalid_params):
     return as_problem_response(problem, 404)
 
 
+def as_rate_limited_problem(request, retry_after):
+    base_url = set_base_url(request)
+    retry_after = math.ceil(retry_after)
+
+    problem = {
+        "type": base_url + "rate-limit-exceeded",
+        "title": "Too many requests, please retry later.",
+        "retry-after": retry_after
+    }
+    response = as_problem_response(problem, 429)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def as_capacity_problem(request, error):
+    base_url = set_base_url(request)
+    retry_after = math.ceil(error.retry_after)
+
+    problem = {
+        "type": base_url + "insufficient-capacity",
+        "title": error.description,
+        "retry-after": retry_after
+    }
+    response = as_problem_response(problem, error.code)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
 def as_problem_response(problem, status_code=None):
     if not isinstance(status_code, int) or not status_code:
         status_code = 400
@@ -135,23 +430,65 @@ def as_problem_response(problem, status_code=None):
     return response
 
 
-@check_redis_alive
-def set_password(password, ttl):
+def set_password(password, ttl, views=1):
     """
-    Encrypt and store the password for the specified lifetime.
+    Encrypt and store the password for the specified lifetime, to be
+    revealed at most ``views`` times.
 
     Returns a token comprised of the key where the encrypted password
     is stored, and the decryption key.
     """
-    storage_key = REDIS_PREFIX + uuid.uuid4().hex
-    encrypted_password, encryption_key = encrypt(password)
-    redis_client.setex(storage_key, ttl, encrypted_password)
-    encryption_key = encryption_key.decode('utf-8')
-    token = TOKEN_SEPARATOR.join([storage_key, encryption_key])
-    return token
+    return run_steps(set_password_steps(password, ttl, views))
+
+
+def set_password_steps(password, ttl, views=1):
+    storage_key = new_storage_key()
+    encrypted_password, encryption_key = yield from encrypt_steps(password)
+    yield StorageCall('set', (storage_key, ttl, encrypted_password, views))
+    current_services().events.emit('created', storage_key, ttl=ttl, views=views)
+    return make_token(storage_key, encryption_key)
+
+
+def set_encrypted_password(ciphertext, ttl, views=1):
+    """
+    Store a password encrypted in the browser as is. Its key stays with the
+    browser, so the token holds none, and the password is returned as
+    stored.
+    """
+    return run_steps(set_encrypted_password_steps(ciphertext, ttl, views))
+
+
+def set_encrypted_password_steps(ciphertext, ttl, views=1):
+    storage_key = new_storage_key()
+    yield StorageCall('set', (storage_key, ttl, ciphertext.encode('ascii'), views))
+    current_services().events.emit('created', storage_key, ttl=ttl, views=views)
+    return make_token(storage_key, None)
+
+
+def set_passwords(items):
+    """
+    Encrypt and store several (password, ttl, views) triples at once (a
+    single transaction with Redis), returning their tokens in the same
+    order.
+    """
+    return run_steps(set_passwords_steps(items))
+
+
+def set_passwords_steps(items):
+    tokens = []
+    entries = []
+    for password, ttl, views in items:
+        storage_key = new_storage_key()
+        encrypted_password, encryption_key = yield from encrypt_steps(password)
+        entries.append((storage_key, ttl, encrypted_password, views))
+        tokens.append(make_token(storage_key, encryption_key))
+    yield StorageCall('set_many', (entries,))
+    services = current_services()
+    for storage_key, ttl, encrypted_password, views in entries:
+        services.events.emit('created', storage_key, ttl=ttl, views=views)
+    return tokens
 
 
-@check_redis_alive
 def get_password(token):
     """
     From a given token, return the initial password.
@@ -159,22 +496,203 @@ def get_password(token):
     If the token is tilde-separated, we decrypt the password fetched from Redis.
     If not, the password is simply returned as is.
     """
+    return take_password(token)[0]
+
+
+def take_password(token, single_view=False):
+    """
+    From a given token, consume a view of the password, returning it with
+    the views left, or (None, 0) if it doesn't exist.
+
+    Passwords known to have a ``single_view`` left are fetched and deleted
+    with a single GETDEL, skipping the views bookkeeping.
+    """
+    return run_steps(take_password_steps(token, single_view))
+
+
+def take_password_steps(token, single_view=False):
     storage_key, decryption_key = parse_token(token)
-    password = redis_client.get(storage_key)
-    redis_client.delete(storage_key)
+    if storage_key is None or is_file_key(storage_key) or known_missing(storage_key):
+        return None, 0
+    if decryption_key is None and is_bare_key(token):
+        # Secrets encrypted on the server can't be read without their key:
+        # they are left alone rather than consumed for nothing.
+        value = yield StorageCall('peek', (storage_key,))
+        if value is None or is_encrypted(value):
+            return None, 0
+    password, views_left = yield StorageCall('take_last' if single_view else 'take', (storage_key,))
+
+    services = current_services()
+    if password is None:
+        services.negative_cache.add(storage_key)
+        return None, 0
+    if not views_left:
+        services.negative_cache.burn(storage_key)
+    services.events.emit('revealed', storage_key, remaining_views=views_left)
+
+    if decryption_key is not None:
+        password = yield from decrypt_steps(password, decryption_key)
+
+    return password.decode('utf-8'), views_left
 
-    if password is not None:
 
-        if decryption_key is not None:
-            password = decrypt(password, decryption_key)
+@check_redis_alive
+def set_file(stream, ttl, filename, content_type):
+    """
+    Encrypt and store a file read from a binary stream, chunk by chunk.
 
-        return password.decode('utf-8')
+    Returns a token comprised of the key where the file is stored, and the
+    decryption key.
+    """
+    services = current_services()
+    storage_key = new_storage_key(file=True)
+    with services.metrics.crypto_timer('encrypt_file'):
+        encryption_key = store_file(services.storage, storage_key, stream, ttl, filename, content_type,
+                                    services.config['SNAPPASS_FILE_CHUNK_SIZE'],
+                                    services.config['SNAPPASS_MAX_FILE_SIZE'])
+    services.events.emit('created', storage_key, ttl=ttl, views=1)
+    return make_token(storage_key, encryption_key)
+
+
+@check_redis_alive
+def get_file(token):
+    """
+    From a given token, consume the stored file, returning its header (a dict
+    with its filename, content_type and size) and an iterator over its
+    decrypted content, or (None, None) if it doesn't exist.
+    """
+    storage_key, decryption_key = parse_token(token)
+    if not is_file_key(storage_key) or decryption_key is None or known_missing(storage_key):
+        return None, None
+    services = current_services()
+    header, content = open_file(services.storage, storage_key, decryption_key)
+    if header is None:
+        services.negative_cache.add(storage_key)
+    else:
+        services.negative_cache.burn(storage_key)
+        services.events.emit('revealed', storage_key, remaining_views=0)
+    return header, content
+
+
+def file_response(header, content):
+    response = Response(content, mimetype=header['content_type'] or 'application/octet-stream')
+    response.headers['Content-Length'] = header['size']
+    response.headers.set('Content-Disposition', 'attachment', filename=header['filename'] or 'secret')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
 @check_redis_alive
 def password_exists(token):
     storage_key, decryption_key = parse_token(token)
-    return redis_client.exists(storage_key)
+    if storage_key is None or known_missing(storage_key):
+        return False
+    services = current_services()
+    with services.metrics.storage_timer('exists'):
+        exists = services.storage.exists(storage_key)
+    if exists:
+        services.events.emit('previewed', storage_key)
+    else:
+        services.negative_cache.add(storage_key)
+    return exists
+
+
+def password_views(token):
+    """
+    Return how many more times the token's password can be viewed, 0 if it
+    doesn't exist.
+    """
+    return run_steps(password_views_steps(token))
+
+
+def password_views_steps(token):
+    storage_key, decryption_key = parse_token(token)
+    if storage_key is None or known_missing(storage_key):
+        return 0
+    views = yield StorageCall('views', (storage_key,))
+    services = current_services()
+    if views:
+        services.events.emit('previewed', storage_key, remaining_views=views)
+    else:
+        services.negative_cache.add(storage_key)
+    return views
+
+
+def reveal_nonce_serializer():
+    from itsdangerous import URLSafeTimedSerializer
+
+    return URLSafeTimedSerializer(current_services().config['SECRET_KEY'], salt='snappass-reveal')
+
+
+def reveal_nonce_cookie(token):
+    return REVEAL_NONCE_COOKIE + secret_id(parse_token(token)[0])
+
+
+def set_reveal_nonce(response, token, views):
+    """
+    Hand the browser previewing a password a nonce, signed with the
+    application's secret key, recording how many views it had left.
+    """
+    nonce = reveal_nonce_serializer().dumps([secret_id(parse_token(token)[0]), views])
+    response.set_cookie(reveal_nonce_cookie(token), nonce,
+                        max_age=current_services().config['SNAPPASS_REVEAL_NONCE_TTL'],
+                        path=request.script_root or '/', secure=request.is_secure, httponly=True,
+                        samesite='Strict')
+    return response
+
+
+def is_single_view(req, token):
+    """
+    Return whether the request carries a valid nonce from the preview of the
+    token's password, telling it had a single view left: it can then be
+    revealed with a single GETDEL, as views are never added.
+    """
+    from itsdangerous import BadSignature
+
+    services = current_services()
+    nonce = req.cookies.get(reveal_nonce_cookie(token))
+    if nonce is None:
+        services.metrics.observe_reveal_nonce('missing')
+        return False
+    try:
+        digest, views = reveal_nonce_serializer().loads(
+            nonce, max_age=services.config['SNAPPASS_REVEAL_NONCE_TTL'])
+    except (BadSignature, ValueError):
+        digest, views = None, None
+    if digest != secret_id(parse_token(token)[0]):
+        services.metrics.observe_reveal_nonce('invalid')
+        return False
+    services.metrics.observe_reveal_nonce('valid')
+    return views == 1
+
+
+def passwords_ttl(tokens):
+    """
+    Return the remaining lifetime in seconds of each token's password, or
+    None for those that don't exist (anymore or at all), in one round trip.
+    """
+    return run_steps(passwords_ttl_steps(tokens))
+
+
+def passwords_ttl_steps(tokens):
+    storage_keys = [parse_token(token)[0] for token in tokens]
+    pttls = yield StorageCall('pttl_many', ([storage_key for storage_key in storage_keys if storage_key is not None],))
+    return ttls_from_pttls(storage_keys, pttls)
+
+
+def ttls_from_pttls(storage_keys, pttls):
+    # Keys of rejected tokens, never looked up, are missing.
+    pttls = iter(pttls)
+    return [None if storage_key is None else ttl_from_pttl(next(pttls)) for storage_key in storage_keys]
+
+
+def ttl_from_pttl(pttl):
+    # PTTL answers -2 for missing keys and -1 for keys without expiry.
+    if pttl == -2:
+        return None
+    if pttl == -1:
+        return -1
+    return -(-pttl // 1000)
 
 
 def empty(value):
@@ -182,6 +700,22 @@ def empty(value):
         return True
 
 
+def clean_views(value):
+    """
+    Parse how many times a secret may be viewed, defaulting to once;
+    returns None if out of bounds.
+    """
+    if value is None or value == '':
+        return 1
+    try:
+        views = int(value)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, bool) or not 1 <= views <= current_services().config['SNAPPASS_MAX_VIEWS']:
+        return None
+    return views
+
+
 def clean_input():
     """
     Make sure we're not getting bad data from the front end,
@@ -200,51 +734,231 @@ def clean_input():
     return TIME_CONVERSION[time_period], request.form['password']
 
 
+def is_client_encrypted(form):
+    """
+    Tell whether the form's password was encrypted in the browser, checking
+    that the mode is enabled and that it looks like a ciphertext.
+    """
+    if not form.get('encrypted'):
+        return False
+    if not current_services().config['SNAPPASS_CLIENT_ENCRYPTION'] or \
+       not CLIENT_CIPHERTEXT.match(form.get('password', '')):
+        abort(400)
+    return True
+
+
 def set_base_url(req):
-    if NO_SSL:
-        if HOST_OVERRIDE:
-            base_url = f'http://{HOST_OVERRIDE}/'
+    config = current_services().config
+    host_override = config['HOST_OVERRIDE']
+    if config['NO_SSL']:
+        if host_override:
+            base_url = f'http://{host_override}/'
         else:
             base_url = req.url_root
     else:
-        if HOST_OVERRIDE:
-            base_url = f'https://{HOST_OVERRIDE}/'
+        if host_override:
+            base_url = f'https://{host_override}/'
         else:
             base_url = req.url_root.replace("http://", "https://")
-    if URL_PREFIX:
-        base_url = base_url + URL_PREFIX.strip("/") + "/"
+    if config['URL_PREFIX']:
+        base_url = base_url + config['URL_PREFIX'].strip("/") + "/"
     return base_url
 
 
-@app.route('/', methods=['GET'])
+def validate_v2_password(password, ttl, views=1):
+    invalid_params = []
+
+    if not password:
+        invalid_params.append({
+            "name": "password",
+            "reason": "The password is required and should not be null or empty."
+        })
+
+    invalid_params.extend(validate_v2_ttl(ttl))
+
+    if views is None:
+        invalid_params.append({
+            "name": "views",
+            "reason": "Between 1 and %d views are supported." % current_services().config['SNAPPASS_MAX_VIEWS']
+        })
+
+    return invalid_params
+
+
+def validate_v2_ttl(ttl):
+    if isinstance(ttl, int) and ttl <= 0:
+        return [{
+            "name": "ttl",
+            "reason": "The TTL should be a positive number of seconds."
+        }]
+    if not isinstance(ttl, int) or ttl > MAX_TTL:
+        return [{
+            "name": "ttl",
+            "reason": "The specified TTL is longer than the maximum supported."
+        }]
+    return []
+
+
+def validate_v2_batch(items):
+    """
+    Validate a batch of v2 passwords, returning the invalid params of every
+    item (named after their position) and the (password, ttl, views)
+    triples.
+    """
+    max_batch_size = current_services().config['SNAPPASS_MAX_BATCH_SIZE']
+    if not isinstance(items, list) or not items or len(items) > max_batch_size:
+        return [{
+            "name": "passwords",
+            "reason": "Between 1 and %d passwords are required." % max_batch_size
+        }], []
+
+    invalid_params = []
+    passwords = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {}
+        password = item.get('password')
+        try:
+            ttl = int(item.get('ttl', DEFAULT_API_TTL))
+        except (TypeError, ValueError):
+            # Reported as an invalid TTL
+            ttl = None
+        views = clean_views(item.get('views'))
+        for invalid_param in validate_v2_password(password, ttl, views):
+            invalid_param["name"] = "[%d].%s" % (index, invalid_param["name"])
+            invalid_params.append(invalid_param)
+        passwords.append((password, ttl, views))
+    return invalid_params, passwords
+
+
+def validate_v2_tokens(tokens):
+    max_batch_size = current_services().config['SNAPPASS_MAX_BATCH_SIZE']
+    if not isinstance(tokens, list) or not tokens or len(tokens) > max_batch_size or \
+       not all(isinstance(token, str) for token in tokens):
+        return [{
+            "name": "tokens",
+            "reason": "Between 1 and %d tokens are required." % max_batch_size
+        }]
+    return []
+
+
+def v2_status_content(tokens, ttls):
+    return [{
+        "token": token,
+        "exists": ttl is not None,
+        "ttl": ttl
+    } for token, ttl in zip(tokens, ttls)]
+
+
+def v2_password_content(req, token, ttl, collection_path=None, views=1):
+    url_token = quote_plus(token)
+    base_url = set_base_url(req)
+    api_link = urljoin(base_url, (collection_path or req.path) + "/" + url_token)
+    web_link = urljoin(base_url, url_token)
+    return {
+        "token": token,
+        "links": [{
+            "rel": "self",
+            "href": api_link
+        }, {
+            "rel": "web-view",
+            "href": web_link
+        }],
+        "ttl": ttl,
+        "views": views
+    }
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def request_cost(endpoint):
+    """
+    Return how many rate limit tokens a request to an endpoint costs: one
+    per secret it creates.
+    """
+    if endpoint == 'api_v2_set_passwords':
+        items = request.get_json(silent=True)
+        if isinstance(items, list) and items:
+            return len(items)
+    return 1
+
+
+def enforce_rate_limit():
+    rate_limiter = current_services().rate_limiter
+    identity = rate_limiter.identity(request.remote_addr, request.headers.get('X-API-Key'))
+    retry_after = rate_limiter.check(request.endpoint, identity, request_cost(request.endpoint))
+    if retry_after:
+        return as_rate_limited_problem(request, retry_after)
+
+
+def enforce_capacity():
+    services = current_services()
+    if not services.capacity.enabled or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return
+    decision = services.capacity.admit()
+    services.metrics.observe_admission(decision)
+    if decision == REJECTED:
+        return as_capacity_problem(request, InsufficientCapacity(services.capacity.interval))
+
+
+def handle_insufficient_capacity(error):
+    return as_capacity_problem(request, error)
+
+
+def record_request_metrics(response):
+    services = current_services()
+    metrics = services.metrics
+    if metrics.enabled and 'request_started' in g:
+        metrics.observe_request(request.endpoint, request.method, response.status_code,
+                                time.perf_counter() - g.request_started)
+        metrics.observe_pool(services.redis_pool_client())
+    return response
+
+
+@route('/', methods=['GET'])
 def index():
-    return render_template('set_password.html')
+    return render_page('set_password.html')
 
 
-@app.route('/', methods=['POST'])
+@route('/', methods=['POST'])
 def handle_password():
-    password = request.form.get('password')
-    ttl = request.form.get('ttl')
-    if clean_input():
-        ttl = TIME_CONVERSION[ttl.lower()]
-        token = set_password(password, ttl)
-        base_url = set_base_url(request)
-        link = base_url + quote_plus(token)
-        if request.accept_mimetypes.accept_json and not \
-           request.accept_mimetypes.accept_html:
-            return jsonify(link=link, ttl=ttl)
-        else:
-            return render_template('confirm.html', password_link=link)
+    return run_steps(handle_password_steps())
+
+
+def handle_password_steps():
+    ttl, password = clean_input()
+    ttl = current_services().capacity.ttl(ttl)
+    views = clean_views(request.form.get('views'))
+    if views is None:
+        abort(400)
+    client_encrypted = is_client_encrypted(request.form)
+    if client_encrypted:
+        token = yield from set_encrypted_password_steps(password, ttl, views)
     else:
-        abort(500)
+        token = yield from set_password_steps(password, ttl, views)
+    base_url = set_base_url(request)
+    link = base_url + quote_plus(token)
+    if request.accept_mimetypes.accept_json and not \
+       request.accept_mimetypes.accept_html:
+        return jsonify(link=link, ttl=ttl)
+    else:
+        return render_template('confirm.html', password_link=link, client_encrypted=client_encrypted)
 
 
-@app.route('/api/set_password/', methods=['POST'])
+@route('/api/set_password/', methods=['POST'])
 def api_handle_password():
+    return run_steps(api_handle_password_steps())
+
+
+def api_handle_password_steps():
     password = request.json.get('password')
     ttl = int(request.json.get('ttl', DEFAULT_API_TTL))
-    if password and isinstance(ttl, int) and ttl <= MAX_TTL:
-        token = set_password(password, ttl)
+    views = clean_views(request.json.get('views'))
+    if password and isinstance(ttl, int) and ttl <= MAX_TTL and views is not None:
+        ttl = current_services().capacity.ttl(ttl)
+        token = yield from set_password_steps(password, ttl, views)
         base_url = set_base_url(request)
         link = base_url + quote_plus(token)
         return jsonify(link=link, ttl=ttl)
@@ -252,25 +966,17 @@ def api_handle_password():
         abort(500)
 
 
-@app.route('/api/v2/passwords', methods=['POST'])
+@route('/api/v2/passwords', methods=['POST'])
 def api_v2_set_password():
-    password = request.json.get('password')
-    ttl = int(request.json.get('ttl', DEFAULT_API_TTL))
-
-    invalid_params = []
+    return run_steps(api_v2_set_password_steps())
 
-    if not password:
-        invalid_params.append({
-            "name": "password",
-            "reason": "The password is required and should not be null or empty."
-        })
 
-    if not isinstance(ttl, int) or ttl > MAX_TTL:
-        invalid_params.append({
-            "name": "ttl",
-            "reason": "The specified TTL is longer than the maximum supported."
-        })
+def api_v2_set_password_steps():
+    password = request.json.get('password')
+    ttl = int(request.json.get('ttl', DEFAULT_API_TTL))
+    views = clean_views(request.json.get('views'))
 
+    invalid_params = validate_v2_password(password, ttl, views)
     if len(invalid_params) > 0:
         # Return a ProblemDetails expliciting issue with Password and/or TTL
         return as_validation_problem(
@@ -280,40 +986,82 @@ def api_v2_set_password():
             invalid_params
         )
 
-    token = set_password(password, ttl)
-    url_token = quote_plus(token)
-    base_url = set_base_url(request)
-    api_link = urljoin(base_url, request.path + "/" + url_token)
-    web_link = urljoin(base_url, url_token)
-    response_content = {
-        "token": token,
-        "links": [{
-            "rel": "self",
-            "href": api_link
-        }, {
-            "rel": "web-view",
-            "href": web_link
-        }],
-        "ttl": ttl
-    }
-    return jsonify(response_content)
+    ttl = current_services().capacity.ttl(ttl)
+    token = yield from set_password_steps(password, ttl, views)
+    return jsonify(v2_password_content(request, token, ttl, views=views))
 
 
-@app.route('/api/v2/passwords/<token>', methods=['HEAD'])
+@route('/api/v2/passwords/batch', methods=['POST'])
+def api_v2_set_passwords():
+    return run_steps(api_v2_set_passwords_steps())
+
+
+def api_v2_set_passwords_steps():
+    invalid_params, passwords = validate_v2_batch(request.json)
+    if len(invalid_params) > 0:
+        return as_validation_problem(
+            request,
+            "set-passwords-validation-error",
+            "Some of the passwords and/or TTLs are invalid.",
+            invalid_params
+        )
+
+    capacity = current_services().capacity
+    passwords = [(password, capacity.ttl(ttl), views) for password, ttl, views in passwords]
+    tokens = yield from set_passwords_steps(passwords)
+    collection_path = url_for('api_v2_set_password')
+    return jsonify([
+        v2_password_content(request, token, ttl, collection_path, views)
+        for token, (password, ttl, views) in zip(tokens, passwords)
+    ])
+
+
+@route('/api/v2/passwords/status', methods=['POST'])
+def api_v2_check_passwords():
+    return run_steps(api_v2_check_passwords_steps())
+
+
+def api_v2_check_passwords_steps():
+    tokens = request.json
+    invalid_params = validate_v2_tokens(tokens)
+    if len(invalid_params) > 0:
+        return as_validation_problem(
+            request,
+            "check-passwords-validation-error",
+            "The tokens are invalid.",
+            invalid_params
+        )
+
+    ttls = yield from passwords_ttl_steps(tokens)
+    return jsonify(v2_status_content(tokens, ttls))
+
+
+@route('/api/v2/passwords/<token>', methods=['HEAD'])
 def api_v2_check_password(token):
+    return run_steps(api_v2_check_password_steps(token))
+
+
+def api_v2_check_password_steps(token):
     token = unquote_plus(token)
-    if not password_exists(token):
+    # Files are not served by the password routes, as GET answers too.
+    views = 0 if is_file_key(parse_token(token)[0]) else (yield from password_views_steps(token))
+    if not views:
         # Return NotFound, to indicate that password does not exists (anymore or at all)
         return ('', 404)
     else:
-        # Return OK, to indicate that password still exists
-        return ('', 200)
+        # Return OK, to indicate that password still exists, and how many
+        # more times it can be viewed
+        return ('', 200, {'X-Remaining-Views': str(views)})
 
 
-@app.route('/api/v2/passwords/<token>', methods=['GET'])
+@route('/api/v2/passwords/<token>', methods=['GET'])
 def api_v2_retrieve_password(token):
+    return run_steps(api_v2_retrieve_password_steps(token))
+
+
+def api_v2_retrieve_password_steps(token):
     token = unquote_plus(token)
-    password = get_password(token)
+    password, views_left = yield from take_password_steps(token)
     if not password:
         # Return NotFound, to indicate that password does not exists (anymore or at all)
         return as_not_found_problem(
@@ -324,38 +1072,183 @@ def api_v2_retrieve_password(token):
         )
     else:
         # Return OK and the password in JSON message
-        return jsonify(password=password)
+        response = jsonify(password=password, remaining_views=views_left)
+        response.headers['X-Remaining-Views'] = str(views_left)
+        return response
 
 
-@app.route('/<password_key>', methods=['GET'])
+@route('/api/v2/files', methods=['POST'])
+def api_v2_set_file():
+    """
+    Store a file, sent either as the `file` field of a multipart form or as
+    the raw request body (named by the `filename` query parameter).
+    """
+    max_file_size = current_services().config['SNAPPASS_MAX_FILE_SIZE']
+    try:
+        upload = request.files.get('file')
+    except RequestEntityTooLarge:
+        return as_validation_problem(
+            request,
+            "set-file-validation-error",
+            "The file and/or the TTL are invalid.",
+            [{"name": "file", "reason": "Files are limited to %d bytes." % max_file_size}]
+        )
+    if upload is not None:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, request.args.get('filename'), request.mimetype
+    try:
+        ttl = int(request.values.get('ttl', DEFAULT_API_TTL))
+    except ValueError:
+        ttl = None
+
+    invalid_params = validate_v2_ttl(ttl)
+    if upload is None and (request.content_length or 0) > max_file_size:
+        invalid_params.append({
+            "name": "file",
+            "reason": "Files are limited to %d bytes." % max_file_size
+        })
+    if len(invalid_params) > 0:
+        return as_validation_problem(
+            request,
+            "set-file-validation-error",
+            "The file and/or the TTL are invalid.",
+            invalid_params
+        )
+
+    ttl = current_services().capacity.ttl(ttl)
+    try:
+        token = set_file(stream, ttl, filename, content_type)
+    except FileTooLarge as e:
+        return as_validation_problem(
+            request,
+            "set-file-validation-error",
+            "The file and/or the TTL are invalid.",
+            [{"name": "file", "reason": e.description}]
+        )
+    return jsonify(v2_password_content(request, token, ttl))
+
+
+@route('/api/v2/files/<token>', methods=['HEAD'])
+def api_v2_check_file(token):
+    token = unquote_plus(token)
+    if not is_file_key(parse_token(token)[0]) or not password_exists(token):
+        return ('', 404)
+    else:
+        return ('', 200)
+
+
+@route('/api/v2/files/<token>', methods=['GET'])
+def api_v2_retrieve_file(token):
+    token = unquote_plus(token)
+    header, content = get_file(token)
+    if header is None:
+        return as_not_found_problem(
+            request,
+            "get-file-error",
+            "The file doesn't exist.",
+            [{"name": "token"}]
+        )
+    return file_response(header, content)
+
+
+@route('/<password_key>', methods=['GET'])
 def preview_password(password_key):
-    password_key = unquote_plus(password_key)
-    if not password_exists(password_key):
-        return render_template('expired.html'), 404
+    return run_steps(preview_password_steps(password_key))
 
-    return render_template('preview.html')
+
+def preview_password_steps(password_key):
+    password_key = unquote_plus(password_key)
+    views = yield from password_views_steps(password_key)
+    if not views:
+        return render_page('expired.html'), 404
+
+    storage_key, decryption_key = parse_token(password_key)
+    file = is_file_key(storage_key)
+    # Without a key in their token, secrets were encrypted in the browser.
+    response = make_response(render_page('preview.html', client_encrypted=not file and decryption_key is None))
+    if not file:
+        set_reveal_nonce(response, password_key, views)
+    return response
 
 
-@app.route('/<password_key>', methods=['POST'])
+@route('/<password_key>', methods=['POST'])
 def show_password(password_key):
+    token = unquote_plus(password_key)
+    if is_file_key(parse_token(token)[0]):
+        header, content = get_file(token)
+        if header is None:
+            return render_page('expired.html'), 404
+        return file_response(header, content)
+    return run_steps(show_password_steps(password_key))
+
+
+def show_password_steps(password_key):
     password_key = unquote_plus(password_key)
-    password = get_password(password_key)
-    if not password:
-        return render_template('expired.html'), 404
+    if parse_token(password_key)[0] is None:
+        return render_page('expired.html'), 404
 
-    return render_template('password.html', password=password)
+    password, views_left = yield from take_password_steps(password_key, is_single_view(request, password_key))
+    if not password:
+        response = make_response(render_page('expired.html'), 404)
+    elif request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        # Secrets encrypted in the browser are decrypted by the preview page.
+        response = jsonify(password=password, remaining_views=views_left)
+    else:
+        response = make_response(render_template('password.html', password=password, remaining_views=views_left))
+    response.delete_cookie(reveal_nonce_cookie(password_key), path=request.script_root or '/')
+    return response
 
 
-@app.route('/_/_/health', methods=['GET'])
-@check_redis_alive
+@route('/_/_/health', methods=['GET'])
 def health_check():
+    return run_steps(health_check_steps())
+
+
+def health_check_steps():
+    yield StorageCall('ping', ())
     return {}
 
 
+@route('/_/_/health/live', methods=['GET'])
+def liveness_check():
+    return {}
+
+
+@route('/_/_/health/ready', methods=['GET'])
+def readiness_check():
+    status = current_services().readiness.status()
+    return status, 200 if status['ready'] else 503
+
+
+@route('/_/_/metrics', methods=['GET'])
+def metrics_endpoint():
+    metrics = current_services().metrics
+    if not metrics.enabled:
+        abort(404)
+    body, content_type = metrics.render()
+    return body, 200, {'Content-Type': content_type}
+
+
+def reset_after_fork():
+    """
+    Drop the connections and pools inherited from the parent process, so
+    each worker process creates its own.
+    """
+    current_services().reset()
+
+
 @check_redis_alive
 def main():
-    app.run(host=os.environ.get('SNAPPASS_BIND_ADDRESS', '0.0.0.0'),
-            port=os.environ.get('SNAPPASS_PORT', 5000))
+    app = default_app()
+    services = app.extensions['snappass']
+    serve(app,
+          host=os.environ.get('SNAPPASS_BIND_ADDRESS', '0.0.0.0'),
+          port=int(os.environ.get('SNAPPASS_PORT', 5000)),
+          # In-memory secrets are only visible to the process holding them.
+          single_process=isinstance(services.storage, MemoryStorage),
+          post_fork=reset_after_fork,
+          child_exit=services.metrics.process_exited)
 
 
 if __name__ == '__main__':
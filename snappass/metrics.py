@@ -0,0 +1,186 @@
+"""
+Prometheus metrics for snappass.
+
+Metrics are collected when ``SNAPPASS_METRICS`` is set and `prometheus_client`
+is installed (``pip install snappass[metrics]``), and served on
+``/_/_/metrics``. They cover requests per route, storage command and Fernet
+latencies, reveal nonces, Redis connection pool usage, negative cache
+lookups, and, with ``SNAPPASS_CAPACITY``, Redis memory usage and the
+admission of new secrets.
+
+When running several worker processes (e.g. gunicorn), point
+``PROMETHEUS_MULTIPROC_DIR`` at an empty directory shared by the workers:
+each worker then writes its samples there and the endpoint aggregates them.
+"""
+import importlib.util
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+from snappass.settings import to_bool
+
+# Latencies range from sub-millisecond storage calls to slow crypto on large secrets.
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+
+def pool_usage(client):
+    """
+    Return (in use, idle) connection counts of a redis-py client's pool, or
+    None when the pool doesn't expose them (e.g. Redis Cluster).
+    """
+    pool = getattr(client, 'connection_pool', None)
+    if pool is None:
+        return None
+    if hasattr(pool, '_in_use_connections'):
+        return len(pool._in_use_connections), len(pool._available_connections)
+    if hasattr(pool, 'pool') and hasattr(pool, '_connections'):
+        # BlockingConnectionPool: idle connections wait in a queue, padded with None.
+        idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        return len(pool._connections) - idle, idle
+    return None
+
+
+class NullMetrics:
+    """
+    Stand-in used when metrics are disabled: every hook does nothing.
+    """
+    enabled = False
+
+    def crypto_timer(self, operation):
+        return nullcontext()
+
+    def storage_timer(self, command):
+        return nullcontext()
+
+    def observe_request(self, endpoint, method, status, duration):
+        pass
+
+    def observe_pool(self, client):
+        pass
+
+    def observe_reveal_nonce(self, result):
+        pass
+
+    def observe_capacity(self, status):
+        pass
+
+    def observe_admission(self, decision):
+        pass
+
+    def observe_negative_cache(self, result):
+        pass
+
+    def process_exited(self, pid):
+        pass
+
+    def render(self):
+        raise RuntimeError('Metrics are disabled')
+
+
+class Metrics(NullMetrics):
+    enabled = True
+
+    def __init__(self, registry=None):
+        # Only imported when metrics are enabled, as it is slow to import.
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+        if registry is None:
+            registry = CollectorRegistry()
+        self.registry = registry
+        self.requests = Counter(
+            'snappass_requests_total', 'Requests handled, by route and status.',
+            ['endpoint', 'method', 'status'], registry=registry)
+        self.request_latency = Histogram(
+            'snappass_request_duration_seconds', 'Time spent handling requests, by route.',
+            ['endpoint'], buckets=LATENCY_BUCKETS, registry=registry)
+        self.storage_latency = Histogram(
+            'snappass_storage_command_duration_seconds', 'Time spent in storage (Redis) commands.',
+            ['command'], buckets=LATENCY_BUCKETS, registry=registry)
+        self.crypto_latency = Histogram(
+            'snappass_crypto_duration_seconds', 'Time spent encrypting and decrypting secrets.',
+            ['operation'], buckets=LATENCY_BUCKETS, registry=registry)
+        self.reveal_nonces = Counter(
+            'snappass_reveal_nonces_total', 'Secrets revealed from the browser, by state of the preview nonce.',
+            ['result'], registry=registry)
+        self.pool_connections = Gauge(
+            'snappass_redis_pool_connections', 'Redis connections of the pool, by state.',
+            ['state'], multiprocess_mode='livesum', registry=registry)
+        # Every worker samples the same Redis server.
+        self.redis_memory = Gauge(
+            'snappass_redis_memory_bytes', 'Redis memory, used and limit (maxmemory, 0 if unlimited).',
+            ['kind'], multiprocess_mode='max', registry=registry)
+        self.redis_keys = Gauge(
+            'snappass_redis_keys', 'Keys in the Redis database.', multiprocess_mode='max', registry=registry)
+        self.admissions = Counter(
+            'snappass_admissions_total', 'New secrets by admission decision under memory pressure.',
+            ['decision'], registry=registry)
+        self.negative_cache = Counter(
+            'snappass_negative_cache_total', 'Lookups of the negative cache, by result.',
+            ['result'], registry=registry)
+
+    @contextmanager
+    def _timer(self, histogram):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def crypto_timer(self, operation):
+        return self._timer(self.crypto_latency.labels(operation))
+
+    def storage_timer(self, command):
+        return self._timer(self.storage_latency.labels(command))
+
+    def observe_request(self, endpoint, method, status, duration):
+        endpoint = endpoint or 'unknown'
+        self.requests.labels(endpoint, method, str(status)).inc()
+        self.request_latency.labels(endpoint).observe(duration)
+
+    def observe_pool(self, client):
+        usage = pool_usage(client)
+        if usage is not None:
+            in_use, idle = usage
+            self.pool_connections.labels('in_use').set(in_use)
+            self.pool_connections.labels('idle').set(idle)
+
+    def observe_reveal_nonce(self, result):
+        self.reveal_nonces.labels(result).inc()
+
+    def observe_capacity(self, status):
+        self.redis_memory.labels('used').set(status['used_memory'])
+        self.redis_memory.labels('max').set(status['maxmemory'])
+        self.redis_keys.set(status['keys'])
+
+    def observe_admission(self, decision):
+        self.admissions.labels(decision).inc()
+
+    def observe_negative_cache(self, result):
+        self.negative_cache.labels(result).inc()
+
+    def process_exited(self, pid):
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+
+    def render(self):
+        """
+        Return the exposition body and its content type.
+        """
+        import prometheus_client
+        from prometheus_client import multiprocess
+
+        registry = self.registry
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def create_metrics(environ=None):
+    environ = os.environ if environ is None else environ
+    if not to_bool(environ.get('SNAPPASS_METRICS', 'False')):
+        return NullMetrics()
+    if importlib.util.find_spec('prometheus_client') is None:
+        raise RuntimeError('SNAPPASS_METRICS requires prometheus_client: pip install snappass[metrics]')
+    return Metrics()
@@ -0,0 +1,129 @@
+"""
+Negative lookup cache, of the secrets known to be gone.
+
+Crawlers, chat link unfurlers and people reloading a burned link keep
+asking for secrets that were revealed or have expired. When
+``SNAPPASS_NEGATIVE_CACHE`` is set, each process remembers the storage keys
+it found missing, or whose last view it consumed, in a bounded LRU whose
+entries expire after ``ttl`` seconds; repeated lookups are answered from
+memory. Storage keys are never reused, so a key gone once stays gone: the
+expiry only lets a key restored in Redis, e.g. from a backup, be found
+again.
+
+``SNAPPASS_NEGATIVE_CACHE_BLOOM`` adds a Bloom filter of the keys burned
+(revealed for the last time) most recently, remembering many more of them
+in little memory. A false positive would hide a secret that still exists,
+so its error rate defaults to one in a billion.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class NullNegativeCache:
+    """
+    Stand-in used when the negative cache is disabled: nothing is known to
+    be gone.
+    """
+    enabled = False
+
+    def __contains__(self, key):
+        return False
+
+    def add(self, key):
+        pass
+
+    def burn(self, key):
+        pass
+
+
+class BloomFilter:
+    """
+    Bloom filter over two generations of ``capacity`` keys each: once the
+    current one is full, it becomes the previous one and the oldest is
+    dropped, so the most recent keys are always remembered.
+    """
+
+    def __init__(self, capacity, error_rate=1e-9):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        # A blake2b digest holds 8 positions
+        self._salts = [bytes([salt]) * 16 for salt in range(-(-self.hashes // 8))]
+        self._current = bytearray((self.size + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0
+
+    def _indexes(self, key):
+        # Independent 64-bit positions, sliced from as many salted digests of
+        # the key as needed: double hashing falls short of tiny error rates.
+        data = key.encode('utf-8')
+        digests = b''.join(hashlib.blake2b(data, salt=salt).digest() for salt in self._salts)
+        return [int.from_bytes(digests[i * 8:i * 8 + 8], 'big') % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        if self._count >= self.capacity:
+            self._current, self._previous = bytearray(len(self._current)), self._current
+            self._count = 0
+        for index in self._indexes(key):
+            self._current[index >> 3] |= 1 << (index & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        indexes = self._indexes(key)
+        return any(all(bits[index >> 3] & (1 << (index & 7)) for index in indexes)
+                   for bits in (self._current, self._previous))
+
+
+class NegativeCache(NullNegativeCache):
+    enabled = True
+
+    def __init__(self, size=10000, ttl=300, bloom=None, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.bloom = bloom
+        self.clock = clock
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._expiries.get(key)
+            if expiry is not None:
+                if expiry > self.clock():
+                    self._expiries.move_to_end(key)
+                    return True
+                del self._expiries[key]
+            return self.bloom is not None and key in self.bloom
+
+    def add(self, key):
+        """
+        Remember that a key was found missing.
+        """
+        with self._lock:
+            self._expiries[key] = self.clock() + self.ttl
+            self._expiries.move_to_end(key)
+            while len(self._expiries) > self.size:
+                self._expiries.popitem(last=False)
+
+    def burn(self, key):
+        """
+        Remember that the last view of a key was consumed.
+        """
+        self.add(key)
+        if self.bloom is not None:
+            with self._lock:
+                self.bloom.add(key)
+
+
+def create_negative_cache(environ):
+    size = int(environ.get('SNAPPASS_NEGATIVE_CACHE', 0))
+    if size <= 0:
+        return NullNegativeCache()
+    bloom_capacity = int(environ.get('SNAPPASS_NEGATIVE_CACHE_BLOOM', 0))
+    bloom = None
+    if bloom_capacity > 0:
+        bloom = BloomFilter(bloom_capacity, float(environ.get('SNAPPASS_NEGATIVE_CACHE_BLOOM_ERROR_RATE', 1e-9)))
+    return NegativeCache(size, float(environ.get('SNAPPASS_NEGATIVE_CACHE_TTL', 300)), bloom)
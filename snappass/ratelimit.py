@@ -0,0 +1,202 @@
+"""
+Token bucket rate limiting of the routes creating secrets.
+
+Each client (its IP address, or one of the API keys listed in
+``SNAPPASS_RATE_LIMIT_API_KEYS``) gets a bucket per route, holding up to the
+route's allowance of tokens and refilled continuously. With Redis storage
+the buckets live in Redis and are updated by a single script per request, so
+every worker process shares them; other storage backends keep them in
+process. A client found over its limit is remembered locally until its
+bucket refills, so it is turned away without a round trip to Redis.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from snappass.sharding import ShardedStorage
+from snappass.storage import RedisStorage, _is_unknown_command
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Returns whether the request is allowed, and how many seconds to wait if not.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+def parse_rate(value):
+    """
+    Parse a rate such as ``20/minute`` into a (capacity, tokens per second)
+    pair.
+    """
+    count, _, period = value.partition('/')
+    try:
+        count = int(count)
+        seconds = PERIODS[period.strip().lower()]
+    except (KeyError, ValueError):
+        raise ValueError('Invalid rate limit %r, expected <count>/<%s>' % (value, '|'.join(PERIODS)))
+    if count <= 0:
+        raise ValueError('Invalid rate limit %r, the count must be positive' % value)
+    return count, count / seconds
+
+
+def parse_limits(default, overrides, endpoints):
+    """
+    Return the (capacity, rate) of each limited endpoint: ``default`` applies
+    to all of ``endpoints``, and ``overrides`` is a comma separated list of
+    ``endpoint=rate`` pairs, where a rate of ``off`` lifts the limit.
+    """
+    limits = {}
+    if default:
+        limits = dict.fromkeys(endpoints, parse_rate(default))
+    for override in (overrides or '').split(','):
+        if not override.strip():
+            continue
+        endpoint, _, rate = override.partition('=')
+        endpoint = endpoint.strip()
+        if rate.strip().lower() == 'off':
+            limits.pop(endpoint, None)
+        else:
+            limits[endpoint] = parse_rate(rate)
+    return limits
+
+
+class LocalBuckets:
+    """
+    Token buckets held in process.
+    """
+
+    def __init__(self, max_buckets=100000, clock=time.monotonic):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, cost=1):
+        """
+        Take ``cost`` tokens from a bucket, returning 0 when they were
+        available, or how many seconds to wait until they are.
+        """
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if len(self._buckets) > self.max_buckets:
+                # Buckets full again are the same as missing ones.
+                self._buckets = {k: bucket for k, bucket in self._buckets.items() if bucket[2] > now}
+            return retry_after
+
+
+class RedisBuckets:
+    """
+    Token buckets held in Redis, shared by every process.
+    """
+
+    def __init__(self, client):
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, capacity, rate, cost=1):
+        allowed, retry_after = self.script(keys=[key], args=[capacity, rate, cost])
+        return 0 if int(allowed) else float(retry_after)
+
+
+class RateLimiter:
+
+    def __init__(self, limits, buckets, prefix='ratelimit:', api_keys=(), max_blocked=10000):
+        self.limits = limits
+        self.buckets = buckets
+        self.prefix = prefix
+        self.api_keys = frozenset(api_keys)
+        self.max_blocked = max_blocked
+        self._blocked = {}
+        self._blocked_lock = threading.Lock()
+
+    def identity(self, remote_addr, api_key=None):
+        """
+        Return who a request is accounted to: its API key if it is a known
+        one, its IP address otherwise.
+        """
+        if api_key and api_key in self.api_keys:
+            return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+        return 'ip:' + (remote_addr or 'unknown')
+
+    def check(self, endpoint, identity, cost=1):
+        """
+        Account a request to an endpoint, returning 0 if it is allowed, or how
+        many seconds the client should wait before retrying.
+        """
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return 0
+        key = '%s%s:%s' % (self.prefix, endpoint, identity)
+
+        now = time.monotonic()
+        with self._blocked_lock:
+            blocked_until = self._blocked.get(key)
+            if blocked_until is not None:
+                if blocked_until > now:
+                    return blocked_until - now
+                del self._blocked[key]
+
+        capacity, rate = limit
+        try:
+            retry_after = self.buckets.take(key, capacity, rate, cost)
+        except Exception as e:
+            if not _is_unknown_command(e):
+                raise
+            # The server doesn't run scripts: fall back to per-process buckets.
+            self.buckets = LocalBuckets()
+            retry_after = self.buckets.take(key, capacity, rate, cost)
+
+        if retry_after:
+            with self._blocked_lock:
+                if len(self._blocked) >= self.max_blocked:
+                    self._blocked = {k: until for k, until in self._blocked.items() if until > now}
+                    if len(self._blocked) >= self.max_blocked:
+                        self._blocked.clear()
+                self._blocked[key] = now + retry_after
+        return retry_after
+
+
+def create_rate_limiter(storage, endpoints, prefix='ratelimit:', environ=None):
+    """
+    Create the rate limiter configured by ``SNAPPASS_RATE_LIMIT`` (applying
+    to all of ``endpoints``) and ``SNAPPASS_RATE_LIMITS`` (per endpoint).
+    """
+    environ = os.environ if environ is None else environ
+    limits = parse_limits(environ.get('SNAPPASS_RATE_LIMIT'), environ.get('SNAPPASS_RATE_LIMITS'), endpoints)
+    if isinstance(storage, ShardedStorage):
+        # Buckets are kept on the first shard.
+        storage = storage.default
+    if isinstance(storage, RedisStorage):
+        buckets = RedisBuckets(storage.client)
+    else:
+        buckets = LocalBuckets()
+    api_keys = [key.strip() for key in environ.get('SNAPPASS_RATE_LIMIT_API_KEYS', '').split(',') if key.strip()]
+    return RateLimiter(limits, buckets, prefix, api_keys)
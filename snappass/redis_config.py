@@ -0,0 +1,140 @@
+"""
+Build the Redis client from the environment.
+
+``REDIS_MODE`` selects a standalone server (the default), a Sentinel-managed
+master or a Redis Cluster; the ``SNAPPASS_REDIS_*`` variables tune the
+connection pool. The same settings build both the blocking client used by the
+Flask app and the asyncio client used by the ASGI app.
+
+Each function reads its settings from ``environ``, the environment by
+default. redis-py is only imported once a client is built.
+"""
+import os
+
+from snappass.settings import to_bool
+
+REDIS_MODES = ('standalone', 'sentinel', 'cluster')
+
+
+def redis_mode(environ=None):
+    environ = os.environ if environ is None else environ
+    mode = environ.get('REDIS_MODE', 'standalone').lower()
+    if mode not in REDIS_MODES:
+        raise ValueError('Unknown REDIS_MODE %r, expected one of %s' % (mode, ', '.join(REDIS_MODES)))
+    return mode
+
+
+def supports_transactions(environ=None):
+    """
+    Redis Cluster can't run MULTI/EXEC across keys living on different nodes.
+    """
+    environ = os.environ if environ is None else environ
+    return bool(environ.get('MOCK_REDIS')) or redis_mode(environ) != 'cluster'
+
+
+def connection_options(environ=None):
+    """
+    Connection settings shared by every mode, left out when not configured
+    so redis-py keeps its own defaults.
+    """
+    environ = os.environ if environ is None else environ
+    options = {}
+    if environ.get('SNAPPASS_REDIS_SOCKET_TIMEOUT'):
+        options['socket_timeout'] = float(environ['SNAPPASS_REDIS_SOCKET_TIMEOUT'])
+    if environ.get('SNAPPASS_REDIS_CONNECT_TIMEOUT'):
+        options['socket_connect_timeout'] = float(environ['SNAPPASS_REDIS_CONNECT_TIMEOUT'])
+    if environ.get('SNAPPASS_REDIS_HEALTH_CHECK_INTERVAL'):
+        options['health_check_interval'] = int(environ['SNAPPASS_REDIS_HEALTH_CHECK_INTERVAL'])
+    if environ.get('SNAPPASS_REDIS_KEEPALIVE'):
+        options['socket_keepalive'] = to_bool(environ['SNAPPASS_REDIS_KEEPALIVE'])
+    return options
+
+
+def max_connections(environ=None):
+    environ = os.environ if environ is None else environ
+    if environ.get('SNAPPASS_REDIS_MAX_CONNECTIONS'):
+        return int(environ['SNAPPASS_REDIS_MAX_CONNECTIONS'])
+
+
+def parse_nodes(nodes, default_port):
+    """
+    Parse a comma separated list of ``host[:port]`` into (host, port) pairs.
+    """
+    parsed = []
+    for node in nodes.split(','):
+        node = node.strip()
+        if not node:
+            continue
+        if ':' in node:
+            host, port = node.rsplit(':', 1)
+        else:
+            host, port = node, default_port
+        parsed.append((host, int(port)))
+    return parsed
+
+
+def create_redis_client(use_asyncio=False, environ=None):
+    """
+    Create the Redis client described by the environment, either blocking
+    or, with ``use_asyncio``, from ``redis.asyncio``.
+    """
+    environ = os.environ if environ is None else environ
+    if environ.get('MOCK_REDIS'):
+        if use_asyncio:
+            from fakeredis.aioredis import FakeRedis
+            return FakeRedis()
+        from fakeredis import FakeStrictRedis
+        return FakeStrictRedis()
+
+    import redis
+    import redis.asyncio
+    import redis.asyncio.cluster
+    import redis.asyncio.sentinel
+    import redis.cluster
+    import redis.sentinel
+
+    module = redis.asyncio if use_asyncio else redis
+    mode = redis_mode(environ)
+    options = connection_options(environ)
+    pool_size = max_connections(environ)
+    db = environ.get('SNAPPASS_REDIS_DB', 0)
+
+    if mode == 'sentinel':
+        sentinel_module = redis.asyncio.sentinel if use_asyncio else redis.sentinel
+        sentinels = parse_nodes(environ.get('REDIS_SENTINELS', 'localhost'), 26379)
+        sentinel = sentinel_module.Sentinel(sentinels, sentinel_kwargs=dict(options), **options)
+        if pool_size:
+            options['max_connections'] = pool_size
+        return sentinel.master_for(
+            environ.get('REDIS_SENTINEL_MASTER', 'mymaster'),
+            redis_class=module.StrictRedis, db=db, **options)
+
+    if mode == 'cluster':
+        cluster_module = redis.asyncio.cluster if use_asyncio else redis.cluster
+        if pool_size:
+            options['max_connections'] = pool_size
+        if environ.get('REDIS_URL'):
+            return cluster_module.RedisCluster.from_url(environ['REDIS_URL'], **options)
+        nodes = parse_nodes(environ.get('REDIS_CLUSTER_NODES', 'localhost'), 6379)
+        return cluster_module.RedisCluster(
+            startup_nodes=[cluster_module.ClusterNode(host, port) for host, port in nodes], **options)
+
+    if pool_size:
+        # Make callers wait for a free connection instead of failing when
+        # the pool is exhausted.
+        options['max_connections'] = pool_size
+        if environ.get('SNAPPASS_REDIS_POOL_TIMEOUT'):
+            options['timeout'] = float(environ['SNAPPASS_REDIS_POOL_TIMEOUT'])
+        if environ.get('REDIS_URL'):
+            pool = module.BlockingConnectionPool.from_url(environ['REDIS_URL'], **options)
+        else:
+            pool = module.BlockingConnectionPool(
+                host=environ.get('REDIS_HOST', 'localhost'),
+                port=environ.get('REDIS_PORT', 6379), db=db, **options)
+        return module.StrictRedis(connection_pool=pool)
+
+    if environ.get('REDIS_URL'):
+        return module.StrictRedis.from_url(environ['REDIS_URL'], **options)
+    return module.StrictRedis(
+        host=environ.get('REDIS_HOST', 'localhost'),
+        port=environ.get('REDIS_PORT', 6379), db=db, **options)
@@ -0,0 +1,96 @@
+"""
+Production serving for the ``snappass`` command.
+
+``SNAPPASS_SERVER`` selects the server: `gunicorn` (several worker processes,
+each running several threads), `waitress` (one process, several threads, for
+platforms without ``fork``) or Flask's `development` server. It defaults to
+the first of them that is installed.
+
+Each gunicorn worker drops the Redis connections, crypto pool and other
+state it inherited from the parent process right after the fork, so no
+socket or lock is ever shared between processes.
+"""
+import importlib.util
+import os
+
+SERVERS = ('gunicorn', 'waitress', 'development')
+
+
+def cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        # CPUs this process may run on, which is what containers restrict.
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def server_options():
+    """
+    Return the gunicorn settings configured through the environment.
+    """
+    return {
+        'workers': int(os.environ.get('SNAPPASS_WORKERS', 0)) or 2 * cpu_count() + 1,
+        'threads': int(os.environ.get('SNAPPASS_THREADS', 4)),
+        'keepalive': int(os.environ.get('SNAPPASS_KEEPALIVE', 5)),
+        'max_requests': int(os.environ.get('SNAPPASS_MAX_REQUESTS', 1000)),
+        'max_requests_jitter': int(os.environ.get('SNAPPASS_MAX_REQUESTS_JITTER', 100)),
+        'timeout': int(os.environ.get('SNAPPASS_WORKER_TIMEOUT', 30)),
+    }
+
+
+def select_server(name=None):
+    name = (name or os.environ.get('SNAPPASS_SERVER') or 'auto').lower()
+    if name == 'auto':
+        for server in SERVERS[:-1]:
+            if importlib.util.find_spec(server) is not None:
+                return server
+        return 'development'
+    if name not in SERVERS:
+        raise ValueError('Unknown SNAPPASS_SERVER %r, expected one of auto, %s' % (name, ', '.join(SERVERS)))
+    return name
+
+
+def run_gunicorn(app, host, port, options, post_fork=None, child_exit=None):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', '%s:%d' % (host, port))
+            for key, value in options.items():
+                self.cfg.set(key, value)
+            if post_fork is not None:
+                self.cfg.set('post_fork', lambda server, worker: post_fork())
+            if child_exit is not None:
+                self.cfg.set('child_exit', lambda server, worker: child_exit(worker.pid))
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def run_waitress(app, host, port, options):
+    import waitress
+
+    waitress.serve(app, host=host, port=port, threads=options['threads'])
+
+
+def serve(app, host, port, server=None, single_process=False, post_fork=None, child_exit=None):
+    """
+    Serve ``app`` until interrupted.
+
+    ``single_process`` restricts gunicorn to one worker, for storage that
+    lives in process memory. ``post_fork`` is called in every worker process
+    once forked, and ``child_exit`` with the process id of every worker that
+    exited.
+    """
+    server = select_server(server)
+    options = server_options()
+    if single_process:
+        options['workers'] = 1
+    if server == 'gunicorn':
+        run_gunicorn(app, host, port, options, post_fork, child_exit)
+    elif server == 'waitress':
+        run_waitress(app, host, port, options)
+    else:
+        app.run(host=host, port=port)
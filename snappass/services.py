@@ -0,0 +1,132 @@
+"""
+Per-application backends, built on first use.
+
+An application created by :func:`snappass.main.create_app` holds a
+:class:`Services` instance, from which its Redis client, storage, metrics,
+probes, crypto pool, rate limiter, event publisher, capacity monitor and
+negative cache are built from its settings the first time they are needed. Creating an application therefore
+costs no connection and imports no backend, and several differently
+configured applications can live in one process.
+"""
+import threading
+from functools import cached_property
+
+from snappass.capacity import create_capacity
+from snappass.crypto import CryptoExecutor, MasterKeys
+from snappass.events import create_events
+from snappass.health import ReadinessProbe
+from snappass.metrics import create_metrics
+from snappass.negative import create_negative_cache
+from snappass.ratelimit import create_rate_limiter
+from snappass.redis_config import create_redis_client, supports_transactions
+from snappass.sharding import create_sharded_storage
+from snappass.storage import create_storage, storage_backend
+
+
+class Services:
+
+    def __init__(self, config, environ, rate_limited_endpoints=()):
+        self.config = config
+        self.environ = environ
+        self.rate_limited_endpoints = rate_limited_endpoints
+        # Pages that only depend on the locale, rendered once per locale
+        self.page_cache = {}
+        # cached_property doesn't guard against concurrent first uses.
+        self._lock = threading.RLock()
+
+    def _build(self, name, factory):
+        with self._lock:
+            if name not in self.__dict__:
+                self.__dict__[name] = factory()
+            return self.__dict__[name]
+
+    @cached_property
+    def redis_client(self):
+        return self._build('redis_client', lambda: create_redis_client(environ=self.environ))
+
+    @cached_property
+    def storage(self):
+        def factory():
+            backend = storage_backend(self.environ)
+            if backend == 'redis' and self.environ.get('SNAPPASS_REDIS_SHARDS'):
+                return create_sharded_storage(
+                    self.environ['SNAPPASS_REDIS_SHARDS'], self.config['REDIS_PREFIX'],
+                    lambda url: create_redis_client(environ=dict(self.environ, REDIS_URL=url)),
+                    supports_transactions(self.environ), self.config['SNAPPASS_TENANT_SHARDS'])
+            redis_client = self.redis_client if backend == 'redis' else None
+            return create_storage(redis_client, supports_transactions(self.environ), self.environ)
+        return self._build('storage', factory)
+
+    @cached_property
+    def metrics(self):
+        # A no-op unless SNAPPASS_METRICS is set
+        return self._build('metrics', lambda: create_metrics(self.environ))
+
+    @cached_property
+    def events(self):
+        # A no-op unless SNAPPASS_EVENTS is set
+        prefix = self.config['REDIS_PREFIX']
+        return self._build('events', lambda: create_events(
+            lambda: self.redis_client, prefix + 'events', prefix, self.environ))
+
+    @cached_property
+    def readiness(self):
+        environ = self.environ
+        return self._build('readiness', lambda: ReadinessProbe(
+            lambda: self.storage.ping(), getattr(self.storage, 'client', None),
+            interval=float(environ.get('SNAPPASS_READINESS_INTERVAL', 5)),
+            latency_budget=float(environ.get('SNAPPASS_READINESS_LATENCY_BUDGET', 0.25)),
+            max_pool_usage=float(environ.get('SNAPPASS_READINESS_MAX_POOL_USAGE', 0.9))))
+
+    @cached_property
+    def capacity(self):
+        # Admission control under Redis memory pressure, when SNAPPASS_CAPACITY is set
+        return self._build('capacity', lambda: create_capacity(
+            getattr(self.storage, 'client', None), self.metrics, self.environ))
+
+    @cached_property
+    def negative_cache(self):
+        # Storage keys known to be gone, when SNAPPASS_NEGATIVE_CACHE is set
+        return self._build('negative_cache', lambda: create_negative_cache(self.environ))
+
+    @cached_property
+    def crypto_executor(self):
+        # Optionally run Fernet on a 'thread' or 'process' pool for large payloads
+        environ = self.environ
+        return self._build('crypto_executor', lambda: CryptoExecutor(
+            kind=environ.get('SNAPPASS_CRYPTO_EXECUTOR') or None,
+            max_workers=int(environ.get('SNAPPASS_CRYPTO_WORKERS', 0)) or None,
+            threshold=int(environ.get('SNAPPASS_CRYPTO_THRESHOLD', 65536)),
+            max_pending=int(environ['SNAPPASS_CRYPTO_MAX_PENDING'])
+            if environ.get('SNAPPASS_CRYPTO_MAX_PENDING') else None))
+
+    @cached_property
+    def master_keys(self):
+        # Envelope encryption with short tokens, when SNAPPASS_MASTER_KEYS is set
+        value = self.environ.get('SNAPPASS_MASTER_KEYS')
+        return self._build('master_keys', lambda: MasterKeys.parse(value) if value else None)
+
+    @cached_property
+    def rate_limiter(self):
+        return self._build('rate_limiter', lambda: create_rate_limiter(
+            self.storage, self.rate_limited_endpoints, self.config['REDIS_PREFIX'] + 'ratelimit:', self.environ))
+
+    def redis_pool_client(self):
+        """
+        Return the Redis client whose connection pool is worth watching, if
+        storage uses one and it was built.
+        """
+        storage = self.__dict__.get('storage')
+        return getattr(storage, 'client', None)
+
+    def reset(self):
+        """
+        Drop the connections and pools inherited from the parent process,
+        after a fork.
+        """
+        if 'storage' in self.__dict__:
+            self.storage.reset()
+        if 'crypto_executor' in self.__dict__:
+            self.crypto_executor.reset()
+        if 'events' in self.__dict__:
+            self.events.reset()
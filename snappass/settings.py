@@ -0,0 +1,35 @@
+"""
+Settings shared by the application factory and the backends it builds.
+
+Every setting is named after its environment variable. An application's
+settings are the configuration mapping it was created with, falling back to
+the environment.
+"""
+import os
+from collections import ChainMap
+
+TRUE_VALUES = ('y', 'yes', 't', 'true', 'on', '1')
+FALSE_VALUES = ('n', 'no', 'f', 'false', 'off', '0')
+
+
+def to_bool(value):
+    """
+    Parse a boolean setting, with the conventions of distutils' strtobool.
+    """
+    if isinstance(value, bool):
+        return value
+    value = str(value).lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError('Invalid boolean setting %r' % value)
+
+
+def environ(config=None):
+    """
+    Return the settings made of ``config`` over the environment.
+    """
+    if config is None:
+        return os.environ
+    return ChainMap(dict(config), os.environ)
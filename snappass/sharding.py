@@ -0,0 +1,214 @@
+"""
+Per-tenant key namespaces and sharding of secrets across Redis servers.
+
+After ``REDIS_PREFIX``, storage keys are laid out as::
+
+    [<tenant>.][<shard>-][file]<uuid hex>
+
+Secrets created through an API key listed in ``SNAPPASS_TENANTS`` live
+under their tenant's own prefix, e.g. ``snappassops.``, so that a tenant's
+keys can be told apart, counted or flushed. With ``SNAPPASS_REDIS_SHARDS``,
+each new secret is placed on one of several Redis servers by consistent
+hashing of its key, and the chosen shard is recorded in the key itself:
+adding a shard only changes where new secrets go, and every outstanding
+link keeps reaching the server holding its secret. Keys without a shard,
+created before sharding was enabled, live on the first shard listed.
+"""
+import bisect
+import hashlib
+import re
+from collections import namedtuple
+
+from snappass.storage import RedisStorage, Storage
+
+# Names are recorded in tokens too, hence the limit on their length.
+NAME = re.compile(r'^[a-z0-9_]{1,64}$')
+KEY_LAYOUT = re.compile(
+    r'^(?:(?P<tenant>[a-z0-9_]+)\.)?(?:(?P<shard>[a-z0-9_]+)-)?(?P<file>file)?(?P<uuid>[0-9a-f]{32})(?::\d+)?$')
+
+StorageKey = namedtuple('StorageKey', ['tenant', 'shard', 'file', 'uuid'])
+
+
+def build_key(prefix, uuid_hex, tenant=None, shard=None, file=False):
+    return ''.join([
+        prefix,
+        tenant + '.' if tenant else '',
+        shard + '-' if shard else '',
+        'file' if file else '',
+        uuid_hex,
+    ])
+
+
+def parse_key(prefix, storage_key):
+    """
+    Return the :class:`StorageKey` of a storage key (or of one of a file's
+    chunks), or None if it doesn't follow the layout.
+    """
+    if not storage_key.startswith(prefix):
+        return None
+    match = KEY_LAYOUT.match(storage_key[len(prefix):])
+    if match is None:
+        return None
+    return StorageKey(match.group('tenant'), match.group('shard'), bool(match.group('file')), match.group('uuid'))
+
+
+def location(prefix, storage_key):
+    """
+    Return the tenant and shard segments of a storage key, as laid out.
+    """
+    parsed = parse_key(prefix, storage_key)
+    if parsed is None:
+        return ''
+    return build_key('', '', parsed.tenant, parsed.shard)
+
+
+def parse_names(value, setting):
+    """
+    Parse a comma separated list of ``<name>=<value>`` pairs, names being
+    up to 64 lowercase letters, digits and underscores.
+    """
+    pairs = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, item_value = item.partition('=')
+        name = name.strip()
+        if not sep or not NAME.match(name) or not item_value.strip():
+            raise ValueError('Invalid %s entry %r, expected <name>=<value> with a name made of up to 64 '
+                             'a-z, 0-9 and _' % (setting, item))
+        pairs.append((name, item_value.strip()))
+    return pairs
+
+
+def parse_tenants(value):
+    """
+    Parse ``SNAPPASS_TENANTS``, ``<tenant>=<api key>`` pairs, into a mapping
+    from API keys to tenants.
+    """
+    return {api_key: tenant for tenant, api_key in parse_names(value, 'SNAPPASS_TENANTS')}
+
+
+def parse_tenant_shards(value):
+    """
+    Parse ``SNAPPASS_TENANT_SHARDS``, ``<tenant>=<shard>`` pairs.
+    """
+    return dict(parse_names(value, 'SNAPPASS_TENANT_SHARDS'))
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto shards: each shard owns ``replicas``
+    points of the ring, so adding one takes over about 1/n of the keys.
+    """
+
+    def __init__(self, shards, replicas=128):
+        points = sorted((_hash('%s#%d' % (shard, replica)), shard)
+                        for shard in shards for replica in range(replicas))
+        self._hashes = [point for point, shard in points]
+        self._shards = [shard for point, shard in points]
+
+    def shard(self, key):
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+class ShardedStorage(Storage):
+    """
+    Route each key to the storage of the shard recorded in it, or to the
+    first shard for keys without one.
+    """
+
+    def __init__(self, shards, prefix, tenant_shards=None):
+        # shards: (name, storage) pairs, in configuration order
+        self.shards = dict(shards)
+        self.default = shards[0][1]
+        self.prefix = prefix
+        self.tenant_shards = tenant_shards or {}
+        self.ring = HashRing(self.shards)
+        self.transactions = all(getattr(storage, 'transactions', True) for storage in self.shards.values())
+
+    def choose_shard(self, tenant, uuid_hex):
+        """
+        Pick the shard of a new key: the tenant's own, or by hashing.
+        """
+        if tenant in self.tenant_shards:
+            return self.tenant_shards[tenant]
+        return self.ring.shard(build_key('', uuid_hex, tenant))
+
+    def route(self, key):
+        parsed = parse_key(self.prefix, key)
+        if parsed is None:
+            return self.default
+        # Keys naming an unknown shard can't exist on the first one either.
+        return self.shards.get(parsed.shard, self.default)
+
+    def _group(self, keys):
+        # Positions of the keys, grouped by shard storage
+        groups = {}
+        for index, key in enumerate(keys):
+            storage = self.route(key)
+            groups.setdefault(id(storage), (storage, []))[1].append(index)
+        return groups.values()
+
+    def set(self, key, ttl, value, views=1):
+        self.route(key).set(key, ttl, value, views)
+
+    def set_many(self, items):
+        for storage, indexes in self._group([item[0] for item in items]):
+            storage.set_many([items[index] for index in indexes])
+
+    def getdel(self, key):
+        return self.route(key).getdel(key)
+
+    def take(self, key):
+        return self.route(key).take(key)
+
+    def take_last(self, key):
+        return self.route(key).take_last(key)
+
+    def peek(self, key):
+        return self.route(key).peek(key)
+
+    def exists(self, key):
+        return self.route(key).exists(key)
+
+    def views(self, key):
+        return self.route(key).views(key)
+
+    def pttl_many(self, keys):
+        pttls = [None] * len(keys)
+        for storage, indexes in self._group(keys):
+            for index, pttl in zip(indexes, storage.pttl_many([keys[index] for index in indexes])):
+                pttls[index] = pttl
+        return pttls
+
+    def ping(self):
+        return all(storage.ping() for storage in self.shards.values())
+
+    def reset(self):
+        for storage in self.shards.values():
+            storage.reset()
+
+    def close(self):
+        for storage in self.shards.values():
+            storage.close()
+
+
+def create_sharded_storage(value, prefix, client_factory, transactions=True, tenant_shards=None):
+    """
+    Create the storage of ``SNAPPASS_REDIS_SHARDS``, ``<shard>=<redis url>``
+    pairs, building each shard's client with ``client_factory(url)``.
+    """
+    shards = [(name, RedisStorage(client_factory(url), transactions))
+              for name, url in parse_names(value, 'SNAPPASS_REDIS_SHARDS')]
+    if not shards:
+        raise ValueError('SNAPPASS_REDIS_SHARDS lists no shard')
+    unknown = set((tenant_shards or {}).values()) - {name for name, storage in shards}
+    if unknown:
+        raise ValueError('SNAPPASS_TENANT_SHARDS names unknown shards: %s' % ', '.join(sorted(unknown)))
+    return ShardedStorage(shards, prefix, tenant_shards)
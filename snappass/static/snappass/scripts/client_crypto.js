@@ -0,0 +1,72 @@
+/*
+ * Encryption of secrets in the browser, with AES-GCM through WebCrypto.
+ *
+ * The server only ever sees the ciphertext: the key travels in the fragment
+ * of the secret's link, which browsers never send.
+ */
+var snappassCrypto = (function () {
+
+  var IV_SIZE = 12;
+
+  function toBase64Url(bytes) {
+    var text = '';
+    for (var i = 0; i < bytes.length; i++) {
+      text += String.fromCharCode(bytes[i]);
+    }
+    return btoa(text).replace(/\+/g, '-').replace(/\//g, '_').replace(/=+$/, '');
+  }
+
+  function fromBase64Url(text) {
+    text = text.replace(/-/g, '+').replace(/_/g, '/');
+    while (text.length % 4) {
+      text += '=';
+    }
+    var binary = atob(text);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+      bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+  }
+
+  // Resolves to {ciphertext, key}, both in unpadded url-safe base64; the
+  // ciphertext is prefixed with its random IV.
+  function encrypt(secret) {
+    var iv = window.crypto.getRandomValues(new Uint8Array(IV_SIZE));
+    return window.crypto.subtle.generateKey({name: 'AES-GCM', length: 256}, true, ['encrypt'])
+      .then(function (key) {
+        return Promise.all([
+          window.crypto.subtle.exportKey('raw', key),
+          window.crypto.subtle.encrypt({name: 'AES-GCM', iv: iv}, key, new TextEncoder().encode(secret))
+        ]);
+      })
+      .then(function (results) {
+        var encrypted = new Uint8Array(results[1]);
+        var ciphertext = new Uint8Array(IV_SIZE + encrypted.length);
+        ciphertext.set(iv);
+        ciphertext.set(encrypted, IV_SIZE);
+        return {ciphertext: toBase64Url(ciphertext), key: toBase64Url(new Uint8Array(results[0]))};
+      });
+  }
+
+  function decrypt(ciphertext, key) {
+    var data = fromBase64Url(ciphertext);
+    return window.crypto.subtle.importKey('raw', fromBase64Url(key), 'AES-GCM', false, ['decrypt'])
+      .then(function (cryptoKey) {
+        return window.crypto.subtle.decrypt(
+          {name: 'AES-GCM', iv: data.slice(0, IV_SIZE)}, cryptoKey, data.slice(IV_SIZE));
+      })
+      .then(function (plaintext) {
+        return new TextDecoder().decode(plaintext);
+      });
+  }
+
+  return {
+    // WebCrypto is only available to secure (HTTPS or localhost) pages.
+    supported: !!(window.crypto && window.crypto.subtle && window.TextEncoder),
+    // The link's key is held here between the form and the confirmation page.
+    keyStorageName: 'snappass-key',
+    encrypt: encrypt,
+    decrypt: decrypt
+  };
+})();
@@ -0,0 +1,10 @@
+(function () {
+
+  // Complete the link of a secret encrypted in the browser with its key.
+  var key = window.sessionStorage.getItem(snappassCrypto.keyStorageName);
+  window.sessionStorage.removeItem(snappassCrypto.keyStorageName);
+  if (key) {
+    var link = $('#password-link');
+    link.val(link.val() + '#' + key);
+  }
+})();
@@ -1,10 +1,46 @@
 (function () {
 
-  $('#revealSecret').click(function () {
+  // Secrets encrypted in the browser carry their key in the link's fragment.
+  var key = window.location.hash.slice(1);
+  var clientEncrypted = $('#revealSecret').data('client-encrypted') === true;
+
+  function submitForm() {
     var form = $('<form/>')
       .attr('id', 'revealSecretForm')
       .attr('method', 'post');
     form.appendTo($('body'));
     form.submit();
+  }
+
+  function revealInBrowser() {
+    $.ajax({method: 'POST', url: window.location.pathname, headers: {Accept: 'application/json'}})
+      .then(function (response) {
+        // A malformed key may also throw before any promise is made.
+        return Promise.resolve().then(function () {
+          return snappassCrypto.decrypt(response.password, key);
+        }).then(function (secret) {
+          $('#password-text').val(secret);
+          $('#revealSecret').closest('.row').addClass('hidden');
+          $('#revealedSecret').removeClass('hidden');
+          if (!response.remaining_views) {
+            $('#secretDeleted').removeClass('hidden');
+          }
+        }, function () {
+          // The view is consumed all the same: say so rather than fail silently.
+          $('#revealSecret').closest('.row').addClass('hidden');
+          $('#decryptionFailed').removeClass('hidden');
+        });
+      }, function () {
+        // Gone meanwhile: let the server render the expired page.
+        submitForm();
+      });
+  }
+
+  $('#revealSecret').click(function () {
+    if (clientEncrypted && key && snappassCrypto.supported) {
+      revealInBrowser();
+    } else {
+      submitForm();
+    }
   });
-})();
\ No newline at end of file
+})();
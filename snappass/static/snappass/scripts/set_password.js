@@ -0,0 +1,20 @@
+(function () {
+
+  // Without WebCrypto, the form is submitted as is and the server encrypts.
+  if (!snappassCrypto.supported) {
+    return;
+  }
+
+  $('#password_create').submit(function (event) {
+    var form = this;
+    var textarea = $('#password');
+    event.preventDefault();
+    snappassCrypto.encrypt(textarea.val()).then(function (result) {
+      window.sessionStorage.setItem(snappassCrypto.keyStorageName, result.key);
+      textarea.removeAttr('name');
+      $('<input type="hidden" name="password"/>').val(result.ciphertext).appendTo(form);
+      $('<input type="hidden" name="encrypted" value="1"/>').appendTo(form);
+      form.submit();
+    });
+  });
+})();
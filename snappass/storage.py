@@ -0,0 +1,724 @@
+"""
+Storage backends for encrypted secrets.
+
+Every backend stores opaque bytes under a key for a limited time and hands
+them back exactly once, or as many times as the views they were stored with,
+counted down atomically. ``SNAPPASS_STORAGE`` selects the backend:
+
+* ``redis`` (the default) keeps secrets in Redis, shared by every process.
+* ``memory`` keeps them in the process itself, bounded in size. Secrets are
+  lost on restart and are not shared between processes, so it only suits
+  single-process deployments.
+* ``sqlite`` keeps them in a local SQLite database in WAL mode, shared by the
+  processes of a single host.
+"""
+import asyncio
+import functools
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+from snappass.capacity import InsufficientCapacity
+
+# Used when the server predates GETDEL (Redis < 6.2).
+GETDEL_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', KEYS[1])
+end
+return value
+"""
+
+# Consume a view of a key: plain values are deleted, values with several
+# views are kept in a hash with their remaining views until the last one.
+TAKE_SCRIPT = """
+if redis.call('TYPE', KEYS[1])['ok'] == 'hash' then
+    local views = redis.call('HINCRBY', KEYS[1], 'views', -1)
+    local value = redis.call('HGET', KEYS[1], 'value')
+    if views <= 0 then
+        redis.call('DEL', KEYS[1])
+    end
+    return {value, views}
+end
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return false
+end
+redis.call('DEL', KEYS[1])
+return {value, 0}
+"""
+
+STORAGE_BACKENDS = ('redis', 'memory', 'sqlite')
+
+
+def _peeked(value, hash_value):
+    # Answers of GET and HGET value, one of them an error for the key's type.
+    for answer in (value, hash_value):
+        if answer is not None and not isinstance(answer, Exception):
+            return answer
+
+
+def _with_views(items):
+    # Items of set_many may leave out their views, one by default.
+    return [item if len(item) == 4 else tuple(item) + (1,) for item in items]
+
+
+def _queue_set(pipe, key, ttl, value, views):
+    # Values with several views are hashes counting them down.
+    if views == 1:
+        pipe.setex(key, ttl, value)
+    else:
+        pipe.hset(key, mapping={'value': value, 'views': views})
+        pipe.expire(key, ttl)
+
+
+def _views(kind, views):
+    # Answers of TYPE and HGET views, the latter an error for plain values.
+    if kind in (b'hash', 'hash'):
+        return int(views or 0)
+    return 0 if kind in (b'none', 'none') else 1
+
+
+def _is_unknown_command(error):
+    # Told by its message, so that redis-py needn't be imported to catch it.
+    return type(error).__name__ == 'ResponseError' and 'unknown command' in str(error).lower()
+
+
+def _drop_strategy(strategies, strategy, lock):
+    """
+    Drop a strategy the server rejected, unless it is the last one or a
+    concurrent caller dropped it already. Return whether another strategy
+    is left to try.
+    """
+    with lock:
+        if strategies[0] is strategy and len(strategies) > 1:
+            strategies.pop(0)
+        return strategies[0] is not strategy
+
+
+class Storage:
+    """
+    Interface shared by the storage backends.
+
+    Keys are strings, values are bytes and TTLs are whole seconds.
+    """
+
+    def set(self, key, ttl, value, views=1):
+        """
+        Store a value that can be taken ``views`` times.
+        """
+        raise NotImplementedError
+
+    def set_many(self, items):
+        """
+        Store several (key, ttl, value) triples, or (key, ttl, value, views)
+        for values that can be taken several times.
+        """
+        for key, ttl, value, views in _with_views(items):
+            self.set(key, ttl, value, views)
+
+    def getdel(self, key):
+        """
+        Atomically fetch and delete a key, returning None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def take(self, key):
+        """
+        Atomically consume a view of a key, returning its value and the views
+        left, or (None, 0) if it doesn't exist. The key is deleted along
+        with its last view.
+        """
+        raise NotImplementedError
+
+    def take_last(self, key):
+        """
+        Consume a key known to have had a single view left, like ``take``
+        but with a single GETDEL.
+        """
+        return self.getdel(key), 0
+
+    def peek(self, key):
+        """
+        Return the value of a key without consuming a view, None if it
+        doesn't exist.
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def views(self, key):
+        """
+        Return the views left of a key, 0 if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def pttl_many(self, keys):
+        """
+        Return the remaining lifetime of each key in milliseconds, with the
+        same conventions as Redis' PTTL: -2 for missing keys.
+        """
+        raise NotImplementedError
+
+    def ping(self):
+        return True
+
+    def reset(self):
+        """
+        Drop the connections inherited from the parent process, after a fork.
+        """
+
+    def close(self):
+        pass
+
+
+class RedisStorage(Storage):
+
+    def __init__(self, client, transactions=True):
+        self.client = client
+        self.transactions = transactions
+        # Ordered from cheapest to most widely supported; a strategy the
+        # server rejects as an unknown command is dropped for good.
+        self.getdel_strategies = [self._getdel_command, self._getdel_script, self._getdel_transaction]
+        self.take_strategies = [self._take_script, self._take_transaction]
+        self._strategies_lock = threading.Lock()
+
+    def set(self, key, ttl, value, views=1):
+        if views == 1:
+            self.client.setex(key, ttl, value)
+            return
+        self.set_many([(key, ttl, value, views)])
+
+    def set_many(self, items):
+        pipe = self.client.pipeline(transaction=self.transactions)
+        for key, ttl, value, views in _with_views(items):
+            _queue_set(pipe, key, ttl, value, views)
+        pipe.execute()
+
+    def _getdel_command(self, key):
+        return self.client.getdel(key)
+
+    def _getdel_script(self, key):
+        # register_script is cheap (it only hashes the source); the script is
+        # loaded server-side on first use and run through EVALSHA afterwards.
+        return self.client.register_script(GETDEL_SCRIPT)(keys=[key])
+
+    def _getdel_transaction(self, key):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(key)
+        pipe.delete(key)
+        return pipe.execute()[0]
+
+    def getdel(self, key):
+        return self._run(self.getdel_strategies, key)
+
+    def _take_script(self, key):
+        result = self.client.register_script(TAKE_SCRIPT)(keys=[key])
+        return (None, 0) if result is None else (result[0], int(result[1]))
+
+    def _take_transaction(self, key):
+        # For servers without scripting: WATCH makes the transaction fail,
+        # and be retried, if another reader took a view meanwhile.
+        views_left = []
+
+        def take(pipe):
+            views_left.clear()
+            if pipe.type(key) in (b'hash', 'hash'):
+                views = int(pipe.hget(key, 'views')) - 1
+                views_left.append(max(views, 0))
+                pipe.multi()
+                pipe.hget(key, 'value')
+                if views > 0:
+                    pipe.hset(key, 'views', views)
+                else:
+                    pipe.delete(key)
+            else:
+                pipe.multi()
+                pipe.get(key)
+                pipe.delete(key)
+
+        value = self.client.transaction(take, key)[0]
+        if value is None:
+            return None, 0
+        return value, views_left[0] if views_left else 0
+
+    def take(self, key):
+        return self._run(self.take_strategies, key)
+
+    def take_last(self, key):
+        try:
+            return self.getdel(key), 0
+        except Exception as e:
+            # The last view of a secret created with several is still a hash.
+            if 'WRONGTYPE' not in str(e):
+                raise
+            return self.take(key)
+
+    def _run(self, strategies, key):
+        while True:
+            strategy = strategies[0]
+            try:
+                return strategy(key)
+            except Exception as e:
+                if not _is_unknown_command(e) or not _drop_strategy(strategies, strategy, self._strategies_lock):
+                    raise
+
+    def peek(self, key):
+        # One round trip: GET fails with WRONGTYPE on secrets with several
+        # views, HGET on the others.
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.hget(key, 'value')
+        return _peeked(*pipe.execute(raise_on_error=False))
+
+    def exists(self, key):
+        return bool(self.client.exists(key))
+
+    def views(self, key):
+        # One round trip: HGET fails with WRONGTYPE on single view secrets.
+        pipe = self.client.pipeline(transaction=False)
+        pipe.type(key)
+        pipe.hget(key, 'views')
+        return _views(*pipe.execute(raise_on_error=False))
+
+    def pttl_many(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.pttl(key)
+        return pipe.execute()
+
+    def ping(self):
+        return self.client.ping()
+
+    def reset(self):
+        pool = getattr(self.client, 'connection_pool', None)
+        if pool is not None:
+            pool.reset()
+        elif hasattr(self.client, 'disconnect_connection_pools'):
+            # Redis Cluster keeps a pool per node.
+            self.client.disconnect_connection_pools()
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStorage(Storage):
+    """
+    In-process storage holding at most ``max_bytes`` of keys and values.
+
+    Expiry times are kept in a heap, so expired secrets are dropped in
+    order without scanning every key.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._values = {}
+        # Views left of the keys stored with several
+        self._views = {}
+        self._expiry = []
+        self._lock = threading.Lock()
+
+    def _forget(self, key):
+        expires_at, value = self._values.pop(key)
+        self._views.pop(key, None)
+        self.size -= len(key) + len(value)
+        return value
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry)
+            entry = self._values.get(key)
+            # The key may have been consumed or overwritten since.
+            if entry is not None and entry[0] == expires_at:
+                self._forget(key)
+        # Consumed keys leave stale heap entries behind until they would have
+        # expired; rebuild the heap if they start to dominate it.
+        if len(self._expiry) > 2 * len(self._values) + 1024:
+            self._expiry = [(expires_at, key) for key, (expires_at, value) in self._values.items()]
+            heapq.heapify(self._expiry)
+
+    def _get(self, key, now):
+        entry = self._values.get(key)
+        if entry is not None and entry[0] > now:
+            return entry
+
+    def _full(self, now):
+        # Room is made as soon as the next secret expires.
+        retry_after = self._expiry[0][0] - now if self._expiry else 0
+        return InsufficientCapacity(max(retry_after, 1))
+
+    def _set(self, key, ttl, value, now):
+        if key in self._values:
+            self._forget(key)
+        if self.size + len(key) + len(value) > self.max_bytes:
+            raise self._full(now)
+        expires_at = now + ttl
+        self._values[key] = (expires_at, value)
+        self.size += len(key) + len(value)
+        heapq.heappush(self._expiry, (expires_at, key))
+
+    def set(self, key, ttl, value, views=1):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._set(key, ttl, value, now)
+            if views > 1:
+                self._views[key] = views
+
+    def set_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            items = _with_views(items)
+            needed = sum(len(key) + len(value) for key, ttl, value, views in items)
+            if self.size + needed > self.max_bytes:
+                raise self._full(now)
+            for key, ttl, value, views in items:
+                self._set(key, ttl, value, now)
+                if views > 1:
+                    self._views[key] = views
+
+    def getdel(self, key):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if self._get(key, now) is not None:
+                return self._forget(key)
+
+    def take(self, key):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._get(key, now)
+            if entry is None:
+                return None, 0
+            views = self._views.get(key, 1) - 1
+            if views <= 0:
+                return self._forget(key), 0
+            self._views[key] = views
+            return entry[1], views
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._get(key, time.time())
+            return None if entry is None else entry[1]
+
+    def exists(self, key):
+        with self._lock:
+            return self._get(key, time.time()) is not None
+
+    def views(self, key):
+        with self._lock:
+            if self._get(key, time.time()) is None:
+                return 0
+            return self._views.get(key, 1)
+
+    def pttl_many(self, keys):
+        now = time.time()
+        with self._lock:
+            entries = [self._get(key, now) for key in keys]
+        return [-2 if entry is None else int((entry[0] - now) * 1000) for entry in entries]
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local SQLite database, in WAL mode so readers never wait
+    for writers.
+
+    Expired rows are never returned, and are deleted in bulk at most every
+    ``sweep_interval`` seconds using the index on their expiry time.
+    """
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = 0
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS secrets (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                views INTEGER NOT NULL DEFAULT 1
+            );
+            CREATE INDEX IF NOT EXISTS secrets_expires_at ON secrets (expires_at);
+        """)
+        columns = [row[1] for row in self._connect().execute('PRAGMA table_info(secrets)')]
+        if 'views' not in columns:
+            # Databases created before secrets could have several views
+            self._connect().execute('ALTER TABLE secrets ADD COLUMN views INTEGER NOT NULL DEFAULT 1')
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit mode: transactions are opened explicitly.
+            connection = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _sweep(self, connection, now):
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            connection.execute('DELETE FROM secrets WHERE expires_at <= ?', (now,))
+
+    def set(self, key, ttl, value, views=1):
+        self.set_many([(key, ttl, value, views)])
+
+    def set_many(self, items):
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._sweep(connection, now)
+            connection.executemany(
+                'INSERT OR REPLACE INTO secrets (key, value, expires_at, views) VALUES (?, ?, ?, ?)',
+                [(key, value, now + ttl, views) for key, ttl, value, views in _with_views(items)])
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def getdel(self, key):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value, expires_at FROM secrets WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                connection.execute('DELETE FROM secrets WHERE key = ?', (key,))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        if row is not None and row[1] > time.time():
+            return bytes(row[0])
+
+    def take(self, key):
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value, views FROM secrets WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is not None:
+                if row[1] > 1:
+                    connection.execute('UPDATE secrets SET views = views - 1 WHERE key = ?', (key,))
+                else:
+                    connection.execute('DELETE FROM secrets WHERE key = ?', (key,))
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        if row is None:
+            return None, 0
+        return bytes(row[0]), max(row[1] - 1, 0)
+
+    def peek(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM secrets WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def exists(self, key):
+        row = self._connect().execute(
+            'SELECT 1 FROM secrets WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return row is not None
+
+    def views(self, key):
+        row = self._connect().execute(
+            'SELECT views FROM secrets WHERE key = ? AND expires_at > ?', (key, time.time())).fetchone()
+        return 0 if row is None else row[0]
+
+    def pttl_many(self, keys):
+        now = time.time()
+        connection = self._connect()
+        expiries = {}
+        for key in set(keys):
+            row = connection.execute(
+                'SELECT expires_at FROM secrets WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is not None:
+                expiries[key] = row[0]
+        return [int((expiries[key] - now) * 1000) if key in expiries else -2 for key in keys]
+
+    def ping(self):
+        self._connect().execute('SELECT 1')
+        return True
+
+    def reset(self):
+        # SQLite connections must not be used across a fork, not even closed.
+        self._local = threading.local()
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class AsyncRedisStorage:
+    """
+    :class:`RedisStorage` on top of a ``redis.asyncio`` client.
+    """
+
+    def __init__(self, client, transactions=True):
+        self.client = client
+        self.transactions = transactions
+        self.getdel_strategies = [self._getdel_command, self._getdel_script, self._getdel_transaction]
+        self.take_strategies = [self._take_script, self._take_transaction]
+        self._strategies_lock = threading.Lock()
+
+    async def set(self, key, ttl, value, views=1):
+        if views == 1:
+            await self.client.setex(key, ttl, value)
+            return
+        await self.set_many([(key, ttl, value, views)])
+
+    async def set_many(self, items):
+        async with self.client.pipeline(transaction=self.transactions) as pipe:
+            for key, ttl, value, views in _with_views(items):
+                _queue_set(pipe, key, ttl, value, views)
+            await pipe.execute()
+
+    async def _getdel_command(self, key):
+        return await self.client.getdel(key)
+
+    async def _getdel_script(self, key):
+        return await self.client.register_script(GETDEL_SCRIPT)(keys=[key])
+
+    async def _getdel_transaction(self, key):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.get(key)
+            pipe.delete(key)
+            return (await pipe.execute())[0]
+
+    async def getdel(self, key):
+        return await self._run(self.getdel_strategies, key)
+
+    async def _take_script(self, key):
+        result = await self.client.register_script(TAKE_SCRIPT)(keys=[key])
+        return (None, 0) if result is None else (result[0], int(result[1]))
+
+    async def _take_transaction(self, key):
+        views_left = []
+
+        async def take(pipe):
+            views_left.clear()
+            if await pipe.type(key) in (b'hash', 'hash'):
+                views = int(await pipe.hget(key, 'views')) - 1
+                views_left.append(max(views, 0))
+                pipe.multi()
+                pipe.hget(key, 'value')
+                if views > 0:
+                    pipe.hset(key, 'views', views)
+                else:
+                    pipe.delete(key)
+            else:
+                pipe.multi()
+                pipe.get(key)
+                pipe.delete(key)
+
+        value = (await self.client.transaction(take, key))[0]
+        if value is None:
+            return None, 0
+        return value, views_left[0] if views_left else 0
+
+    async def take(self, key):
+        return await self._run(self.take_strategies, key)
+
+    async def take_last(self, key):
+        try:
+            return await self.getdel(key), 0
+        except Exception as e:
+            if 'WRONGTYPE' not in str(e):
+                raise
+            return await self.take(key)
+
+    async def _run(self, strategies, key):
+        while True:
+            strategy = strategies[0]
+            try:
+                return await strategy(key)
+            except Exception as e:
+                if not _is_unknown_command(e) or not _drop_strategy(strategies, strategy, self._strategies_lock):
+                    raise
+
+    async def peek(self, key):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.hget(key, 'value')
+            return _peeked(*await pipe.execute(raise_on_error=False))
+
+    async def exists(self, key):
+        return bool(await self.client.exists(key))
+
+    async def views(self, key):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.type(key)
+            pipe.hget(key, 'views')
+            return _views(*await pipe.execute(raise_on_error=False))
+
+    async def pttl_many(self, keys):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.pttl(key)
+            return await pipe.execute()
+
+    async def ping(self):
+        return await self.client.ping()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+async def run_in_thread(func, *args):
+    """
+    Run a blocking call on a worker thread of the event loop's default
+    executor, as ``asyncio.to_thread`` does from Python 3.9 on.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+class ThreadedStorage:
+    """
+    Expose a blocking :class:`Storage` to asyncio code by running each call
+    on a worker thread.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args):
+            return await run_in_thread(method, *args)
+
+        return call
+
+
+def storage_backend(environ=None):
+    environ = os.environ if environ is None else environ
+    backend = environ.get('SNAPPASS_STORAGE', 'redis').lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError('Unknown SNAPPASS_STORAGE %r, expected one of %s' % (backend, ', '.join(STORAGE_BACKENDS)))
+    return backend
+
+
+def create_storage(redis_client, transactions=True, environ=None):
+    """
+    Create the storage backend selected by ``SNAPPASS_STORAGE``.
+    """
+    environ = os.environ if environ is None else environ
+    backend = storage_backend(environ)
+    if backend == 'memory':
+        return MemoryStorage(int(environ.get('SNAPPASS_STORAGE_MAX_BYTES', 64 * 1024 * 1024)))
+    if backend == 'sqlite':
+        return SQLiteStorage(environ.get('SNAPPASS_STORAGE_PATH', 'snappass.sqlite3'),
+                             int(environ.get('SNAPPASS_STORAGE_SWEEP_INTERVAL', 60)))
+    return RedisStorage(redis_client, transactions)
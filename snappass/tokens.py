@@ -0,0 +1,116 @@
+"""
+Compact, self-checking tokens.
+
+A token holds everything needed to find and decrypt a secret: the parts of
+its storage key and, unless it was encrypted in the browser, its key.
+Version 1 tokens pack them into unpadded url-safe base64, so that links
+need no escaping::
+
+    <version (high nibble) and flags (low nibble): 1 byte>
+    [<tenant length: 1 byte><tenant><shard length: 1 byte><shard>]
+    <uuid: 16 bytes>
+    [<key: 16 bytes compact, or 32 bytes of a Fernet key>]
+    <tag: 6 bytes>
+
+The tag is a truncated HMAC-SHA256 of the rest, keyed from ``SECRET_KEY``:
+malformed, truncated or forged tokens are told apart locally, without a
+round trip to Redis. Changing ``SECRET_KEY`` invalidates the tokens
+handed out before.
+"""
+import base64
+import binascii
+import functools
+import hashlib
+import hmac
+import re
+
+from snappass.crypto import SECRET_KEY_SIZE
+from snappass.sharding import StorageKey
+
+VERSION = 1
+TAG_SIZE = 6
+UUID_SIZE = 16
+
+FILE = 0x1
+LOCATION = 0x2
+KEY_KIND = 0xc
+# Kinds of keys: none for secrets encrypted in the browser, compact or Fernet
+NO_KEY = 0x0
+COMPACT_KEY = 0x4
+FERNET_KEY = 0x8
+KEY_SIZES = {NO_KEY: 0, COMPACT_KEY: SECRET_KEY_SIZE, FERNET_KEY: 32}
+
+TOKEN = re.compile(r'^[A-Za-z0-9_-]{%d,}$' % ((1 + UUID_SIZE + TAG_SIZE) * 4 // 3))
+
+
+@functools.lru_cache(maxsize=8)
+def _tag_key(secret):
+    return hashlib.sha256(b'snappass-token\0' + secret.encode('utf-8')).digest()
+
+
+def _tag(secret, body):
+    return hmac.new(_tag_key(secret), body, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def _name(name):
+    name = name.encode('ascii')
+    return bytes([len(name)]) + name
+
+
+def _read_name(body, offset):
+    size = body[offset] if offset < len(body) else 0
+    return body[offset + 1:offset + 1 + size].decode('ascii') or None, offset + 1 + size
+
+
+def encode_token(secret, storage_key, key):
+    """
+    Encode a :class:`StorageKey` and the key of its secret (bytes: compact,
+    base64 Fernet, or None) into a token.
+    """
+    flags = FILE if storage_key.file else 0
+    location = b''
+    if storage_key.tenant or storage_key.shard:
+        flags |= LOCATION
+        location = _name(storage_key.tenant or '') + _name(storage_key.shard or '')
+    if key is None:
+        key = b''
+    elif len(key) != KEY_SIZES[COMPACT_KEY]:
+        key = base64.urlsafe_b64decode(key)
+    flags |= {size: kind for kind, size in KEY_SIZES.items()}[len(key)]
+    body = bytes([VERSION << 4 | flags]) + location + bytes.fromhex(storage_key.uuid) + key
+    return base64.urlsafe_b64encode(body + _tag(secret, body)).rstrip(b'=').decode('ascii')
+
+
+def decode_token(secret, token):
+    """
+    Return the :class:`StorageKey` and key of a token, or None if it isn't
+    a genuine version 1 token.
+    """
+    if not TOKEN.match(token):
+        return None
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    # The last character may carry unused bits: only one spelling is genuine.
+    if base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii') != token:
+        return None
+    body, tag = data[:-TAG_SIZE], data[-TAG_SIZE:]
+    if not body or body[0] >> 4 != VERSION or not hmac.compare_digest(tag, _tag(secret, body)):
+        return None
+
+    flags, offset = body[0], 1
+    tenant = shard = None
+    if flags & LOCATION:
+        tenant, offset = _read_name(body, offset)
+        shard, offset = _read_name(body, offset)
+    key_size = KEY_SIZES.get(flags & KEY_KIND)
+    if key_size is None or len(body) != offset + UUID_SIZE + key_size:
+        return None
+    uuid_hex = body[offset:offset + UUID_SIZE].hex()
+    key = body[offset + UUID_SIZE:]
+    if flags & KEY_KIND == NO_KEY:
+        key = None
+    elif flags & KEY_KIND == FERNET_KEY:
+        key = base64.urlsafe_b64encode(key)
+    return StorageKey(tenant, shard, bool(flags & FILE), uuid_hex), key
@@ -1,4 +1,16 @@
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
 import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import tempfile
 import time
 import unittest
 import uuid
@@ -10,14 +22,49 @@ from urllib.parse import unquote
 from cryptography.fernet import Fernet
 from freezegun import freeze_time
 from werkzeug.exceptions import BadRequest
+import redis
+import redis.asyncio
 from fakeredis import FakeStrictRedis
+from prometheus_client import CollectorRegistry
+from redis.exceptions import ResponseError
 
 # noinspection PyPep8Naming
 import snappass.main as snappass
+import benchmarks.files
+import benchmarks.keys
+import benchmarks.load
+import benchmarks.startup
+import snappass.asgi as snappass_asgi
+import snappass.events as snappass_events
+import snappass.redis_config as redis_config
+import snappass.server as server
+from snappass import assets
+from snappass.events import EventPublisher, expired_key, export_events, listen_expiries
+from snappass.capacity import ACCEPTED, REJECTED, SHORTENED, CapacityMonitor, InsufficientCapacity
+from snappass.health import ReadinessProbe
+from snappass.sharding import HashRing, ShardedStorage, StorageKey, build_key, parse_key
+from snappass.tokens import decode_token, encode_token
+from snappass.metrics import Metrics
+from snappass.negative import BloomFilter, NegativeCache
+from snappass.ratelimit import LocalBuckets, RateLimiter, RedisBuckets, create_rate_limiter, parse_limits
+from snappass.storage import MemoryStorage, RedisStorage, SQLiteStorage, ThreadedStorage, create_storage
+from snappass.crypto import ENVELOPE, RAW, RAW_ZLIB, SECRET_KEY_SIZE, CryptoBusy, CryptoExecutor, MasterKeys, \
+    decrypt_bytes, encrypt_bytes, unpack
+from snappass.files import CorruptFile, FileTooLarge, chunk_key, open_file, store_file
 
 __author__ = 'davedash'
 
 
+def patch_service(name, new=mock.DEFAULT):
+    """
+    Patch a backend of the default application, built first so the original
+    is restored rather than built again.
+    """
+    services = snappass.current_services()
+    getattr(services, name)
+    return mock.patch.object(services, name, new)
+
+
 class SnapPassTestCase(TestCase):
 
     @mock.patch('redis.client.StrictRedis', FakeStrictRedis)
@@ -31,32 +78,79 @@ class SnapPassTestCase(TestCase):
     def test_password_is_not_stored_in_plaintext(self):
         password = "trustno1"
         token = snappass.set_password(password, 30)
-        redis_key = token.split(snappass.TOKEN_SEPARATOR)[0]
-        stored_password_text = snappass.redis_client.get(redis_key).decode('utf-8')
-        self.assertNotIn(password, stored_password_text)
+        redis_key = snappass.parse_token(token)[0]
+        stored_password = snappass.redis_client.get(redis_key)
+        self.assertNotIn(password.encode('utf-8'), stored_password)
 
     def test_returned_token_format(self):
         password = "trustsome1"
         token = snappass.set_password(password, 30)
-        token_fragments = token.split(snappass.TOKEN_SEPARATOR)
-        self.assertEqual(2, len(token_fragments))
-        redis_key, encryption_key = token_fragments
-        self.assertEqual(32 + len(snappass.REDIS_PREFIX), len(redis_key))
+        # Compact tokens need no escaping in links.
+        self.assertRegex(token, r'^[A-Za-z0-9_-]{74}$')
+        redis_key, encryption_key = snappass.parse_token(token)
+        self.assertEqual(32 + len(snappass.app.config['REDIS_PREFIX']), len(redis_key))
         try:
-            Fernet(encryption_key.encode('utf-8'))
+            Fernet(encryption_key)
         except ValueError:
             self.fail('the encryption key is not valid')
 
     def test_encryption_key_is_returned(self):
         password = "trustany1"
         token = snappass.set_password(password, 30)
-        token_fragments = token.split(snappass.TOKEN_SEPARATOR)
-        redis_key, encryption_key = token_fragments
+        redis_key, encryption_key = snappass.parse_token(token)
         stored_password = snappass.redis_client.get(redis_key)
-        fernet = Fernet(encryption_key.encode('utf-8'))
-        decrypted_password = fernet.decrypt(stored_password).decode('utf-8')
+        fernet = Fernet(encryption_key)
+        decrypted_password = fernet.decrypt(unpack(stored_password)[1]).decode('utf-8')
         self.assertEqual(password, decrypted_password)
 
+    def test_secrets_are_stored_as_raw_bytes(self):
+        password = "p" * 100
+        token = snappass.set_password(password, 30)
+        stored_password = snappass.redis_client.get(snappass.parse_token(token)[0])
+        base64_token = unpack(stored_password)[1]
+        self.assertEqual(RAW, stored_password[:1])
+        self.assertEqual(len(stored_password), len(base64.urlsafe_b64decode(base64_token)) + 1)
+        self.assertLess(len(stored_password), len(base64_token))
+
+    def test_large_secrets_are_compressed(self):
+        password = "SOME_SETTING=value\n" * 1000
+        token = snappass.set_password(password, 30)
+        stored_password = snappass.redis_client.get(snappass.parse_token(token)[0])
+        self.assertEqual(RAW_ZLIB, stored_password[:1])
+        self.assertLess(len(stored_password), len(password) / 10)
+        self.assertEqual(password, snappass.get_password(token))
+
+        with mock.patch.dict(snappass.app.config, {'SNAPPASS_COMPRESS_THRESHOLD': 0}):
+            token = snappass.set_password(password, 30)
+        self.assertEqual(RAW, snappass.redis_client.get(snappass.parse_token(token)[0])[:1])
+
+    def test_incompressible_secrets_are_not_compressed(self):
+        data = os.urandom(2048)
+        encrypted, key = encrypt_bytes(data, 1024)
+        self.assertEqual(RAW, encrypted[:1])
+        self.assertEqual(data, decrypt_bytes(encrypted, key))
+
+    def test_base64_fernet_tokens_still_work(self):
+        encryption_key = Fernet.generate_key()
+        storage_key = snappass.new_storage_key()
+        snappass.redis_client.setex(storage_key, 30, Fernet(encryption_key).encrypt(b'stored before'))
+        self.assertEqual('stored before', snappass.get_password(snappass.make_token(storage_key, encryption_key)))
+
+    def test_forged_tokens_are_rejected_locally(self):
+        token = snappass.set_password('genuine', 30)
+        forged = token[:-1] + ('A' if token[-1] != 'A' else 'B')
+        with patch_service('storage') as storage:
+            for bogus in (forged, token[:-4], 'wp-login.php', 'snappass' + 'z' * 32,
+                          snappass.parse_token(token)[0] + ':0', 'snappass' + uuid.uuid4().hex + '~notakey'):
+                self.assertEqual((None, None), snappass.parse_token(bogus))
+                self.assertIsNone(snappass.get_password(bogus))
+                self.assertFalse(snappass.password_exists(bogus))
+            self.assertEqual([None], snappass.passwords_ttl([forged]))
+        storage.take.assert_not_called()
+        storage.exists.assert_not_called()
+        storage.pttl_many.assert_called_once_with([])
+        self.assertEqual('genuine', snappass.get_password(token))
+
     def test_unencrypted_passwords_still_work(self):
         unencrypted_password = "trustevery1"
         storage_key = uuid.uuid4().hex
@@ -64,11 +158,93 @@ class SnapPassTestCase(TestCase):
         retrieved_password = snappass.get_password(storage_key)
         self.assertEqual(unencrypted_password, retrieved_password)
 
+    def test_get_password_is_one_time_under_concurrency(self):
+        password = "only one of you gets this"
+        key = snappass.set_password(password, 30)
+        results = []
+        barrier = threading.Barrier(16)
+
+        def reveal():
+            barrier.wait()
+            results.append(snappass.get_password(key))
+
+        threads = [threading.Thread(target=reveal) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([password], [r for r in results if r is not None])
+        self.assertEqual(15, results.count(None))
+
+    def test_getdel_falls_back_when_command_is_unknown(self):
+        unknown = ResponseError("unknown command 'GETDEL'")
+        storage = RedisStorage(snappass.redis_client)
+        with mock.patch.object(snappass.redis_client, 'getdel', side_effect=unknown):
+            storage.set('old-redis', 30, b'same semantics')
+            self.assertEqual(b'same semantics', storage.getdel('old-redis'))
+            self.assertIsNone(storage.getdel('old-redis'))
+            self.assertEqual([storage._getdel_transaction], storage.getdel_strategies)
+
     def test_password_is_decoded(self):
         password = "correct horse battery staple"
         key = snappass.set_password(password, 30)
         self.assertFalse(isinstance(snappass.get_password(key), bytes))
 
+    def test_crypto_executor_offloads_above_threshold(self):
+        executor = CryptoExecutor('thread', max_workers=2, threshold=16)
+        self.addCleanup(executor.shutdown)
+        with patch_service('crypto_executor', executor):
+            password = "x" * 64
+            key = snappass.set_password(password, 30)
+            self.assertIsNotNone(executor._executor)
+            self.assertEqual(password, snappass.get_password(key))
+
+    def test_crypto_executor_runs_small_payloads_inline(self):
+        executor = CryptoExecutor('thread', threshold=1024)
+        with patch_service('crypto_executor', executor):
+            key = snappass.set_password("short", 30)
+            self.assertEqual("short", snappass.get_password(key))
+        self.assertIsNone(executor._executor)
+
+    def test_crypto_executor_keeps_large_payloads_off_the_event_loop(self):
+        executor = CryptoExecutor(threshold=16)
+
+        def current_thread(data):
+            return threading.current_thread()
+
+        self.assertIs(threading.main_thread(), asyncio.run(executor.run_async(current_thread, 15, b'')))
+        self.assertIsNot(threading.main_thread(), asyncio.run(executor.run_async(current_thread, 16, b'')))
+        self.assertIs(threading.main_thread(), executor.run(current_thread, 16, b''))
+
+    def test_crypto_process_executor(self):
+        executor = CryptoExecutor('process', max_workers=1)
+        self.addCleanup(executor.shutdown)
+        encrypted, key = executor.run(encrypt_bytes, 6, b'secret')
+        self.assertEqual(b'secret', executor.run(decrypt_bytes, len(encrypted), encrypted, key))
+
+    def test_crypto_executor_rejects_when_saturated(self):
+        executor = CryptoExecutor('thread', max_workers=1, max_pending=2)
+        release = threading.Event()
+        for _ in range(2):
+            executor._submit(release.wait)
+        self.assertRaises(CryptoBusy, executor.run, encrypt_bytes, 6, b'secret')
+        release.set()
+        # Waits for the jobs to give their slots back
+        executor.shutdown()
+        self.assertEqual(b'secret', decrypt_bytes(*executor.run(encrypt_bytes, 6, b'secret')))
+        executor.shutdown()
+
+    def test_crypto_executor_needs_a_pending_slot(self):
+        self.assertRaises(ValueError, CryptoExecutor, 'thread', max_pending=0)
+        services = snappass.create_app({'SNAPPASS_CRYPTO_EXECUTOR': 'thread',
+                                        'SNAPPASS_CRYPTO_MAX_PENDING': '0'}).extensions['snappass']
+        with self.assertRaises(ValueError):
+            services.crypto_executor
+
+    def test_unknown_crypto_executor(self):
+        self.assertRaises(ValueError, CryptoExecutor, 'fibers')
+
     def test_clean_input(self):
         # Test Bad Data
         with snappass.app.test_request_context(
@@ -101,6 +277,83 @@ class SnapPassTestCase(TestCase):
         self.assertIsNone(snappass.get_password(key))
 
 
+def master_key(key_id):
+    return key_id + ':' + base64.urlsafe_b64encode(os.urandom(32)).decode('ascii')
+
+
+class EnvelopeEncryptionTestCase(TestCase):
+
+    def setUp(self):
+        self.old_key = master_key('old')
+        self.new_key = master_key('new')
+        self.app = snappass.create_app({'SNAPPASS_MASTER_KEYS': self.old_key})
+        self.app.config['TESTING'] = True
+        self.client = self.app.test_client()
+
+    def test_short_tokens(self):
+        with self.app.app_context():
+            token = snappass.set_password('enveloped', 30)
+            self.assertRegex(token, r'^[A-Za-z0-9_-]{52}$')
+            storage_key, secret_key = snappass.parse_token(token)
+            self.assertEqual(SECRET_KEY_SIZE, len(secret_key))
+            stored = self.app.extensions['snappass'].storage.client.get(storage_key)
+            self.assertEqual(ENVELOPE + b'\x03old' + RAW, stored[:6])
+            self.assertNotIn(b'enveloped', stored)
+            self.assertEqual('enveloped', snappass.get_password(token))
+
+    def test_routes(self):
+        rv = self.client.post('/api/v2/passwords', json={'password': 'enveloped'})
+        token = rv.get_json()['token']
+        self.assertEqual(52, len(token))
+        self.assertEqual(200, self.client.head('/api/v2/passwords/' + token).status_code)
+        self.assertEqual('enveloped', self.client.get('/api/v2/passwords/' + token).get_json()['password'])
+
+    def test_legacy_tokens_still_work(self):
+        with self.app.app_context():
+            with mock.patch.object(self.app.extensions['snappass'], 'master_keys', None):
+                storage_key, key = snappass.parse_token(snappass.set_password('legacy', 30))
+            legacy = storage_key + snappass.TOKEN_SEPARATOR + key.decode('ascii')
+        self.assertEqual('legacy', self.client.get('/api/v2/passwords/' + quote(legacy)).get_json()['password'])
+
+    def test_bare_keys_of_server_encrypted_secrets(self):
+        with self.app.app_context():
+            tokens = [snappass.set_password('enveloped', 30)]
+            with mock.patch.object(self.app.extensions['snappass'], 'master_keys', None):
+                tokens.append(snappass.set_password('raw', 30))
+            bare_keys = [snappass.parse_token(token)[0] for token in tokens]
+        for bare_key in bare_keys:
+            self.assertEqual(404, self.client.get('/api/v2/passwords/' + quote(bare_key)).status_code)
+            self.assertEqual(404, self.client.post('/' + quote(bare_key)).status_code)
+        # The secrets were left alone.
+        self.assertEqual('enveloped', self.client.get('/api/v2/passwords/' + tokens[0]).get_json()['password'])
+        self.assertEqual('raw', self.client.get('/api/v2/passwords/' + tokens[1]).get_json()['password'])
+
+    def test_legacy_tokens_with_colon_in_prefix(self):
+        app = snappass.create_app({'SNAPPASS_STORAGE': 'memory', 'REDIS_PREFIX': 'snappass:'})
+        with app.app_context():
+            storage_key = 'snappass:' + uuid.uuid4().hex
+            app.extensions['snappass'].storage.set(storage_key, 30, b'stored before', 1)
+            self.assertEqual((storage_key, None), snappass.parse_token(storage_key))
+            self.assertEqual((None, None), snappass.parse_token(storage_key + ':0'))
+            self.assertEqual('stored before', snappass.get_password(storage_key))
+
+    def test_master_key_rotation(self):
+        old = MasterKeys.parse(self.old_key)
+        encrypted, secret_key = old.encrypt(b'secret')
+        rotated = MasterKeys.parse(self.new_key + ',' + self.old_key)
+        self.assertEqual('new', rotated.current_id)
+        self.assertEqual(b'secret', decrypt_bytes(encrypted, secret_key, rotated))
+        self.assertEqual(b'\x03new', rotated.encrypt(b'secret')[0][1:5])
+        self.assertRaises(ValueError, decrypt_bytes, encrypted, secret_key, MasterKeys.parse(self.new_key))
+        self.assertRaises(ValueError, decrypt_bytes, encrypted, secret_key)
+
+    def test_invalid_master_keys(self):
+        self.assertRaises(ValueError, MasterKeys.parse, '')
+        self.assertRaises(ValueError, MasterKeys.parse, 'no-id')
+        self.assertRaises(ValueError, MasterKeys.parse, 'short:' + base64.urlsafe_b64encode(b'x' * 16).decode())
+        self.assertRaises(ValueError, MasterKeys.parse, 'bad id:' + base64.urlsafe_b64encode(b'x' * 32).decode())
+
+
 class SnapPassRoutesTestCase(TestCase):
     # noinspection PyPep8Naming
     def setUp(self):
@@ -124,10 +377,40 @@ class SnapPassRoutesTestCase(TestCase):
         rv = self.app.post('/{0}'.format(key))
         self.assertIn(password, rv.get_data(as_text=True))
 
+    def test_show_password_with_preview_nonce(self):
+        key = snappass.set_password('revealed once', 30)
+        cookie = snappass.reveal_nonce_cookie(key)
+        metrics = Metrics(CollectorRegistry())
+        with patch_service('metrics', metrics):
+            self.app.get('/{0}'.format(quote(key)))
+            self.assertIsNotNone(self.app.get_cookie(cookie))
+            rv = self.app.post('/{0}'.format(quote(key)))
+        self.assertIn('revealed once', rv.get_data(as_text=True))
+        self.assertIsNone(self.app.get_cookie(cookie))
+        self.assertEqual(1, metrics.registry.get_sample_value('snappass_reveal_nonces_total', {'result': 'valid'}))
+        self.assertEqual(1, metrics.registry.get_sample_value(
+            'snappass_storage_command_duration_seconds_count', {'command': 'take_last'}))
+        self.assertIsNone(metrics.registry.get_sample_value(
+            'snappass_storage_command_duration_seconds_count', {'command': 'take'}))
+
+    def test_show_password_with_forged_nonce(self):
+        key = snappass.set_password('revealed once', 30)
+        other = snappass.set_password('another one', 30)
+        self.app.get('/{0}'.format(quote(other)))
+        self.app.set_cookie(snappass.reveal_nonce_cookie(key), self.app.get_cookie(
+            snappass.reveal_nonce_cookie(other)).value)
+        metrics = Metrics(CollectorRegistry())
+        with patch_service('metrics', metrics):
+            rv = self.app.post('/{0}'.format(quote(key)))
+        self.assertIn('revealed once', rv.get_data(as_text=True))
+        self.assertEqual(1, metrics.registry.get_sample_value('snappass_reveal_nonces_total', {'result': 'invalid'}))
+        self.assertEqual(1, metrics.registry.get_sample_value(
+            'snappass_storage_command_duration_seconds_count', {'command': 'take'}))
+
     def test_url_prefix(self):
         password = "I like novelty kitten statues!"
-        snappass.URL_PREFIX = "/test/prefix"
-        rv = self.app.post('/', data={'password': password, 'ttl': 'hour'})
+        with mock.patch.dict(snappass.app.config, {'URL_PREFIX': "/test/prefix"}):
+            rv = self.app.post('/', data={'password': password, 'ttl': 'hour'})
         self.assertIn("localhost/test/prefix/", rv.get_data(as_text=True))
 
     def test_set_password(self):
@@ -286,6 +569,102 @@ class SnapPassRoutesTestCase(TestCase):
         bad_ttl = invalid_params[1]
         self.assertEqual(bad_ttl['name'], 'ttl')
 
+    def test_set_passwords_api_v2_batch(self):
+        passwords = ['first secret', 'second secret', 'third secret']
+        rv = self.app.post(
+            '/api/v2/passwords/batch',
+            json=[{'password': passwords[0]},
+                  {'password': passwords[1], 'ttl': 60},
+                  {'password': passwords[2], 'ttl': '3600'}],
+        )
+        self.assertEqual(rv.status_code, 200)
+
+        json_content = rv.get_json()
+        self.assertEqual([1209600, 60, 3600], [item['ttl'] for item in json_content])
+        for password, item in zip(passwords, json_content):
+            self.assertTrue(item['links'][0]['href'].startswith('https://localhost/api/v2/passwords/'))
+            self.assertEqual(password, snappass.get_password(item['token']))
+
+    def test_set_passwords_api_v2_batch_views(self):
+        rv = self.app.post('/api/v2/passwords/batch', json=[{'password': 'shared', 'views': 2}, {'password': 'once'}])
+        self.assertEqual(rv.status_code, 200)
+        shared, once = rv.get_json()
+        self.assertEqual([2, 1], [shared['views'], once['views']])
+        self.assertEqual(2, snappass.password_views(shared['token']))
+        self.assertEqual(('shared', 1), snappass.take_password(shared['token']))
+        self.assertEqual(('shared', 0), snappass.take_password(shared['token']))
+        self.assertEqual(('once', 0), snappass.take_password(once['token']))
+
+    def test_connection_errors_answer_500(self):
+        token = quote(snappass.set_password('unreachable', 30))
+        storage = mock.Mock()
+        storage.views.side_effect = storage.take.side_effect = redis.exceptions.ConnectionError('refused')
+        with patch_service('storage', storage), mock.patch('sys.stdout', io.StringIO()) as stdout:
+            self.assertEqual(500, self.app.head('/api/v2/passwords/' + token).status_code)
+            with mock.patch.object(snappass_asgi, 'storage', ThreadedStorage(storage)):
+                self.assertEqual(500, asgi_request('GET', '/api/v2/passwords/' + token)[0])
+        self.assertEqual(['Failed to connect to redis! refused'] * 2, stdout.getvalue().splitlines())
+
+    def test_set_passwords_api_v2_batch_uses_one_transaction(self):
+        with mock.patch.object(snappass.redis_client, 'setex') as setex:
+            rv = self.app.post('/api/v2/passwords/batch', json=[{'password': 'a'}, {'password': 'b'}])
+        self.assertEqual(rv.status_code, 200)
+        setex.assert_not_called()
+
+    def test_set_passwords_api_v2_batch_invalid_items(self):
+        rv = self.app.post(
+            '/api/v2/passwords/batch',
+            json=[{'password': 'fine'}, {'password': ''}, {'password': 'x', 'ttl': 1209600000},
+                  {'password': 'x', 'ttl': 'soon'}, {'password': 'x', 'ttl': None}, {'password': 'x', 'ttl': 0},
+                  {'password': 'x', 'views': 0}],
+        )
+        self.assertEqual(rv.status_code, 400)
+
+        invalid_params = rv.get_json()['invalid-params']
+        self.assertEqual(['[1].password', '[2].ttl', '[3].ttl', '[4].ttl', '[5].ttl', '[6].views'],
+                         [p['name'] for p in invalid_params])
+
+    def test_set_passwords_api_v2_batch_empty(self):
+        rv = self.app.post('/api/v2/passwords/batch', json=[])
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual('passwords', rv.get_json()['invalid-params'][0]['name'])
+
+    def test_check_passwords_api_v2(self):
+        live = snappass.set_password('still here', 60)
+        burned = snappass.set_password('gone', 60)
+        snappass.get_password(burned)
+
+        with mock.patch.object(snappass.redis_client, 'exists') as exists:
+            rv = self.app.post('/api/v2/passwords/status', json=[live, burned, 'garbage'])
+        exists.assert_not_called()
+        self.assertEqual(rv.status_code, 200)
+
+        statuses = rv.get_json()
+        self.assertEqual([live, burned, 'garbage'], [status['token'] for status in statuses])
+        self.assertEqual([True, False, False], [status['exists'] for status in statuses])
+        self.assertEqual(60, statuses[0]['ttl'])
+        self.assertIsNone(statuses[1]['ttl'])
+
+    def test_check_passwords_api_v2_invalid(self):
+        for tokens in ([], 'not a list', [42]):
+            rv = self.app.post('/api/v2/passwords/status', json=tokens)
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual('tokens', rv.get_json()['invalid-params'][0]['name'])
+
+    def test_set_password_api_v2_crypto_saturated(self):
+        executor = CryptoExecutor('thread', max_workers=1, max_pending=1)
+        release = threading.Event()
+        blocked = executor._submit(release.wait)
+        with patch_service('crypto_executor', executor):
+            rv = self.app.post('/api/v2/passwords', json={'password': 'foo'})
+            self.assertEqual(rv.status_code, 503)
+            release.set()
+            blocked.result()
+            executor.shutdown()
+            rv = self.app.post('/api/v2/passwords', json={'password': 'foo'})
+            self.assertEqual(rv.status_code, 200)
+        executor.shutdown()
+
     def test_check_password_api_v2(self):
         password = 'my name is my passport. verify me.'
         rv = self.app.post(
@@ -314,6 +693,71 @@ class SnapPassRoutesTestCase(TestCase):
         rvc = self.app.head('/api/v2/passwords/' + quote(key[::-1]))
         self.assertEqual(rvc.status_code, 404)
 
+    def test_multi_view_password_api_v2(self):
+        rv = self.app.post('/api/v2/passwords', json={'password': 'shared', 'views': 2})
+        self.assertEqual(2, rv.get_json()['views'])
+        url = '/api/v2/passwords/' + quote(rv.get_json()['token'])
+
+        self.assertEqual('2', self.app.head(url).headers['X-Remaining-Views'])
+        rvc = self.app.get(url)
+        self.assertEqual({'password': 'shared', 'remaining_views': 1}, rvc.get_json())
+        self.assertEqual('1', rvc.headers['X-Remaining-Views'])
+        self.assertEqual('1', self.app.head(url).headers['X-Remaining-Views'])
+        self.assertEqual(0, self.app.get(url).get_json()['remaining_views'])
+        self.assertEqual(404, self.app.head(url).status_code)
+        self.assertEqual(404, self.app.get(url).status_code)
+
+    def test_multi_view_password_api_v2_invalid_views(self):
+        for views in (0, 11, 'many'):
+            rv = self.app.post('/api/v2/passwords', json={'password': 'shared', 'views': views})
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual(['views'], [param['name'] for param in rv.get_json()['invalid-params']])
+
+    def test_multi_view_password_form_and_api(self):
+        rv = self.app.post('/', data={'password': 'team secret', 'ttl': 'hour', 'views': '2'},
+                           headers={'Accept': 'application/json'})
+        key = rv.get_json()['link'].split('/')[-1]
+        first = self.app.post('/' + key).get_data(as_text=True)
+        self.assertIn('team secret', first)
+        self.assertIn('1 more time', first)
+        self.assertNotIn('1 more time', self.app.post('/' + key).get_data(as_text=True))
+        self.assertEqual(404, self.app.post('/' + key).status_code)
+
+        self.assertEqual(400, self.app.post('/', data={'password': 'x', 'ttl': 'hour', 'views': '0'}).status_code)
+        link = self.app.post('/api/set_password/', json={'password': 'api secret', 'views': 3}).get_json()['link']
+        token = unquote(link.split('/')[-1])
+        self.assertEqual(3, snappass.password_views(token))
+
+    def test_client_encrypted_password(self):
+        ciphertext = base64.urlsafe_b64encode(os.urandom(48)).rstrip(b'=').decode('ascii')
+        with mock.patch.dict(snappass.app.config, {'SNAPPASS_CLIENT_ENCRYPTION': True}), \
+                mock.patch.object(snappass, 'encrypt_steps') as encrypt, \
+                mock.patch.object(snappass, 'decrypt_steps') as decrypt, \
+                patch_service('page_cache', {}):
+            self.assertIn('set_password.js', self.app.get('/').get_data(as_text=True))
+            rv = self.app.post('/', data={'password': ciphertext, 'ttl': 'hour', 'encrypted': '1'})
+            self.assertIn('confirm.js', rv.get_data(as_text=True))
+            rv = self.app.post('/', data={'password': ciphertext, 'ttl': 'hour', 'views': '2', 'encrypted': '1'},
+                               headers={'Accept': 'application/json'})
+            key = rv.get_json()['link'].split('/')[-1]
+            self.assertNotIn(snappass.TOKEN_SEPARATOR, unquote(key))
+            preview = self.app.get('/' + key)
+            self.assertEqual(200, preview.status_code)
+            # Only these are decrypted by the preview page.
+            self.assertIn('data-client-encrypted="true"', preview.get_data(as_text=True))
+            reveal = self.app.post('/' + key, headers={'Accept': 'application/json'})
+            self.assertEqual({'password': ciphertext, 'remaining_views': 1}, reveal.get_json())
+            self.assertIn(ciphertext, self.app.post('/' + key).get_data(as_text=True))
+            self.assertEqual(404, self.app.post('/' + key, headers={'Accept': 'application/json'}).status_code)
+            self.assertEqual(400, self.app.post(
+                '/', data={'password': 'not base64!', 'ttl': 'hour', 'encrypted': '1'}).status_code)
+        encrypt.assert_not_called()
+        decrypt.assert_not_called()
+        preview = self.app.get('/' + quote(snappass.set_password('server side', 30)))
+        self.assertIn('data-client-encrypted="false"', preview.get_data(as_text=True))
+        self.assertEqual(400, self.app.post(
+            '/', data={'password': ciphertext, 'ttl': 'hour', 'encrypted': '1'}).status_code)
+
     def test_retrieve_password_api_v2(self):
         password = 'my name is my passport. verify me.'
         rv = self.app.post(
@@ -353,5 +797,1312 @@ class SnapPassRoutesTestCase(TestCase):
         self.assertEqual(bad_token['name'], 'token')
 
 
+class StorageTestMixin:
+
+    def test_set_and_getdel(self):
+        self.storage.set('key', 30, b'value')
+        self.assertTrue(self.storage.exists('key'))
+        self.assertEqual(b'value', self.storage.getdel('key'))
+        self.assertIsNone(self.storage.getdel('key'))
+        self.assertFalse(self.storage.exists('key'))
+
+    def test_set_many_and_pttl_many(self):
+        self.storage.set_many([('a', 30, b'1'), ('b', 60, b'2')])
+        pttls = self.storage.pttl_many(['a', 'missing', 'b'])
+        self.assertEqual(-2, pttls[1])
+        self.assertTrue(29000 < pttls[0] <= 30000)
+        self.assertTrue(59000 < pttls[2] <= 60000)
+
+    def test_expiry(self):
+        with freeze_time("2020-05-08 12:00:00") as frozen_time:
+            self.storage.set('short', 1, b'1')
+            self.storage.set('long', 60, b'2')
+            frozen_time.move_to("2020-05-08 12:00:02")
+            self.assertFalse(self.storage.exists('short'))
+            self.assertIsNone(self.storage.getdel('short'))
+            self.assertEqual([-2], self.storage.pttl_many(['short']))
+            self.assertEqual(b'2', self.storage.getdel('long'))
+
+    def test_set_many_with_views(self):
+        self.storage.set_many([('once', 30, b'1'), ('twice', 30, b'2', 2)])
+        self.assertEqual([1, 2], [self.storage.views('once'), self.storage.views('twice')])
+        self.assertEqual([(b'2', 1), (b'2', 0), (None, 0)], [self.storage.take('twice') for _ in range(3)])
+
+    def test_take_counts_views_down(self):
+        self.storage.set('once', 30, b'1')
+        self.assertEqual(1, self.storage.views('once'))
+        self.assertEqual((b'1', 0), self.storage.take('once'))
+        self.assertEqual((None, 0), self.storage.take('once'))
+
+        self.storage.set('thrice', 30, b'3', views=3)
+        self.assertEqual(3, self.storage.views('thrice'))
+        self.assertEqual([(b'3', 2), (b'3', 1), (b'3', 0), (None, 0)],
+                         [self.storage.take('thrice') for _ in range(4)])
+        self.assertEqual(0, self.storage.views('thrice'))
+        self.assertFalse(self.storage.exists('thrice'))
+
+    def test_peek(self):
+        self.storage.set('once', 30, b'1')
+        self.storage.set('twice', 30, b'2', views=2)
+        self.assertEqual(b'1', self.storage.peek('once'))
+        self.assertEqual(b'2', self.storage.peek('twice'))
+        self.assertIsNone(self.storage.peek('missing'))
+        self.assertEqual(1, self.storage.views('once'))
+        self.assertEqual(2, self.storage.views('twice'))
+
+    def test_take_last(self):
+        self.storage.set('once', 30, b'1')
+        self.assertEqual((b'1', 0), self.storage.take_last('once'))
+        self.assertEqual((None, 0), self.storage.take_last('once'))
+
+        # The last view of a secret created with several
+        self.storage.set('twice', 30, b'2', views=2)
+        self.storage.take('twice')
+        self.assertEqual((b'2', 0), self.storage.take_last('twice'))
+        self.assertEqual(0, self.storage.views('twice'))
+
+    def test_ping(self):
+        self.assertTrue(self.storage.ping())
+
+
+class RedisStorageTestCase(StorageTestMixin, TestCase):
+
+    def setUp(self):
+        self.storage = RedisStorage(FakeStrictRedis())
+
+    def test_take_falls_back_without_scripting(self):
+        self.storage.set('views', 30, b'x', views=2)
+        self.assertEqual((b'x', 1), self.storage.take('views'))
+        self.assertEqual([self.storage._take_transaction], self.storage.take_strategies)
+        self.assertTrue(0 < self.storage.pttl_many(['views'])[0] <= 30000)
+
+    def test_concurrent_fallbacks_keep_the_last_strategy(self):
+        keys = ['views%d' % index for index in range(16)]
+        for key in keys:
+            self.storage.set(key, 30, b'x', views=2)
+        script = self.storage.take_strategies[0]
+        barrier = threading.Barrier(len(keys))
+        results = []
+
+        def take(key):
+            barrier.wait()
+            results.append(self.storage.take(key))
+
+        # Every thread first gets "unknown command" from the script.
+        with mock.patch.object(self.storage, 'take_strategies', [script, self.storage._take_transaction]):
+            threads = [threading.Thread(target=take, args=(key,)) for key in keys]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([self.storage._take_transaction], self.storage.take_strategies)
+        self.assertEqual([(b'x', 1)] * len(keys), results)
+
+
+class MemoryStorageTestCase(StorageTestMixin, TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def test_memory_bound(self):
+        storage = MemoryStorage(max_bytes=20)
+        storage.set('a', 30, b'x' * 10)
+        self.assertRaises(InsufficientCapacity, storage.set, 'b', 30, b'x' * 10)
+        storage.getdel('a')
+        storage.set('b', 30, b'x' * 10)
+        self.assertEqual(11, storage.size)
+
+    def test_full_storage_answers_a_capacity_problem(self):
+        app = snappass.create_app({'SNAPPASS_STORAGE': 'memory', 'SNAPPASS_STORAGE_MAX_BYTES': '200'})
+        client = app.test_client()
+        self.assertEqual(200, client.post('/api/v2/passwords', json={'password': 'x', 'ttl': 30}).status_code)
+        rv = client.post('/api/v2/passwords', json={'password': 'x' * 200})
+        self.assertEqual(507, rv.status_code)
+        self.assertEqual('application/problem+json', rv.headers['Content-Type'])
+        self.assertTrue(rv.get_json()['type'].endswith('insufficient-capacity'))
+        self.assertTrue(0 < int(rv.headers['Retry-After']) <= 30)
+
+    def test_expired_secrets_free_memory(self):
+        storage = MemoryStorage(max_bytes=20)
+        with freeze_time("2020-05-08 12:00:00") as frozen_time:
+            storage.set('a', 1, b'x' * 10)
+            frozen_time.move_to("2020-05-08 12:00:02")
+            storage.set('b', 30, b'x' * 10)
+        self.assertEqual(['b'], list(storage._values))
+
+
+class SQLiteStorageTestCase(StorageTestMixin, TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = SQLiteStorage(os.path.join(directory.name, 'snappass.sqlite3'), sweep_interval=0)
+        self.addCleanup(self.storage.close)
+
+    def test_is_shared_between_threads(self):
+        self.storage.set('key', 30, b'value')
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.storage.getdel('key')))
+        thread.start()
+        thread.join()
+        self.assertEqual([b'value'], results)
+
+    def test_sweep_deletes_expired_rows(self):
+        with freeze_time("2020-05-08 12:00:00") as frozen_time:
+            self.storage.set('short', 1, b'1')
+            frozen_time.move_to("2020-05-08 12:00:02")
+            self.storage.set('long', 60, b'2')
+        rows = self.storage._connect().execute('SELECT key FROM secrets').fetchall()
+        self.assertEqual([('long',)], rows)
+
+    def test_adds_views_column(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'old.sqlite3')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE secrets (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                               'expires_at REAL NOT NULL)')
+            connection.execute('INSERT INTO secrets VALUES (?, ?, ?)', ('old', b'1', time.time() + 30))
+            connection.commit()
+            connection.close()
+            storage = SQLiteStorage(path)
+            self.assertEqual((b'1', 0), storage.take('old'))
+            storage.set('new', 30, b'2', views=2)
+            self.assertEqual(2, storage.views('new'))
+            storage.close()
+
+
+class ShardingTestCase(TestCase):
+
+    def setUp(self):
+        self.shards = [('a', RedisStorage(FakeStrictRedis())), ('b', RedisStorage(FakeStrictRedis()))]
+        self.storage = ShardedStorage(self.shards, 'snappass')
+
+    def test_key_layout(self):
+        uuid_hex = uuid.uuid4().hex
+        self.assertEqual('snappass' + uuid_hex, build_key('snappass', uuid_hex))
+        key = build_key('snappass', uuid_hex, 'ops', 'b', file=True)
+        self.assertEqual('snappassops.b-file' + uuid_hex, key)
+        self.assertEqual(('ops', 'b', True, uuid_hex), parse_key('snappass', key))
+        self.assertEqual(('ops', 'b', True, uuid_hex), parse_key('snappass', chunk_key(key, 3)))
+        self.assertEqual((None, None, False, uuid_hex), parse_key('snappass', 'snappass' + uuid_hex))
+        self.assertIsNone(parse_key('snappass', 'garbage'))
+
+    def test_ring_moves_few_keys(self):
+        keys = [uuid.uuid4().hex for _ in range(2000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.shard(key) != after.shard(key)]
+        self.assertTrue(200 < len(moved) < 800)
+        self.assertEqual({'d'}, {after.shard(key) for key in moved})
+
+    def test_routes_by_recorded_shard(self):
+        keys = [build_key('snappass', uuid.uuid4().hex, shard=shard) for shard in ('a', 'b', 'b')]
+        legacy = 'snappass' + uuid.uuid4().hex
+        self.storage.set_many([(key, 30, b'x') for key in keys])
+        self.storage.set(legacy, 60, b'legacy')
+        self.assertEqual([2, 2], [storage.client.dbsize() for name, storage in self.shards])
+        self.assertEqual(b'legacy', self.shards[0][1].client.get(legacy))
+        pttls = self.storage.pttl_many([keys[1], legacy, keys[0], 'garbage'])
+        self.assertTrue(29000 < pttls[0] <= 30000 and 59000 < pttls[1] <= 60000 and 29000 < pttls[2] <= 30000)
+        self.assertEqual(-2, pttls[3])
+
+        # Adding a shard keeps every existing key reachable
+        grown = ShardedStorage(self.shards + [('c', RedisStorage(FakeStrictRedis()))], 'snappass')
+        self.assertEqual([(b'x', 0)] * 3, [grown.take(key) for key in keys])
+        self.assertEqual(b'legacy', grown.getdel(legacy))
+
+    def test_tenants_and_shards(self):
+        app = snappass.create_app({'SNAPPASS_REDIS_SHARDS': 'a=redis://a,b=redis://b',
+                                   'SNAPPASS_TENANTS': 'ops=ops-key,data=data-key',
+                                   'SNAPPASS_TENANT_SHARDS': 'data=b',
+                                   'SNAPPASS_MASTER_KEYS': master_key('key')})
+        client = app.test_client()
+        storage = app.extensions['snappass'].storage
+        self.assertIsInstance(storage, ShardedStorage)
+        tokens = {}
+        for tenant, api_key in (('ops', 'ops-key'), ('data', 'data-key'), (None, None)):
+            headers = {'X-API-Key': api_key} if api_key else {}
+            token = client.post('/api/v2/passwords', json={'password': 'sharded'}, headers=headers).get_json()['token']
+            with app.app_context():
+                storage_key = snappass.parse_token(unquote(token))[0]
+            parsed = parse_key('snappass', storage_key)
+            self.assertEqual(tenant, parsed.tenant)
+            # The data tenant is pinned to shard b
+            self.assertIn(parsed.shard, ('b',) if tenant == 'data' else ('a', 'b'))
+            self.assertTrue(storage.shards[parsed.shard].exists(storage_key))
+            tokens[tenant] = token
+        for token in tokens.values():
+            self.assertEqual('sharded', client.get('/api/v2/passwords/' + token).get_json()['password'])
+
+        file_token = client.post('/api/v2/files?filename=a.txt', data=b'shard file',
+                                 headers={'X-API-Key': 'ops-key'}).get_json()['token']
+        self.assertEqual(b'shard file', client.get('/api/v2/files/' + file_token).get_data())
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, snappass.create_app, {'SNAPPASS_TENANTS': 'Bad Name=key'})
+        self.assertRaises(ValueError, snappass.create_app, {'SNAPPASS_TENANTS': 'ops'})
+        self.assertRaises(ValueError, snappass.create_app, {'SNAPPASS_TENANTS': 'a' * 65 + '=key'})
+
+
+class TokensTestCase(TestCase):
+
+    def test_round_trip(self):
+        for storage_key in (StorageKey(None, None, False, uuid.uuid4().hex),
+                            StorageKey('ops', 'b', True, uuid.uuid4().hex),
+                            StorageKey(None, 'b', False, uuid.uuid4().hex)):
+            for key in (None, os.urandom(SECRET_KEY_SIZE), Fernet.generate_key()):
+                token = encode_token('secret', storage_key, key)
+                self.assertRegex(token, r'^[A-Za-z0-9_-]+$')
+                self.assertEqual((storage_key, key), decode_token('secret', token))
+
+    def test_rejects_tampering(self):
+        token = encode_token('secret', StorageKey('ops', None, False, uuid.uuid4().hex), Fernet.generate_key())
+        self.assertIsNone(decode_token('other secret', token))
+        self.assertIsNone(decode_token('secret', token[:-2]))
+        self.assertIsNone(decode_token('secret', token + 'AA'))
+        self.assertIsNone(decode_token('secret', token.replace('~', '')[:10]))
+        for index in range(len(token)):
+            tampered = token[:index] + ('A' if token[index] != 'A' else 'B') + token[index + 1:]
+            self.assertIsNone(decode_token('secret', tampered))
+
+
+class CreateStorageTestCase(TestCase):
+
+    def test_backends(self):
+        with mock.patch.dict('os.environ', {'SNAPPASS_STORAGE': 'memory', 'SNAPPASS_STORAGE_MAX_BYTES': '1024'}):
+            storage = create_storage(None)
+        self.assertIsInstance(storage, MemoryStorage)
+        self.assertEqual(1024, storage.max_bytes)
+
+        with mock.patch.dict('os.environ', {'SNAPPASS_STORAGE': 'floppy'}):
+            self.assertRaises(ValueError, create_storage, None)
+
+    def test_routes_with_memory_storage(self):
+        app = snappass.create_app({'SNAPPASS_STORAGE': 'memory'}).test_client()
+        token = app.post('/api/v2/passwords', json={'password': 'in memory'}).get_json()['token']
+        self.assertEqual(200, app.head('/api/v2/passwords/' + quote(token)).status_code)
+        self.assertEqual('in memory', app.get('/api/v2/passwords/' + quote(token)).get_json()['password'])
+        self.assertEqual(404, app.head('/api/v2/passwords/' + quote(token)).status_code)
+
+
+class CreateAppTestCase(TestCase):
+
+    def test_backends_are_built_on_first_use(self):
+        app = snappass.create_app({'SNAPPASS_STORAGE': 'memory'})
+        services = app.extensions['snappass']
+        self.assertNotIn('storage', services.__dict__)
+        self.assertNotIn('redis_client', services.__dict__)
+        app.test_client().post('/api/v2/passwords', json={'password': 'lazy'})
+        self.assertIsInstance(services.storage, MemoryStorage)
+        self.assertNotIn('redis_client', services.__dict__)
+
+    def test_apps_are_independent(self):
+        alpha = snappass.create_app({'SNAPPASS_STORAGE': 'memory', 'REDIS_PREFIX': 'alpha', 'NO_SSL': 'true'})
+        beta = snappass.create_app({'SNAPPASS_STORAGE': 'memory', 'SNAPPASS_MAX_BATCH_SIZE': '1'})
+        self.assertTrue(alpha.config['NO_SSL'])
+        self.assertFalse(beta.config['NO_SSL'])
+        self.assertIsNot(alpha.extensions['snappass'].storage, beta.extensions['snappass'].storage)
+
+        token = alpha.test_client().post('/api/v2/passwords', json={'password': 'alpha'}).get_json()['token']
+        with alpha.app_context():
+            self.assertTrue(snappass.parse_token(token)[0].startswith('alpha'))
+        self.assertEqual(404, beta.test_client().head('/api/v2/passwords/' + token).status_code)
+        self.assertEqual(200, alpha.test_client().head('/api/v2/passwords/' + token).status_code)
+
+        passwords = [{'password': 'one'}, {'password': 'two'}]
+        self.assertEqual(200, alpha.test_client().post('/api/v2/passwords/batch', json=passwords).status_code)
+        self.assertEqual(400, beta.test_client().post('/api/v2/passwords/batch', json=passwords).status_code)
+
+    def test_import_has_no_side_effects(self):
+        code = ('import sys, snappass.main; '
+                'print([name for name in ("redis", "prometheus_client", "distutils") if name in sys.modules])')
+        output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(b'[]', output.strip())
+
+
+class FilesTestCase(TestCase):
+
+    def setUp(self):
+        snappass.app.config['TESTING'] = True
+        self.app = snappass.app.test_client()
+        self.storage = MemoryStorage()
+
+    def test_store_and_open_file(self):
+        content = os.urandom(1000)
+        key = store_file(self.storage, 'file', io.BytesIO(content), 30, 'cert.pem', 'text/plain', 64, 4096)
+        self.assertEqual(16, len(self.storage._values) - 1)
+
+        header, chunks = open_file(self.storage, 'file', key)
+        self.assertEqual({'filename': 'cert.pem', 'content_type': 'text/plain', 'size': 1000, 'chunks': 16}, header)
+        self.assertEqual(content, b''.join(chunks))
+        self.assertEqual(0, len(self.storage._values))
+        self.assertEqual((None, None), open_file(self.storage, 'file', key))
+
+    def test_empty_file(self):
+        key = store_file(self.storage, 'file', io.BytesIO(b''), 30, None, None, 64, 4096)
+        header, chunks = open_file(self.storage, 'file', key)
+        self.assertEqual(0, header['size'])
+        self.assertEqual(b'', b''.join(chunks))
+
+    def test_file_too_large(self):
+        stream = io.BytesIO(b'x' * 1000)
+        self.assertRaises(FileTooLarge, store_file, self.storage, 'file', stream, 30, None, None, 64, 999)
+        self.assertEqual(0, len(self.storage._values))
+
+    def test_chunks_cannot_be_swapped(self):
+        key = store_file(self.storage, 'file', io.BytesIO(b'a' * 128), 30, None, None, 64, 4096)
+        self.storage._values[chunk_key('file', 0)], self.storage._values[chunk_key('file', 1)] = \
+            self.storage._values[chunk_key('file', 1)], self.storage._values[chunk_key('file', 0)]
+        header, chunks = open_file(self.storage, 'file', key)
+        self.assertRaises(CorruptFile, b''.join, chunks)
+
+    def test_upload_and_download_api_v2(self):
+        content = os.urandom(200000)
+        rv = self.app.post('/api/v2/files?filename=bundle.tar&ttl=60', data=content,
+                           content_type='application/x-tar')
+        self.assertEqual(200, rv.status_code)
+        token = rv.get_json()['token']
+        self.assertTrue(snappass.is_file_key(snappass.parse_token(token)[0]))
+        self.assertIn('/api/v2/files/', rv.get_json()['links'][0]['href'])
+        # Files aren't passwords.
+        self.assertIsNone(snappass.get_password(token))
+
+        self.assertEqual(200, self.app.head('/api/v2/files/' + quote(token)).status_code)
+        rv = self.app.get('/api/v2/files/' + quote(token))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/x-tar', rv.mimetype)
+        self.assertIn('bundle.tar', rv.headers['Content-Disposition'])
+        self.assertEqual(str(len(content)), rv.headers['Content-Length'])
+        self.assertEqual(content, rv.get_data())
+
+        self.assertEqual(404, self.app.head('/api/v2/files/' + quote(token)).status_code)
+        rv = self.app.get('/api/v2/files/' + quote(token))
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual('token', rv.get_json()['invalid-params'][0]['name'])
+
+    def test_upload_multipart_and_reveal_on_web(self):
+        rv = self.app.post('/api/v2/files', data={'file': (io.BytesIO(b'secret key'), 'id_rsa'), 'ttl': '60'})
+        token = rv.get_json()['token']
+
+        rv = self.app.get('/' + quote(token))
+        self.assertEqual(200, rv.status_code)
+        self.assertNotIn(b'secret key', rv.get_data())
+        rv = self.app.post('/' + quote(token))
+        self.assertEqual(b'secret key', rv.get_data())
+        self.assertIn('id_rsa', rv.headers['Content-Disposition'])
+        self.assertEqual(404, self.app.post('/' + quote(token)).status_code)
+
+    def test_upload_validation(self):
+        rv = self.app.post('/api/v2/files?ttl=%d' % (snappass.MAX_TTL + 1), data=b'x')
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual('ttl', rv.get_json()['invalid-params'][0]['name'])
+        for ttl in (0, -5):
+            rv = self.app.post('/api/v2/files?ttl=%d' % ttl, data=b'x')
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual('application/problem+json', rv.headers['Content-Type'])
+            self.assertEqual('ttl', rv.get_json()['invalid-params'][0]['name'])
+
+        with mock.patch.dict(snappass.app.config, {'SNAPPASS_MAX_FILE_SIZE': 10}):
+            rv = self.app.post('/api/v2/files', data=b'x' * 11)
+            self.assertEqual('file', rv.get_json()['invalid-params'][0]['name'])
+            rv = self.app.post('/api/v2/files', data={'file': (io.BytesIO(b'x' * 11), 'big')})
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual('file', rv.get_json()['invalid-params'][0]['name'])
+
+        # Multipart bodies beyond the limit are refused before being spooled.
+        with mock.patch.dict(snappass.app.config, {'SNAPPASS_MAX_FILE_SIZE': 10, 'MAX_CONTENT_LENGTH': 100}), \
+                mock.patch('snappass.main.store_file') as store_file:
+            rv = self.app.post('/api/v2/files', data={'file': (io.BytesIO(b'x' * 200), 'big')})
+            self.assertEqual(400, rv.status_code)
+            self.assertEqual('file', rv.get_json()['invalid-params'][0]['name'])
+        store_file.assert_not_called()
+        self.assertEqual(snappass.app.config['SNAPPASS_MAX_FILE_SIZE'] + snappass.MULTIPART_HEADROOM,
+                         snappass.app.config['MAX_CONTENT_LENGTH'])
+
+    def test_password_routes_agree_on_files(self):
+        token = self.app.post('/api/v2/files', data=b'not a password').get_json()['token']
+        self.assertEqual(404, self.app.head('/api/v2/passwords/' + quote(token)).status_code)
+        self.assertEqual(404, self.app.get('/api/v2/passwords/' + quote(token)).status_code)
+        self.assertEqual(404, asgi_request('HEAD', '/api/v2/passwords/' + quote(token))[0])
+        self.assertEqual(200, self.app.head('/api/v2/files/' + quote(token)).status_code)
+
+    def test_asgi_delegates_files(self):
+        rv = self.app.post('/api/v2/files', data=b'served by flask')
+        token = rv.get_json()['token']
+        status, body = asgi_request('POST', '/' + quote(token))
+        self.assertEqual(200, status)
+        self.assertEqual(b'served by flask', body)
+
+
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        snappass.app.config['TESTING'] = True
+        self.app = snappass.app.test_client()
+        self.limiter = RateLimiter({'api_v2_set_password': (2, 1.0)}, LocalBuckets(), api_keys=['trusted'])
+
+    def test_parse_limits(self):
+        limits = parse_limits('60/minute', 'api_v2_set_file=2/hour,handle_password=off',
+                              snappass.RATE_LIMITED_ENDPOINTS)
+        self.assertEqual((60, 1.0), limits['api_v2_set_password'])
+        self.assertEqual((2, 2 / 3600), limits['api_v2_set_file'])
+        self.assertNotIn('handle_password', limits)
+        self.assertEqual({}, parse_limits(None, None, snappass.RATE_LIMITED_ENDPOINTS))
+        self.assertRaises(ValueError, parse_limits, '60/fortnight', None, ())
+        self.assertRaises(ValueError, parse_limits, None, 'handle_password=-1/minute', ())
+
+    def test_local_buckets_refill(self):
+        now = [0.0]
+        buckets = LocalBuckets(clock=lambda: now[0])
+        self.assertEqual(0, buckets.take('a', 2, 0.5))
+        self.assertEqual(0, buckets.take('a', 2, 0.5))
+        self.assertEqual(2.0, buckets.take('a', 2, 0.5))
+        self.assertEqual(0, buckets.take('b', 2, 0.5))
+        now[0] = 2.0
+        self.assertEqual(0, buckets.take('a', 2, 0.5))
+        self.assertEqual(2.0, buckets.take('a', 2, 0.5))
+
+    def test_over_limit_clients_are_turned_away_locally(self):
+        with mock.patch.object(self.limiter.buckets, 'take', wraps=self.limiter.buckets.take) as take:
+            self.assertEqual(0, self.limiter.check('api_v2_set_password', 'ip:1'))
+            self.assertEqual(0, self.limiter.check('api_v2_set_password', 'ip:1'))
+            self.assertGreater(self.limiter.check('api_v2_set_password', 'ip:1'), 0)
+            self.assertGreater(self.limiter.check('api_v2_set_password', 'ip:1'), 0)
+            self.assertEqual(3, take.call_count)
+            self.assertEqual(0, self.limiter.check('index', 'ip:1'))
+            self.assertEqual(3, take.call_count)
+
+    def test_concurrent_checks(self):
+        limiter = RateLimiter({'api_v2_set_password': (1, 1e-6)}, LocalBuckets(), max_blocked=8)
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def check(index):
+            barrier.wait()
+            try:
+                for attempt in range(200):
+                    limiter.check('api_v2_set_password', 'ip:%d' % ((index * 200 + attempt) % 50))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=check, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertLessEqual(len(limiter._blocked), 8)
+
+    def test_identity(self):
+        self.assertEqual('ip:10.0.0.1', self.limiter.identity('10.0.0.1', 'made up'))
+        self.assertTrue(self.limiter.identity('10.0.0.1', 'trusted').startswith('key:'))
+        self.assertNotIn('trusted', self.limiter.identity('10.0.0.1', 'trusted'))
+
+    def test_redis_buckets_run_one_script(self):
+        client = mock.Mock()
+        client.register_script.return_value.side_effect = [[1, b'0'], [0, b'1.5']]
+        limiter = RateLimiter({'handle_password': (10, 1.0)}, RedisBuckets(client), prefix='snappassratelimit:')
+        self.assertEqual(0, limiter.check('handle_password', 'ip:1'))
+        self.assertEqual(1.5, limiter.check('handle_password', 'ip:1'))
+        client.register_script.return_value.assert_called_with(
+            keys=['snappassratelimit:handle_password:ip:1'], args=[10, 1.0, 1])
+
+    def test_falls_back_to_local_buckets_without_scripting(self):
+        with mock.patch.dict('os.environ', {'SNAPPASS_RATE_LIMIT': '1/minute'}):
+            limiter = create_rate_limiter(RedisStorage(snappass.redis_client), snappass.RATE_LIMITED_ENDPOINTS)
+        self.assertIsInstance(limiter.buckets, RedisBuckets)
+        # fakeredis is installed without Lua support.
+        self.assertEqual(0, limiter.check('handle_password', 'ip:1'))
+        self.assertIsInstance(limiter.buckets, LocalBuckets)
+        self.assertGreater(limiter.check('handle_password', 'ip:1'), 0)
+
+    def test_routes_answer_429(self):
+        with patch_service('rate_limiter', self.limiter):
+            for _ in range(2):
+                rv = self.app.post('/api/v2/passwords', json={'password': 'x'})
+                self.assertEqual(200, rv.status_code)
+            rv = self.app.post('/api/v2/passwords', json={'password': 'x'})
+            self.assertEqual(429, rv.status_code)
+            self.assertEqual('application/problem+json', rv.headers['Content-Type'])
+            self.assertEqual('1', rv.headers['Retry-After'])
+            self.assertTrue(rv.get_json()['type'].endswith('rate-limit-exceeded'))
+
+            rv = self.app.post('/api/v2/passwords', json={'password': 'x'}, headers={'X-API-Key': 'trusted'})
+            self.assertEqual(200, rv.status_code)
+            self.assertEqual(200, self.app.get('/').status_code)
+
+    def test_batches_cost_one_token_per_secret(self):
+        limiter = RateLimiter({'api_v2_set_passwords': (5, 1 / 60)}, LocalBuckets())
+        batch = [{'password': 'x'}] * 3
+        with patch_service('rate_limiter', limiter):
+            self.assertEqual(200, self.app.post('/api/v2/passwords/batch', json=batch).status_code)
+            self.assertEqual(429, self.app.post('/api/v2/passwords/batch', json=batch).status_code)
+        limiter = RateLimiter({'api_v2_set_passwords': (5, 1 / 60)}, LocalBuckets())
+        with patch_service('rate_limiter', limiter):
+            statuses = [asgi_request('POST', '/api/v2/passwords/batch', json.dumps(batch).encode(),
+                                     [('content-type', 'application/json')])[0] for _ in range(2)]
+        self.assertEqual([200, 429], statuses)
+
+    def test_clients_behind_a_proxy_get_their_own_bucket(self):
+        app = snappass.create_app({'SNAPPASS_STORAGE': 'memory', 'SNAPPASS_RATE_LIMIT': '1/minute',
+                                   'SNAPPASS_PROXY_COUNT': '1'})
+        client = app.test_client()
+
+        def create(forwarded_for):
+            return client.post('/api/v2/passwords', json={'password': 'x'},
+                               headers={'X-Forwarded-For': forwarded_for}).status_code
+
+        self.assertEqual([200, 200, 429], [create('10.0.0.1'), create('10.0.0.2'), create('10.0.0.1')])
+
+        limiter = RateLimiter({'api_v2_set_password': (1, 1 / 60)}, LocalBuckets())
+        with patch_service('rate_limiter', limiter), \
+                mock.patch.dict(snappass_asgi.app.config, {'SNAPPASS_PROXY_COUNT': 1}):
+            statuses = [asgi_request('POST', '/api/v2/passwords', b'{"password": "x"}',
+                                     [('content-type', 'application/json'), ('x-forwarded-for', forwarded_for)])[0]
+                        for forwarded_for in ('10.0.0.1', '10.0.0.2', '10.0.0.1')]
+        self.assertEqual([200, 200, 429], statuses)
+
+    def test_asgi_answers_429(self):
+        with patch_service('rate_limiter', self.limiter):
+            statuses = [asgi_request('POST', '/api/v2/passwords', b'{"password": "x"}',
+                                     [('content-type', 'application/json')])[0] for _ in range(3)]
+        self.assertEqual([200, 200, 429], statuses)
+
+
+class EventsTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.create_app({'SNAPPASS_EVENTS': 'true'})
+        self.services = self.app.extensions['snappass']
+        self.client = self.services.redis_client
+
+    def stream(self):
+        self.services.events.flush(timeout=5)
+        return [{name.decode(): value.decode() for name, value in fields.items()}
+                for entry_id, fields in self.client.xrange('snappassevents')]
+
+    def test_disabled_by_default(self):
+        self.assertFalse(snappass.current_services().events.enabled)
+
+    def test_lifecycle_events(self):
+        app = self.app.test_client()
+        token = app.post('/api/v2/passwords', json={'password': 'audited', 'ttl': 60}).get_json()['token']
+        app.head('/api/v2/passwords/' + quote(token))
+        app.get('/api/v2/passwords/' + quote(token))
+
+        events = self.stream()
+        self.assertEqual(['created', 'previewed', 'revealed'], [event['event'] for event in events])
+        self.assertEqual(1, len({event['secret'] for event in events}))
+        self.assertEqual('60', events[0]['ttl'])
+        self.assertEqual('0', events[2]['remaining_views'])
+        for event in events:
+            self.assertEqual('password', event['kind'])
+            self.assertNotIn('audited', json.dumps(event))
+            self.assertNotIn(token.split('~')[0], json.dumps(event))
+
+    def test_stream_is_bounded_and_drops_when_queue_is_full(self):
+        events = EventPublisher(self.client, 'bounded', 'snappass', maxlen=10, queue_size=5)
+        with mock.patch.object(events, '_ensure_thread'):
+            for index in range(8):
+                events.emit('created', 'snappass%d' % index)
+        self.assertEqual(3, events.dropped)
+        events.publish([{'event': 'created'}] * 50)
+        self.assertLess(self.client.xlen('bounded'), 50)
+
+    def test_expired_keys(self):
+        self.assertEqual('snappassabc', expired_key(b'snappassabc', 'snappass'))
+        self.assertIsNone(expired_key(b'snappassfileabc:3', 'snappass'))
+        self.assertIsNone(expired_key(b'snappassratelimit:ip:1', 'snappass'))
+        self.assertIsNone(expired_key(b'other', 'snappass'))
+
+        client = mock.Mock()
+        client.pubsub.return_value.listen.return_value = [
+            {'data': b'snappassabc'}, {'data': b'snappassfileabc:0'}, {'data': b'snappassfileabc'}]
+        events = mock.Mock()
+        listen_expiries(client, events, 'snappass', db=2)
+        client.pubsub.return_value.subscribe.assert_called_once_with('__keyevent@2__:expired')
+        self.assertEqual([mock.call('expired', 'snappassabc'), mock.call('expired', 'snappassfileabc')],
+                         events.emit.call_args_list)
+
+    def test_export(self):
+        for index in range(5):
+            self.client.xadd('exported', {'event': 'created', 'secret': str(index)})
+        out = io.StringIO()
+        self.assertEqual(5, export_events(self.client, 'exported', out, batch_size=2))
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([str(index) for index in range(5)], [line['secret'] for line in lines])
+
+        out = io.StringIO()
+        self.assertEqual(3, export_events(self.client, 'exported', out, since=lines[1]['id']))
+
+        self.assertEqual(5, export_events(self.client, 'exported', io.StringIO(), group='audit'))
+        self.assertEqual(0, export_events(self.client, 'exported', io.StringIO(), group='audit'))
+        self.client.xadd('exported', {'event': 'expired'})
+        self.assertEqual(1, export_events(self.client, 'exported', io.StringIO(), group='audit'))
+
+    def test_export_command(self):
+        self.client.xadd('snappassevents', {'event': 'created'})
+        out = io.StringIO()
+        with mock.patch('snappass.redis_config.create_redis_client', return_value=self.client):
+            snappass_events.main(['export'], out, environ={})
+        self.assertEqual('created', json.loads(out.getvalue())['event'])
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.app.test_client()
+
+    def test_metrics_disabled_by_default(self):
+        self.assertEqual(404, self.app.get('/_/_/metrics').status_code)
+
+    def test_metrics(self):
+        with patch_service('metrics', Metrics(CollectorRegistry())):
+            token = self.app.post('/api/v2/passwords', json={'password': 'measured'}).get_json()['token']
+            self.app.get('/api/v2/passwords/' + quote(token))
+            self.app.head('/api/v2/passwords/' + quote(token))
+            rv = self.app.get('/_/_/metrics')
+
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        exposition = rv.get_data(as_text=True)
+        for sample in (
+            'snappass_requests_total{endpoint="api_v2_set_password",method="POST",status="200"} 1.0',
+            'snappass_requests_total{endpoint="api_v2_check_password",method="HEAD",status="404"} 1.0',
+            'snappass_request_duration_seconds_count{endpoint="api_v2_retrieve_password"} 1.0',
+            'snappass_storage_command_duration_seconds_count{command="take"} 1.0',
+            'snappass_storage_command_duration_seconds_count{command="views"} 1.0',
+            'snappass_crypto_duration_seconds_count{operation="encrypt"} 1.0',
+            'snappass_crypto_duration_seconds_count{operation="decrypt"} 1.0',
+            'snappass_redis_pool_connections{state="in_use"}',
+        ):
+            self.assertIn(sample, exposition)
+
+    def test_asgi_request_metrics(self):
+        metrics = Metrics(CollectorRegistry())
+        with patch_service('metrics', metrics):
+            asgi_request('GET', '/_/_/health')
+            status, body = asgi_request('POST', '/api/v2/passwords', json.dumps({'password': 'measured'}).encode(),
+                                        [('content-type', 'application/json')])
+            asgi_request('GET', '/api/v2/passwords/' + quote(json.loads(body)['token']))
+        self.assertEqual(1, metrics.registry.get_sample_value(
+            'snappass_requests_total', {'endpoint': 'health_check', 'method': 'GET', 'status': '200'}))
+        for name, labels in (
+            ('snappass_storage_command_duration_seconds_count', {'command': 'ping'}),
+            ('snappass_storage_command_duration_seconds_count', {'command': 'set'}),
+            ('snappass_storage_command_duration_seconds_count', {'command': 'take'}),
+            ('snappass_crypto_duration_seconds_count', {'operation': 'encrypt'}),
+            ('snappass_crypto_duration_seconds_count', {'operation': 'decrypt'}),
+        ):
+            self.assertEqual(1, metrics.registry.get_sample_value(name, labels))
+        self.assertIsNotNone(metrics.registry.get_sample_value('snappass_redis_pool_connections', {'state': 'idle'}))
+
+
+class CapacityTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.app.test_client()
+
+    def monitor(self, used_memory, maxmemory=1000, metrics=None):
+        client = mock.Mock()
+        client.info.return_value = {'used_memory': used_memory, 'maxmemory': maxmemory}
+        client.dbsize.return_value = 42
+        return CapacityMonitor(client, metrics or snappass.metrics, interval=60, pressure_ttl=3600)
+
+    def test_admit(self):
+        self.assertEqual(ACCEPTED, self.monitor(500).admit())
+        self.assertEqual(ACCEPTED, self.monitor(500, maxmemory=0).admit())
+        self.assertEqual(SHORTENED, self.monitor(850).admit())
+        self.assertEqual(REJECTED, self.monitor(990).admit())
+        self.assertEqual(86400, self.monitor(500).ttl(86400))
+        self.assertEqual(3600, self.monitor(850).ttl(86400))
+        self.assertEqual(60, self.monitor(850).ttl(60))
+
+    def test_stale_sample_admits(self):
+        monitor = self.monitor(990)
+        with freeze_time("2020-05-08 12:00:00") as frozen_time:
+            self.assertEqual(REJECTED, monitor.admit())
+            frozen_time.move_to("2020-05-08 12:10:00")
+            self.assertEqual(ACCEPTED, monitor.admit())
+
+    def test_sample_metrics(self):
+        metrics = Metrics(CollectorRegistry())
+        self.monitor(850, metrics=metrics).sample()
+        self.assertEqual(850, metrics.registry.get_sample_value('snappass_redis_memory_bytes', {'kind': 'used'}))
+        self.assertEqual(1000, metrics.registry.get_sample_value('snappass_redis_memory_bytes', {'kind': 'max'}))
+        self.assertEqual(42, metrics.registry.get_sample_value('snappass_redis_keys'))
+
+    def test_full_redis_rejects_new_secrets(self):
+        metrics = Metrics(CollectorRegistry())
+        with patch_service('capacity', self.monitor(990)), patch_service('metrics', metrics):
+            rv = self.app.post('/api/v2/passwords', json={'password': 'no room'})
+            self.assertEqual(507, rv.status_code)
+            self.assertEqual('application/problem+json', rv.content_type)
+            self.assertTrue(rv.get_json()['type'].endswith('insufficient-capacity'))
+            self.assertEqual('60', rv.headers['Retry-After'])
+            self.assertEqual(507, self.app.post('/', data={'password': 'no room', 'ttl': 'hour'}).status_code)
+            self.assertEqual(507, asgi_request('POST', '/api/v2/passwords', b'{"password": "no room"}',
+                                               [('content-type', 'application/json')])[0])
+            # Reading secrets is unaffected
+            self.assertEqual(404, self.app.head('/api/v2/passwords/missing').status_code)
+        self.assertEqual(3, metrics.registry.get_sample_value('snappass_admissions_total', {'decision': 'rejected'}))
+
+    def test_pressure_shortens_ttl(self):
+        with patch_service('capacity', self.monitor(850)):
+            rv = self.app.post('/api/v2/passwords', json={'password': 'short lived', 'ttl': 86400})
+            self.assertEqual(3600, rv.get_json()['ttl'])
+            rv = self.app.post('/api/v2/passwords/batch', json=[{'password': 'a', 'ttl': 60}, {'password': 'b'}])
+            self.assertEqual([60, 3600], [item['ttl'] for item in rv.get_json()])
+        self.assertTrue(3500 < snappass.passwords_ttl([unquote(rv.get_json()[1]['token'])])[0] <= 3600)
+
+    def test_out_of_memory(self):
+        error = ResponseError("OOM command not allowed when used memory > 'maxmemory'.")
+        with patch_service('storage') as storage:
+            storage.set.side_effect = error
+            rv = self.app.post('/api/v2/passwords', json={'password': 'no room'})
+        self.assertEqual(503, rv.status_code)
+        self.assertTrue(rv.get_json()['type'].endswith('insufficient-capacity'))
+
+
+class NegativeCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.app.test_client()
+
+    def test_lru_with_ttl(self):
+        now = [0]
+        cache = NegativeCache(size=2, ttl=60, clock=lambda: now[0])
+        cache.add('a')
+        cache.add('b')
+        self.assertIn('a', cache)
+        cache.add('c')
+        # 'a' was used last, so 'b' was evicted.
+        self.assertEqual([True, False, True], [key in cache for key in 'abc'])
+        now[0] = 61
+        self.assertNotIn('a', cache)
+
+    def test_bloom_filter_remembers_recent_keys(self):
+        bloom = BloomFilter(100, error_rate=1e-6)
+        keys = [uuid.uuid4().hex for _ in range(250)]
+        for key in keys:
+            bloom.add(key)
+        # Two generations: the last full one and the current one
+        self.assertTrue(all(key in bloom for key in keys[200:]))
+        self.assertFalse(any(key in bloom for key in keys[:100]))
+        self.assertFalse(any(uuid.uuid4().hex in bloom for _ in range(1000)))
+
+        cache = NegativeCache(size=1, bloom=bloom)
+        cache.burn('burned')
+        cache.add('missing')
+        self.assertIn('burned', cache)
+
+    def test_repeated_misses_are_answered_from_memory(self):
+        cache = NegativeCache()
+        metrics = Metrics(CollectorRegistry())
+        token = snappass.set_password('burn after reading', 30)
+        storage_key = snappass.parse_token(token)[0]
+        with patch_service('negative_cache', cache), patch_service('metrics', metrics):
+            self.assertEqual('burn after reading', snappass.get_password(token))
+            self.assertIn(storage_key, cache)
+            with patch_service('storage') as storage:
+                self.assertEqual(404, self.app.get('/' + token).status_code)
+                self.assertEqual(404, self.app.head('/api/v2/passwords/' + token).status_code)
+                self.assertIsNone(snappass.get_password(token))
+            storage.views.assert_not_called()
+            storage.take.assert_not_called()
+
+            unknown = snappass.make_token(snappass.new_storage_key(), None)
+            self.assertEqual(404, self.app.get('/' + unknown).status_code)
+            self.assertIn(snappass.parse_token(unknown)[0], cache)
+        self.assertEqual(3, metrics.registry.get_sample_value('snappass_negative_cache_total', {'result': 'hit'}))
+        self.assertEqual(2, metrics.registry.get_sample_value('snappass_negative_cache_total', {'result': 'miss'}))
+
+    def test_multi_view_secrets_are_cached_once_burned(self):
+        cache = NegativeCache()
+        token = snappass.set_password('shared', 30, views=2)
+        with patch_service('negative_cache', cache):
+            self.assertEqual(('shared', 1), snappass.take_password(token))
+            self.assertNotIn(snappass.parse_token(token)[0], cache)
+            self.assertEqual(200, self.app.head('/api/v2/passwords/' + token).status_code)
+            self.assertEqual(('shared', 0), snappass.take_password(token))
+            self.assertIn(snappass.parse_token(token)[0], cache)
+
+    def test_disabled_by_default(self):
+        self.assertFalse(snappass.create_app({}).extensions['snappass'].negative_cache.enabled)
+        services = snappass.create_app({'SNAPPASS_NEGATIVE_CACHE': '100',
+                                        'SNAPPASS_NEGATIVE_CACHE_BLOOM': '1000'}).extensions['snappass']
+        self.assertEqual(100, services.negative_cache.size)
+        self.assertEqual(1000, services.negative_cache.bloom.capacity)
+
+
+class HealthTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.app.test_client()
+
+    def test_liveness_does_not_touch_storage(self):
+        with patch_service('storage') as storage:
+            rv = self.app.get('/_/_/health/live')
+        self.assertEqual(200, rv.status_code)
+        storage.assert_not_called()
+        self.assertEqual([], storage.method_calls)
+
+    def test_readiness(self):
+        probe = ReadinessProbe(snappass.storage.ping, snappass.redis_client, interval=60)
+        with patch_service('readiness', probe):
+            rv = self.app.get('/_/_/health/ready')
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv.get_json()['ready'])
+
+    def test_readiness_is_cached(self):
+        ping = mock.Mock()
+        probe = ReadinessProbe(ping, interval=60)
+        probe.check()
+        with mock.patch.object(probe, '_ensure_refreshing'):
+            for _ in range(5):
+                self.assertTrue(probe.status()['ready'])
+        self.assertEqual(1, ping.call_count)
+
+    def test_not_ready_when_storage_is_down(self):
+        probe = ReadinessProbe(mock.Mock(side_effect=redis.exceptions.ConnectionError('refused')), interval=60)
+        probe.check()
+        with mock.patch.object(probe, '_ensure_refreshing'), patch_service('readiness', probe):
+            rv = self.app.get('/_/_/health/ready')
+        self.assertEqual(503, rv.status_code)
+        self.assertIn('refused', rv.get_json()['reason'])
+
+    def test_not_ready_when_over_latency_budget(self):
+        probe = ReadinessProbe(lambda: time.sleep(0.02), latency_budget=0.01)
+        self.assertFalse(probe.check()['ready'])
+
+    def test_not_ready_when_pool_is_saturated(self):
+        client = redis.StrictRedis(connection_pool=redis.ConnectionPool(max_connections=4))
+        client.connection_pool._in_use_connections.update(object() for _ in range(4))
+        probe = ReadinessProbe(mock.Mock(), client, max_pool_usage=0.75)
+        status = probe.check()
+        self.assertFalse(status['ready'])
+        self.assertEqual(1.0, status['pool_usage'])
+
+    def test_not_ready_when_refresh_is_stuck(self):
+        with freeze_time("2020-05-08 12:00:00") as frozen_time:
+            probe = ReadinessProbe(mock.Mock(), interval=5)
+            probe.check()
+            frozen_time.move_to("2020-05-08 12:00:30")
+            with mock.patch.object(probe, '_ensure_refreshing'):
+                self.assertFalse(probe.status()['ready'])
+
+
+class PageCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.app = snappass.app.test_client()
+        snappass.current_services().page_cache.clear()
+        self.addCleanup(snappass.current_services().page_cache.clear)
+
+    def test_static_pages_are_rendered_once_per_locale(self):
+        with mock.patch.object(snappass, 'render_template', wraps=snappass.render_template) as render:
+            english = [self.app.get('/').get_data() for _ in range(3)]
+            german = [self.app.get('/', headers={'Accept-Language': 'de'}).get_data() for _ in range(3)]
+        self.assertEqual(2, render.call_count)
+        self.assertEqual(1, len(set(english)))
+        self.assertEqual(1, len(set(german)))
+
+    def test_expired_page_is_cached(self):
+        with mock.patch.object(snappass, 'render_template', wraps=snappass.render_template) as render:
+            for _ in range(3):
+                self.assertEqual(404, self.app.get('/snappassdoesnotexist').status_code)
+        self.assertEqual(1, render.call_count)
+
+
+class StaticAssetsTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.static_folder = os.path.join(directory.name, 'static')
+        shutil.copytree(os.path.join(os.path.dirname(snappass.__file__), 'static', 'snappass'),
+                        os.path.join(self.static_folder, 'snappass'))
+        with mock.patch('sys.stdout', io.StringIO()):
+            assets.build(self.static_folder)
+        self.addCleanup(assets._fingerprints.clear)
+        original_static_folder = snappass.app.static_folder
+        snappass.app.static_folder = self.static_folder
+        self.addCleanup(setattr, snappass.app, 'static_folder', original_static_folder)
+        self.app = snappass.app.test_client()
+
+    def test_build_writes_manifest_and_compressed_copies(self):
+        with open(os.path.join(self.static_folder, assets.MANIFEST)) as f:
+            manifest = json.load(f)
+        self.assertIn('snappass/css/custom.css', manifest)
+        self.assertNotIn('snappass/css/custom.css.gz', manifest)
+        path = os.path.join(self.static_folder, 'snappass', 'scripts', 'preview.js')
+        with open(path, 'rb') as original, gzip.open(path + '.gz') as compressed:
+            self.assertEqual(original.read(), compressed.read())
+
+    def test_fingerprinted_urls(self):
+        with snappass.app.test_request_context('/'):
+            url = assets.static_url('snappass/css/custom.css')
+        fingerprint = assets.file_hash(os.path.join(self.static_folder, 'snappass', 'css', 'custom.css'))
+        self.assertEqual('static/snappass/css/custom.css?v=' + fingerprint, url)
+
+        rv = self.app.get('/' + url)
+        self.assertEqual(200, rv.status_code)
+        self.assertIn('immutable', rv.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', rv.headers['Cache-Control'])
+
+    def test_unversioned_urls_are_not_cached_forever(self):
+        rv = self.app.get('/static/snappass/css/custom.css')
+        self.assertEqual(200, rv.status_code)
+        self.assertNotIn('immutable', rv.headers.get('Cache-Control', ''))
+
+    def test_compressed_copy_is_served_when_accepted(self):
+        rv = self.app.get('/static/snappass/scripts/preview.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', rv.headers['Content-Encoding'])
+        self.assertIn('javascript', rv.content_type)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        with open(os.path.join(self.static_folder, 'snappass', 'scripts', 'preview.js'), 'rb') as f:
+            self.assertEqual(f.read(), gzip.decompress(rv.get_data()))
+
+        rv = self.app.get('/static/snappass/scripts/preview.js')
+        self.assertNotIn('Content-Encoding', rv.headers)
+        rv = self.app.get('/static/snappass/scripts/preview.js', headers={'Accept-Encoding': 'gzip;q=0, br;q=0'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+        rv = self.app.get('/static/snappass/scripts/preview.js', headers={'Accept-Encoding': 'br;q=0, gzip'})
+        self.assertEqual('gzip', rv.headers['Content-Encoding'])
+
+    def test_missing_asset(self):
+        self.assertEqual(404, self.app.get('/static/snappass/missing.js').status_code)
+        self.assertEqual(404, self.app.get('/static/../main.py').status_code)
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_benchmark_runs(self):
+        for mode in ('client', 'server'):
+            out = io.StringIO()
+            benchmarks.load.main(['--mode', mode, '--iterations', '2', '--concurrency', '2', '--sizes', '32'], out)
+            report = out.getvalue()
+            for name in ('route.handle_password', 'route.show_password', 'route.api_v2_retrieve_password',
+                         'crypto.encrypt', 'storage.take', 'template.password.html'):
+                self.assertIn(name, report)
+
+    def test_startup_benchmark_runs(self):
+        out = io.StringIO()
+        benchmarks.startup.main(['--runs', '1'], out)
+        self.assertEqual(4, len(out.getvalue().splitlines()))
+
+    def test_keys_benchmark_runs(self):
+        out = io.StringIO()
+        benchmarks.keys.main(['--iterations', '2'], out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[2].startswith('envelope'))
+
+    def test_files_benchmark_runs(self):
+        out = io.StringIO()
+        benchmarks.files.main(['--sizes', '0.1', '--iterations', '1', '--chunk-size', '4096'], out)
+        self.assertEqual(2, len(out.getvalue().splitlines()))
+
+
+class RedisConfigTestCase(TestCase):
+
+    def environ(self, **values):
+        return mock.patch.dict('os.environ', values, clear=True)
+
+    def test_mock_redis(self):
+        with self.environ(MOCK_REDIS='1'):
+            self.assertIsInstance(redis_config.create_redis_client(), FakeStrictRedis)
+
+    def test_standalone_pool_options(self):
+        with self.environ(REDIS_HOST='redis.internal', SNAPPASS_REDIS_SOCKET_TIMEOUT='1.5',
+                          SNAPPASS_REDIS_CONNECT_TIMEOUT='0.5', SNAPPASS_REDIS_HEALTH_CHECK_INTERVAL='30',
+                          SNAPPASS_REDIS_KEEPALIVE='true', SNAPPASS_REDIS_MAX_CONNECTIONS='8'):
+            client = redis_config.create_redis_client()
+        pool = client.connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(8, pool.max_connections)
+        self.assertEqual('redis.internal', pool.connection_kwargs['host'])
+        self.assertEqual(1.5, pool.connection_kwargs['socket_timeout'])
+        self.assertEqual(0.5, pool.connection_kwargs['socket_connect_timeout'])
+        self.assertEqual(30, pool.connection_kwargs['health_check_interval'])
+        self.assertTrue(pool.connection_kwargs['socket_keepalive'])
+
+    def test_standalone_url(self):
+        with self.environ(REDIS_URL='redis://redis.internal:6380/2'):
+            client = redis_config.create_redis_client(use_asyncio=True)
+        self.assertIsInstance(client, redis.asyncio.StrictRedis)
+        self.assertEqual(6380, client.connection_pool.connection_kwargs['port'])
+        self.assertEqual(2, client.connection_pool.connection_kwargs['db'])
+
+    def test_sentinel(self):
+        with self.environ(REDIS_MODE='sentinel', REDIS_SENTINELS='s1:26380, s2',
+                          REDIS_SENTINEL_MASTER='secrets', SNAPPASS_REDIS_MAX_CONNECTIONS='4'):
+            client = redis_config.create_redis_client()
+        pool = client.connection_pool
+        self.assertEqual('secrets', pool.service_name)
+        self.assertEqual(4, pool.max_connections)
+        sentinels = [s.connection_pool.connection_kwargs for s in pool.sentinel_manager.sentinels]
+        self.assertEqual([('s1', 26380), ('s2', 26379)], [(s['host'], s['port']) for s in sentinels])
+
+    def test_cluster(self):
+        with self.environ(REDIS_MODE='cluster', REDIS_CLUSTER_NODES='c1:7000,c2:7001'), \
+                mock.patch('redis.cluster.RedisCluster') as cluster:
+            redis_config.create_redis_client()
+            self.assertFalse(redis_config.supports_transactions())
+        nodes = cluster.call_args.kwargs['startup_nodes']
+        self.assertEqual([('c1', 7000), ('c2', 7001)], [(n.host, n.port) for n in nodes])
+
+    def test_unknown_mode(self):
+        with self.environ(REDIS_MODE='carrier-pigeon'):
+            self.assertRaises(ValueError, redis_config.create_redis_client)
+
+
+class ServerTestCase(TestCase):
+
+    def test_options(self):
+        with mock.patch.dict('os.environ', {'SNAPPASS_WORKERS': '3', 'SNAPPASS_THREADS': '8',
+                                            'SNAPPASS_MAX_REQUESTS': '0'}):
+            options = server.server_options()
+        self.assertEqual(3, options['workers'])
+        self.assertEqual(8, options['threads'])
+        self.assertEqual(0, options['max_requests'])
+        self.assertEqual(2 * server.cpu_count() + 1, server.server_options()['workers'])
+
+    def test_select_server(self):
+        with mock.patch('importlib.util.find_spec', return_value=None):
+            self.assertEqual('development', server.select_server())
+        with mock.patch('importlib.util.find_spec', side_effect=lambda name: name == 'waitress' or None):
+            self.assertEqual('waitress', server.select_server())
+        self.assertEqual('gunicorn', server.select_server('Gunicorn'))
+        self.assertRaises(ValueError, server.select_server, 'apache')
+
+    def test_gunicorn(self):
+        settings = {}
+
+        class BaseApplication:
+            cfg = mock.Mock(set=settings.__setitem__)
+
+            def run(self):
+                self.load_config()
+                settings['app'] = self.load()
+
+        module = mock.Mock(BaseApplication=BaseApplication)
+        post_fork = mock.Mock()
+        child_exit = mock.Mock()
+        with mock.patch.dict('sys.modules', {'gunicorn': mock.Mock(), 'gunicorn.app': mock.Mock(),
+                                             'gunicorn.app.base': module}):
+            server.serve(snappass.app, '127.0.0.1', 6000, 'gunicorn', single_process=True,
+                         post_fork=post_fork, child_exit=child_exit)
+        self.assertIs(snappass.app, settings['app'])
+        self.assertEqual('127.0.0.1:6000', settings['bind'])
+        self.assertEqual(1, settings['workers'])
+        settings['post_fork'](None, None)
+        post_fork.assert_called_once_with()
+        settings['child_exit'](None, mock.Mock(pid=42))
+        child_exit.assert_called_once_with(42)
+
+    def test_main_serves_with_configured_server(self):
+        with mock.patch.object(server, 'run_waitress') as run_waitress, \
+                mock.patch.dict('os.environ', {'SNAPPASS_SERVER': 'waitress', 'SNAPPASS_PORT': '6000'}):
+            snappass.main()
+        self.assertEqual((snappass.app, '0.0.0.0', 6000), run_waitress.call_args[0][:3])
+
+    def test_reset_after_fork(self):
+        executor = CryptoExecutor('thread', max_workers=1)
+        executor.run(encrypt_bytes, 1, b'x')
+        with mock.patch.object(snappass.redis_client.connection_pool, 'reset') as reset, \
+                patch_service('crypto_executor', executor):
+            snappass.reset_after_fork()
+        reset.assert_called_once_with()
+        self.assertIsNone(executor._executor)
+
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SQLiteStorage(os.path.join(directory, 'db.sqlite3'))
+            connection = storage._connect()
+            storage.reset()
+            self.assertIsNot(connection, storage._connect())
+            connection.close()
+            storage.close()
+
+
+def asgi_request(method, path, body=b'', headers=(), chunks=None, sent=None):
+    """
+    Serve a request through the ASGI application, its body in one message or
+    as several ``chunks``, and return its status and body.
+    """
+    chunks = [body] if chunks is None else chunks
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1}
+                for index, chunk in enumerate(chunks)]
+    sent = [] if sent is None else sent
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': unquote(path),
+        'query_string': b'',
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        'server': ('localhost', 80),
+    }
+    asyncio.run(snappass_asgi.application(scope, receive, send))
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+class SnapPassAsgiTestCase(TestCase):
+
+    def request(self, method, path, body=b'', headers=()):
+        return asgi_request(method, path, body, headers)
+
+    def post_json(self, path, content):
+        return self.request('POST', path, json.dumps(content).encode('utf-8'),
+                            [('content-type', 'application/json')])
+
+    def test_health_check(self):
+        status, body = self.request('GET', '/_/_/health')
+        self.assertEqual(200, status)
+        self.assertEqual({}, json.loads(body))
+
+    def test_index_is_served_by_flask(self):
+        status, body = self.request('GET', '/')
+        self.assertEqual(200, status)
+        self.assertIn(b'password_create', body)
+
+    def test_runs_without_to_thread(self):
+        # asyncio.to_thread only exists from Python 3.9 on.
+        with mock.patch.object(asyncio, 'to_thread', side_effect=AssertionError, create=True):
+            self.assertEqual(200, self.request('GET', '/')[0])
+            with mock.patch.dict(snappass_asgi.services.rate_limiter.limits, {'api_v2_set_password': (10, 1.0)}):
+                self.assertEqual(200, self.post_json('/api/v2/passwords', {'password': 'py38'})[0])
+            storage = ThreadedStorage(MemoryStorage())
+            asyncio.run(storage.set('threaded', 30, b'py38'))
+            self.assertEqual(b'py38', asyncio.run(storage.getdel('threaded')))
+
+    def test_set_password_form(self):
+        password = 'my name is my passport. verify me.'
+        form = 'password=' + quote(password) + '&ttl=hour'
+        status, body = self.request(
+            'POST', '/', form.encode('ascii'),
+            [('content-type', 'application/x-www-form-urlencoded'), ('accept', 'application/json')])
+        self.assertEqual(200, status)
+        link = json.loads(body)['link']
+        self.assertEqual(3600, json.loads(body)['ttl'])
+        key = link.split('/')[-1]
+
+        status, body = self.request('GET', '/' + key)
+        self.assertEqual(200, status)
+        self.assertNotIn(password.encode('utf-8'), body)
+
+        status, body = self.request('POST', '/' + key)
+        self.assertEqual(200, status)
+        self.assertIn(password.encode('utf-8'), body)
+
+        status, body = self.request('POST', '/' + key)
+        self.assertEqual(404, status)
+
+    def test_set_password_api(self):
+        password = 'my name is my passport. verify me.'
+        status, body = self.post_json('/api/set_password/', {'password': password})
+        self.assertEqual(200, status)
+        key = unquote(json.loads(body)['link'].split('/')[-1])
+        self.assertEqual(password, asyncio.run(snappass_asgi.get_password(key)))
+
+    def test_v2_lifecycle(self):
+        password = 'my name is my passport. verify me.'
+        status, body = self.post_json('/api/v2/passwords', {'password': password, 'ttl': 60})
+        self.assertEqual(200, status)
+        token = json.loads(body)['token']
+
+        status, body = self.request('HEAD', '/api/v2/passwords/' + quote(token))
+        self.assertEqual(200, status)
+        self.assertEqual(b'', body)
+
+        status, body = self.request('GET', '/api/v2/passwords/' + quote(token))
+        self.assertEqual(200, status)
+        self.assertEqual(password, json.loads(body)['password'])
+
+        status, body = self.request('HEAD', '/api/v2/passwords/' + quote(token))
+        self.assertEqual(404, status)
+
+        status, body = self.request('GET', '/api/v2/passwords/' + quote(token))
+        self.assertEqual(404, status)
+        self.assertEqual('token', json.loads(body)['invalid-params'][0]['name'])
+
+    def test_v2_multi_view(self):
+        status, body = self.post_json('/api/v2/passwords', {'password': 'shared', 'views': 2})
+        path = '/api/v2/passwords/' + quote(json.loads(body)['token'])
+        self.assertEqual(200, self.request('HEAD', path)[0])
+        self.assertEqual(1, json.loads(self.request('GET', path)[1])['remaining_views'])
+        self.assertEqual(0, json.loads(self.request('GET', path)[1])['remaining_views'])
+        self.assertEqual(404, self.request('GET', path)[0])
+
+    def test_client_encrypted_password(self):
+        ciphertext = base64.urlsafe_b64encode(os.urandom(48)).rstrip(b'=').decode('ascii')
+        form = 'password=%s&ttl=hour&encrypted=1' % ciphertext
+        headers = [('content-type', 'application/x-www-form-urlencoded'), ('accept', 'application/json')]
+        with mock.patch.dict(snappass.app.config, {'SNAPPASS_CLIENT_ENCRYPTION': True}):
+            status, body = self.request('POST', '/', form.encode('ascii'), headers)
+        self.assertEqual(200, status)
+        key = json.loads(body)['link'].split('/')[-1]
+        status, body = self.request('POST', '/' + key, headers=[('accept', 'application/json')])
+        self.assertEqual({'password': ciphertext, 'remaining_views': 0}, json.loads(body))
+        self.assertEqual(400, self.request('POST', '/', form.encode('ascii'), headers)[0])
+
+    def test_v2_batch(self):
+        status, body = self.post_json('/api/v2/passwords/batch', [{'password': 'one'}, {'password': 'two'}])
+        self.assertEqual(200, status)
+        tokens = [item['token'] for item in json.loads(body)]
+        self.assertEqual(['one', 'two'], [asyncio.run(snappass_asgi.get_password(t)) for t in tokens])
+
+    def test_v2_status(self):
+        token = asyncio.run(snappass_asgi.set_password('one', 60))
+        status, body = self.post_json('/api/v2/passwords/status', [token, 'garbage'])
+        self.assertEqual(200, status)
+        self.assertEqual([True, False], [item['exists'] for item in json.loads(body)])
+
+    def test_files_and_forged_tokens(self):
+        status, body = self.request('POST', '/api/v2/files', b'asgi file')
+        token = json.loads(body)['token']
+        # Told apart from passwords once parsed, files are handed to Flask.
+        self.assertEqual((200, b'asgi file'), self.request('POST', '/' + token))
+        self.assertEqual(404, self.request('POST', '/' + token)[0])
+        with mock.patch.object(snappass_asgi, 'storage') as storage:
+            self.assertEqual(404, self.request('GET', '/' + token[:-1] + 'x')[0])
+            self.assertEqual(404, self.request('POST', '/wp-login.php')[0])
+        storage.views.assert_not_called()
+        storage.take.assert_not_called()
+
+    def test_bodies_are_streamed_through_flask(self):
+        content = os.urandom(3 * 65536 + 1)
+        chunks = [content[i:i + 50000] for i in range(0, len(content), 50000)]
+        # Without a Content-Length, the upload is read until its last message.
+        status, body = asgi_request('POST', '/api/v2/files', chunks=chunks)
+        self.assertEqual(200, status)
+        token = json.loads(body)['token']
+
+        sent = []
+        self.assertEqual((200, content), asgi_request('GET', '/api/v2/files/' + token, sent=sent))
+        # One message per chunk of the file, rather than the whole of it
+        self.assertGreater(len(sent), 4)
+
+    def test_large_bodies_are_refused(self):
+        with mock.patch.dict(snappass_asgi.app.config, {'MAX_CONTENT_LENGTH': 100}):
+            status, body = self.post_json('/api/v2/passwords', {'password': 'x' * 200})
+        self.assertEqual(413, status)
+
+    def test_v2_validation_problem(self):
+        status, body = self.post_json('/api/v2/passwords', {'password': '', 'ttl': 1209600000})
+        self.assertEqual(400, status)
+        invalid_params = json.loads(body)['invalid-params']
+        self.assertEqual(['password', 'ttl'], [p['name'] for p in invalid_params])
+
+
 if __name__ == '__main__':
     unittest.main()